@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+"""
+Throughput of a whole net on synthetic data.
+
+    python -m benchmarks.net_benchmark --model alexnet --batch-sizes 16 64 \\
+        --output alexnet.json
+    python -m benchmarks.net_benchmark --compare before.json after.json
+
+For every batch size a TRAIN net reading a synthetic LMDB is built with its
+kernels precompiled, then the data layers alone, forward and
+forward + backward are timed separately.  Forward and forward + backward
+include the data layers, as in training.  With --roofline the forward pass
+of every layer is also compared to the machine peaks, see
+Net.roofline_report.  Results are written as JSON so runs on two commits
+can be compared.
+"""
+from benchmarks.synthetic_data import make_lmdb, make_mean_file, \
+    synthetic_prototxt
+from benchmarks.timing import repeat
+from sejits_caffe.net import Net
+from sejits_caffe.layers.data_layer import DataLayer
+import sejits_caffe.caffe_pb2 as caffe_pb2
+import numpy as np
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+models = {
+    "alexnet": os.path.join(root, "tests", "layers", "alexnet.prototxt"),
+    "train_val": os.path.join(root, "train_val.prototxt"),
+}
+
+
+def measure(fn, batch_size, iterations, warmup=1):
+    """
+    Time `iterations` calls of `fn` processing `batch_size` images, see
+    benchmarks.timing.repeat.
+    """
+    result = repeat(fn, iterations, warmup)
+    result["images_per_sec"] = batch_size / result["median"]
+    return result
+
+
+def benchmark_net(prototxt, batch_size, iterations, data_workers=0,
+                  prefetch=0, roofline=False):
+    net = Net(prototxt, prefetch=prefetch, data_workers=data_workers,
+              phase=caffe_pb2.TRAIN)
+    try:
+        kernels, compile_time = net.compile()
+        result = {
+            "batch_size": batch_size,
+            "kernels": kernels,
+            "compile_time": compile_time,
+            "data": measure(net.load_data, batch_size, iterations),
+            "forward": measure(net.forward, batch_size, iterations),
+            "forward_backward": measure(net.forward_backward, batch_size,
+                                        iterations),
+        }
+        if roofline:
+            result["roofline"], report = net.roofline_report(iterations)
+            print(report)
+        return result
+    finally:
+        net.close()
+        for layer in net.layers:
+            if isinstance(layer, DataLayer):
+                layer.db.close()
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=root).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(model, batch_sizes, iterations, records, datum_shape,
+        data_workers=0, prefetch=0, roofline=False):
+    model_file = models.get(model, model)
+    workdir = tempfile.mkdtemp()
+    try:
+        source = os.path.join(workdir, "lmdb")
+        mean_file = os.path.join(workdir, "mean.binaryproto")
+        make_lmdb(source, max(records, max(batch_sizes)), datum_shape)
+        make_mean_file(mean_file, datum_shape)
+        results = []
+        for batch_size in batch_sizes:
+            prototxt = os.path.join(workdir, "net_{}.prototxt".format(
+                batch_size))
+            synthetic_prototxt(model_file, prototxt, source, mean_file,
+                               batch_size)
+            result = benchmark_net(prototxt, batch_size, iterations,
+                                   data_workers, prefetch, roofline)
+            print("batch {}: data {:.1f}, forward {:.1f}, forward_backward "
+                  "{:.1f} images/s".format(
+                      batch_size, result["data"]["images_per_sec"],
+                      result["forward"]["images_per_sec"],
+                      result["forward_backward"]["images_per_sec"]))
+            results.append(result)
+    finally:
+        shutil.rmtree(workdir)
+    return {
+        "model": model,
+        "prototxt": model_file,
+        "revision": git_revision(),
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "omp_num_threads": os.environ.get("OMP_NUM_THREADS"),
+        "iterations": iterations,
+        "datum_shape": list(datum_shape),
+        "data_workers": data_workers,
+        "prefetch": prefetch,
+        "results": results,
+    }
+
+
+def compare(before, after):
+    """
+    Print the images/s of `after` relative to `before` for every batch size
+    both ran.
+    """
+    old = dict((result["batch_size"], result) for result in before["results"])
+    print("{:>6} {:>18} {:>10} {:>10} {:>7}".format(
+        "batch", "measure", "before", "after", "ratio"))
+    for result in after["results"]:
+        if result["batch_size"] not in old:
+            continue
+        for measure_name in ("data", "forward", "forward_backward"):
+            before_rate = old[result["batch_size"]][measure_name][
+                "images_per_sec"]
+            after_rate = result[measure_name]["images_per_sec"]
+            print("{:>6} {:>18} {:>10.1f} {:>10.1f} {:>6.2f}x".format(
+                result["batch_size"], measure_name, before_rate,
+                after_rate, after_rate / before_rate))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--model", default="alexnet",
+                        help="alexnet, train_val or a .prototxt path")
+    parser.add_argument("--batch-sizes", type=int, nargs="+",
+                        default=[16, 64])
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--records", type=int, default=256,
+                        help="records in the synthetic LMDB")
+    parser.add_argument("--datum-shape", type=int, nargs=3,
+                        default=[3, 256, 256])
+    parser.add_argument("--data-workers", type=int, default=0)
+    parser.add_argument("--prefetch", type=int, default=0)
+    parser.add_argument("--roofline", action="store_true",
+                        help="also report every layer against its roofline")
+    parser.add_argument("--output", help="JSON file for the results")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"),
+                        help="compare two result files instead")
+    args = parser.parse_args(argv)
+    if args.compare:
+        with open(args.compare[0]) as f:
+            before = json.load(f)
+        with open(args.compare[1]) as f:
+            after = json.load(f)
+        compare(before, after)
+        return
+    results = run(args.model, args.batch_sizes, args.iterations,
+                  args.records, tuple(args.datum_shape), args.data_workers,
+                  args.prefetch, args.roofline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
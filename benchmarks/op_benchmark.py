@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+"""
+Microbenchmarks of the specialized operations, im2col/col2im, max pooling
+and the forward and backward of every layer, over AlexNet and VGG shapes.
+
+    python -m benchmarks.op_benchmark --repetitions 20 --output ops.json
+    python -m benchmarks.op_benchmark --filter pool
+
+The cold time of a case is the code generation and compilation of its
+kernels (for layers and the cstructures operations, the whole first
+call).  Warm times are summarized by
+their median and interquartile range, next to the same computation in pure
+NumPy where there is one.  With the kernel cache enabled a cold run may
+only load a kernel compiled by an earlier process; --no-kernel-cache times
+the compiler.
+"""
+from benchmarks.timing import repeat, timed
+from sejits_caffe.operations import convolve
+from sejits_caffe.operations.relu import relu
+from sejits_caffe.util.im2col import ParallelIm2Col
+from sejits_caffe.util.col2im import ParallelCol2Im
+from sejits_caffe.util.pooling import MaxPool, MaxPoolBackward
+from sejits_caffe.util.precompile import kernel, precompile
+from sejits_caffe.util.kernel_cache import disable_kernel_cache
+from sejits_caffe.net import Net
+import sejits_caffe.caffe_pb2 as caffe_pb2
+from google.protobuf import text_format
+from cstructures.array import Array
+import numpy as np
+import argparse
+import json
+import os
+import platform
+
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (name, (channels, height, width), kernel, pad, stride) of the convolutions
+conv_shapes = [
+    ("alexnet conv1", (3, 227, 227), 11, 0, 4),
+    ("alexnet conv2", (96, 27, 27), 5, 2, 1),
+    ("alexnet conv3", (256, 13, 13), 3, 1, 1),
+    ("vgg conv2_2", (128, 112, 112), 3, 1, 1),
+    ("vgg conv3_2", (256, 56, 56), 3, 1, 1),
+]
+
+# (name, (channels, height, width), kernel, pad, stride) of the poolings
+pool_shapes = [
+    ("alexnet pool1", (96, 55, 55), 3, 0, 2),
+    ("alexnet pool5", (256, 13, 13), 3, 0, 2),
+    ("vgg pool1", (64, 224, 224), 2, 0, 2),
+    ("vgg pool3", (256, 56, 56), 2, 0, 2),
+]
+
+# (name, AlexNet layer index or VGG layer prototxt, bottom shapes without
+# the batch size)
+alexnet_layers = [
+    ("alexnet conv1", 2, [(3, 227, 227)]),
+    ("alexnet relu1", 3, [(96, 55, 55)]),
+    ("alexnet norm1", 4, [(96, 55, 55)]),
+    ("alexnet pool1", 5, [(96, 55, 55)]),
+    ("alexnet conv2", 6, [(96, 27, 27)]),
+    ("alexnet conv3", 10, [(256, 13, 13)]),
+    ("alexnet pool5", 16, [(256, 13, 13)]),
+    ("alexnet fc6", 17, [(256, 6, 6)]),
+    ("alexnet drop6", 19, [(4096, )]),
+    ("alexnet fc8", 23, [(4096, )]),
+    ("alexnet loss", 25, [(1000, ), ()]),
+]
+vgg_filler = 'weight_filler { type: "gaussian" std: 0.01 } ' \
+    'bias_filler { type: "constant" }'
+vgg_layers = [
+    ("vgg conv2_2", 'name: "conv2_2" type: "Convolution" top: "conv2_2" '
+     'convolution_param { num_output: 128 kernel_size: 3 pad: 1 ' +
+     vgg_filler + ' }', [(128, 112, 112)]),
+    ("vgg conv3_2", 'name: "conv3_2" type: "Convolution" top: "conv3_2" '
+     'convolution_param { num_output: 256 kernel_size: 3 pad: 1 ' +
+     vgg_filler + ' }', [(256, 56, 56)]),
+    ("vgg relu2_2", 'name: "relu2_2" type: "ReLU" top: "conv2_2"',
+     [(128, 112, 112)]),
+    ("vgg pool2", 'name: "pool2" type: "Pooling" top: "pool2" '
+     'pooling_param { pool: MAX kernel_size: 2 stride: 2 }',
+     [(128, 112, 112)]),
+]
+
+
+class Case(object):
+    """
+    A benchmark: `run` is timed warm, `jobs` are the (specializer, args) it
+    compiles, or None to time the first call of `run` as the cold time.
+    """
+    def __init__(self, group, name, shape, run, reference=None, jobs=None):
+        self.group = group
+        self.name = name
+        self.shape = shape
+        self.run = run
+        self.reference = reference
+        self.jobs = jobs
+
+
+def out_size(size, kernel_size, pad, stride):
+    return (size + 2 * pad - kernel_size) // stride + 1
+
+
+def windows(data, kernel_size, pad, stride, fill=0.0):
+    """
+    A (..., out_h, out_w, kernel, kernel) view of the windows over the
+    last two axes of `data` padded with `fill`.
+    """
+    padding = [(0, 0)] * (data.ndim - 2) + [(pad, pad)] * 2
+    padded = np.pad(np.asarray(data), padding, 'constant',
+                    constant_values=fill)
+    out_h = out_size(data.shape[-2], kernel_size, pad, stride)
+    out_w = out_size(data.shape[-1], kernel_size, pad, stride)
+    strides = padded.strides
+    return np.lib.stride_tricks.as_strided(
+        padded, padded.shape[:-2] + (out_h, out_w, kernel_size, kernel_size),
+        strides[:-2] + (strides[-2] * stride, strides[-1] * stride) +
+        strides[-2:])
+
+
+def np_im2col(data, kernel_size, pad, stride):
+    num, channels, height, width = data.shape
+    height_col = out_size(height, kernel_size, pad, stride)
+    width_col = out_size(width, kernel_size, pad, stride)
+    padded = np.pad(np.asarray(data),
+                    ((0, 0), (0, 0), (pad, pad), (pad, pad)), 'constant')
+    col = np.empty((channels, kernel_size, kernel_size, num, height_col,
+                    width_col), np.float32)
+    for y in range(kernel_size):
+        for x in range(kernel_size):
+            col[:, y, x] = padded[
+                :, :, y:y + stride * height_col:stride,
+                x:x + stride * width_col:stride].transpose(1, 0, 2, 3)
+    return col.reshape(channels * kernel_size * kernel_size, -1)
+
+
+def np_col2im(col, shape, kernel_size, pad, stride):
+    num, channels, height, width = shape
+    height_col = out_size(height, kernel_size, pad, stride)
+    width_col = out_size(width, kernel_size, pad, stride)
+    col = col.reshape(channels, kernel_size, kernel_size, num, height_col,
+                      width_col)
+    padded = np.zeros((num, channels, height + 2 * pad, width + 2 * pad),
+                      np.float32)
+    for y in range(kernel_size):
+        for x in range(kernel_size):
+            padded[:, :, y:y + stride * height_col:stride,
+                   x:x + stride * width_col:stride] += \
+                col[:, y, x].transpose(1, 0, 2, 3)
+    return padded[:, :, pad:pad + height, pad:pad + width]
+
+
+def np_conv_layer(layer, bottom):
+    cols = np_im2col(bottom, layer.kernel_h, layer.padding[0],
+                     layer.stride[0])
+    weights = layer.weights.reshape(layer.group, layer.weights.shape[0] //
+                                    layer.group, -1)
+    return np.matmul(weights, cols.reshape(layer.group, weights.shape[2], -1))
+
+
+def operation_cases():
+    cases = []
+    for name, (channels, height, width), kernel_size, pad, stride in \
+            conv_shapes:
+        data = Array.rand(height, width).astype(np.float32)
+        weights = Array.rand(kernel_size, kernel_size).astype(np.float32)
+        output = Array.zeros((out_size(height, kernel_size, pad, stride),
+                              out_size(width, kernel_size, pad, stride)),
+                             np.float32)
+        args = data, weights, output, (pad, pad), (stride, stride)
+        cases.append(Case(
+            "convolve", name, data.shape,
+            lambda args=args: convolve(*args),
+            lambda data=data, weights=weights, pad=pad, stride=stride:
+            np.tensordot(windows(data, weights.shape[0], pad, stride),
+                         weights, 2)))
+    # ReLU runs on the planes the poolings read
+    for name, (channels, height, width), _, _, _ in pool_shapes:
+        bottom = Array.rand(height, width).astype(np.float32) - 0.5
+        top = Array.zeros_like(bottom)
+        args = bottom, bottom, top, 0.0
+        cases.append(Case(
+            "relu", name, bottom.shape, lambda args=args: relu(*args),
+            lambda bottom=bottom, top=top: np.maximum(bottom, 0, out=top)))
+    return cases
+
+
+def im2col_cases(num):
+    cases = []
+    for name, shape, kernel_size, pad, stride in conv_shapes:
+        shape = (num, ) + shape
+        data = Array.rand(*shape).astype(np.float32)
+        geometry = ((kernel_size, kernel_size), (stride, stride), (pad, pad))
+        im2col = ParallelIm2Col(*geometry)
+        cols = Array.zeros(im2col.col_shape(shape), np.float32)
+        cases.append(Case(
+            "im2col", name, shape,
+            lambda im2col=im2col, data=data, cols=cols: im2col(data, cols),
+            lambda data=data, kernel_size=kernel_size, pad=pad,
+            stride=stride: np_im2col(data, kernel_size, pad, stride),
+            [kernel(im2col, data, cols)]))
+        col2im = ParallelCol2Im(*(geometry + (shape, )))
+        cols = Array.rand(*cols.shape).astype(np.float32)
+        output = Array.zeros(shape, np.float32)
+        cases.append(Case(
+            "col2im", name, cols.shape,
+            lambda col2im=col2im, cols=cols, output=output:
+            col2im(cols, output),
+            lambda cols=cols, shape=shape, kernel_size=kernel_size, pad=pad,
+            stride=stride: np_col2im(cols, shape, kernel_size, pad, stride),
+            [kernel(col2im, cols, output)]))
+    return cases
+
+
+def pool_cases(num):
+    """
+    The batched max pooling kernels of PoolingLayer, forward as in TEST
+    nets (no mask) and in training, and backward.
+    """
+    cases = []
+    for name, shape, kernel_size, pad, stride in pool_shapes:
+        shape = (num, ) + shape
+        data = Array.rand(*shape).astype(np.float32)
+        top_shape = shape[:2] + (out_size(shape[2], kernel_size, pad, stride),
+                                 out_size(shape[3], kernel_size, pad, stride))
+        top = Array.zeros(top_shape, np.float32)
+        mask = Array.zeros(top_shape, np.int32)
+        geometry = ((kernel_size, kernel_size), (pad, pad), (stride, stride))
+        pool = MaxPool(*geometry)
+
+        def reference(data=data, kernel_size=kernel_size, pad=pad,
+                      stride=stride):
+            return windows(data, kernel_size, pad, stride,
+                           -np.inf).max(axis=(-2, -1))
+
+        for group, args in (("max_pool", (data, top)),
+                            ("max_pool mask", (data, top, mask))):
+            cases.append(Case(group, name, shape,
+                              lambda pool=pool, args=args: pool(*args),
+                              reference, [kernel(pool, *args)]))
+        backward = MaxPoolBackward(*geometry)
+        top_diff = Array.rand(*top_shape).astype(np.float32)
+        bottom_diff = Array.zeros_like(data)
+        args = top_diff, mask, bottom_diff
+        cases.append(Case(
+            "max_pool backward", name, top_shape,
+            lambda backward=backward, args=args: backward(*args),
+            jobs=[kernel(backward, *args)]))
+    return cases
+
+
+def layer_params():
+    param = caffe_pb2.NetParameter()
+    with open(os.path.join(root, "tests", "layers", "alexnet.prototxt")) as f:
+        text_format.Merge(f.read(), param)
+    for name, index, shapes in alexnet_layers:
+        yield name, param.layer[index], shapes
+    for name, layer_string, shapes in vgg_layers:
+        layer_param = caffe_pb2.LayerParameter()
+        text_format.Merge(layer_string, layer_param)
+        yield name, layer_param, shapes
+
+
+def layer_cases(num):
+    """
+    A forward and a backward case per layer, run as a training net would
+    with every bottom needing a gradient.  The label of a loss does not.
+    """
+    cases = []
+    for name, layer_param, shapes in layer_params():
+        layer = Net.layer_type_map[layer_param.type](layer_param)
+        bottom = [Array.rand(*((num, ) + shape)).astype(np.float32)
+                  for shape in shapes]
+        if layer_param.type == "SoftmaxWithLoss":
+            bottom[1] = np.floor(bottom[1] * shapes[0][0])
+        top = [Array.zeros(layer.get_top_shape(*bottom), np.float32)
+               for _ in range(max(len(layer_param.top), 1))]
+        layer.setup(*(bottom + top))
+        bottom_diff = [Array.zeros_like(bottom[0])] + [None] * \
+            (len(bottom) - 1)
+        top_diff = [Array.rand(*blob.shape).astype(np.float32)
+                    for blob in top]
+        reference = None
+        if layer_param.type == "Convolution":
+            def reference(layer=layer, bottom=bottom[0]):
+                return np_conv_layer(layer, bottom)
+        elif layer_param.type == "ReLU":
+            def reference(bottom=bottom[0], top=top[0]):
+                return np.maximum(bottom, 0, out=top)
+        elif layer_param.type == "Pooling":
+            def reference(layer=layer, bottom=bottom[0]):
+                return windows(bottom, layer.kernel_h, layer.pad_h,
+                               layer.stride_h, -np.inf).max(axis=(-2, -1))
+        shape = tuple(bottom[0].shape)
+        cases.append(Case(
+            "forward", name, shape,
+            lambda layer=layer, blobs=bottom + top: layer.forward(*blobs),
+            reference))
+        cases.append(Case(
+            "backward", name, shape,
+            lambda layer=layer, blobs=bottom + bottom_diff + top + top_diff:
+            layer.backward(*blobs)))
+    return cases
+
+
+def run_case(case, repetitions):
+    result = {"group": case.group, "name": case.name,
+              "shape": list(case.shape)}
+    try:
+        if case.jobs is None:
+            result["cold"] = timed(case.run)
+        else:
+            result["cold"] = sum(timed(lambda job=job: precompile(*job))
+                                 for job in case.jobs)
+        result["warm"] = repeat(case.run, repetitions)
+        if case.reference is not None:
+            result["numpy"] = repeat(case.reference, repetitions)
+    except Exception as e:
+        result["error"] = "{}: {}".format(type(e).__name__, e)
+    return result
+
+
+def format_table(results):
+    lines = ["{:<17} {:<15} {:<20} {:>9} {:>10} {:>9} {:>5} {:>10} "
+             "{:>8}".format("case", "shape", "", "cold ms", "median ms",
+                            "iqr ms", "reps", "numpy ms", "speedup")]
+    for result in results:
+        row = "{:<17} {:<15} {:<20}".format(
+            result["group"], result["name"],
+            "x".join(str(size) for size in result["shape"]))
+        if "error" in result:
+            lines.append(row + " " + result["error"])
+            continue
+        warm = result["warm"]
+        row += " {:>9.2f} {:>10.3f} {:>9.3f} {:>5}".format(
+            result["cold"] * 1e3, warm["median"] * 1e3, warm["iqr"] * 1e3,
+            warm["repetitions"])
+        if "numpy" in result:
+            row += " {:>10.3f} {:>7.2f}x".format(
+                result["numpy"]["median"] * 1e3,
+                result["numpy"]["median"] / warm["median"])
+        lines.append(row)
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--groups", nargs="+",
+                        default=["operations", "im2col", "pooling",
+                                 "layers"])
+    parser.add_argument("--filter", default="",
+                        help="only run cases whose name contains this")
+    parser.add_argument("--repetitions", type=int, default=10)
+    parser.add_argument("--num", type=int, default=1,
+                        help="images per im2col/col2im and pooling call")
+    parser.add_argument("--batch-size", type=int, default=2,
+                        help="images per layer call")
+    parser.add_argument("--no-kernel-cache", action="store_true")
+    parser.add_argument("--output", help="JSON file for the results")
+    args = parser.parse_args(argv)
+    if args.no_kernel_cache:
+        disable_kernel_cache()
+    np.random.seed(0)
+    cases = []
+    if "operations" in args.groups:
+        cases.extend(operation_cases())
+    if "im2col" in args.groups:
+        cases.extend(im2col_cases(args.num))
+    if "pooling" in args.groups:
+        cases.extend(pool_cases(args.num))
+    if "layers" in args.groups:
+        cases.extend(layer_cases(args.batch_size))
+    results = []
+    for case in cases:
+        if args.filter in "{} {}".format(case.group, case.name):
+            results.append(run_case(case, args.repetitions))
+    print(format_table(results))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"host": platform.node(),
+                       "numpy": np.__version__,
+                       "omp_num_threads": os.environ.get("OMP_NUM_THREADS"),
+                       "kernel_cache": not args.no_kernel_cache,
+                       "results": results}, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Synthetic stand-ins for the ImageNet LMDB and mean file, so that nets can be
+benchmarked without the dataset.
+"""
+from google.protobuf import text_format
+import sejits_caffe.caffe_pb2 as caffe_pb2
+import numpy as np
+import lmdb
+
+
+def make_lmdb(path, num_records, shape=(3, 256, 256), num_classes=1000,
+              seed=0):
+    """
+    Write `num_records` Datums of random uint8 pixels of `shape`
+    (channels, height, width) and random labels into a new LMDB at `path`.
+    """
+    rng = np.random.RandomState(seed)
+    record_size = int(np.prod(shape))
+    # Room for the records, their keys and LMDB's own pages
+    db = lmdb.open(path, map_size=2 * num_records * (record_size + 4096) +
+                   (1 << 20))
+    with db.begin(write=True) as txn:
+        for i in range(num_records):
+            datum = caffe_pb2.Datum(
+                channels=shape[0], height=shape[1], width=shape[2],
+                label=int(rng.randint(num_classes)),
+                data=rng.randint(0, 256, record_size).astype(
+                    np.uint8).tobytes())
+            txn.put('{:08d}'.format(i).encode(), datum.SerializeToString())
+    db.close()
+
+
+def make_mean_file(path, shape=(3, 256, 256), value=120.0):
+    """
+    Write a constant mean image of `shape` as a binaryproto.
+    """
+    blob = caffe_pb2.BlobProto(num=1, channels=shape[0], height=shape[1],
+                               width=shape[2])
+    blob.data.extend(np.full(int(np.prod(shape)), value, np.float32))
+    with open(path, "wb") as f:
+        f.write(blob.SerializeToString())
+
+
+def synthetic_prototxt(model_file, path, source, mean_file, batch_size):
+    """
+    Copy the net of `model_file` to `path` with every Data layer reading
+    `batch_size` records of `source` as LMDB, and subtracting `mean_file`
+    if it subtracted a mean file.
+    """
+    param = caffe_pb2.NetParameter()
+    with open(model_file) as f:
+        text_format.Merge(f.read(), param)
+    for layer in param.layer:
+        if layer.type != "Data":
+            continue
+        layer.data_param.source = source
+        layer.data_param.backend = caffe_pb2.DataParameter.LMDB
+        layer.data_param.batch_size = batch_size
+        if layer.transform_param.HasField("mean_file"):
+            layer.transform_param.mean_file = mean_file
+    with open(path, "w") as f:
+        f.write(text_format.MessageToString(param))
@@ -0,0 +1,33 @@
+"""
+Timing helpers shared by the benchmarks.
+"""
+import numpy as np
+import timeit
+
+
+def summarize(times):
+    """
+    Robust statistics of a list of durations in seconds: the median and
+    interquartile range are insensitive to the odd preempted run.
+    """
+    q1, median, q3 = np.percentile(times, [25, 50, 75])
+    return {"times": list(times), "repetitions": len(times),
+            "median": float(median), "iqr": float(q3 - q1),
+            "min": float(min(times))}
+
+
+def repeat(fn, repetitions, warmup=1):
+    """
+    Call `fn` `warmup` times, then time `repetitions` calls one by one.
+    """
+    for _ in range(warmup):
+        fn()
+    return summarize([timeit.timeit(fn, number=1)
+                      for _ in range(repetitions)])
+
+
+def timed(fn):
+    """
+    Call `fn` once, returning the time it took.
+    """
+    return timeit.timeit(fn, number=1)
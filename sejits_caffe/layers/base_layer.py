@@ -3,7 +3,13 @@ class BaseLayer(object):
         self.layer_param = param
         self.propagate_down = True
         self.phase = 'train'
+        # Learnable parameters and their gradients, in the order of the
+        # layer's `param` specs.
         self.blobs = []
+        self.blob_diffs = []
+        # Set when forward is carried out by the layer producing the bottom,
+        # see Net.fuse_layers.  Backward still runs.
+        self.fused = False
         # TODO:  Initialize with proto blob
 
     def setup(self, bottom, top):
@@ -12,5 +18,34 @@ class BaseLayer(object):
     def forward(self, bottom, top):
         raise NotImplementedError()
 
-    def backward(self, bottom, propagate_down, top):
+    def kernels(self, bottom, top):
+        """
+        The kernels forward (and backward, if self.propagate_down) will
+        call for these blobs, as (specializer, args) jobs for
+        sejits_caffe.util.precompile.
+        """
+        return []
+
+    def allow_force_backward(self, bottom_index):
+        """
+        Whether force_backward may ask for the gradient of this bottom.
+        """
+        return True
+
+    def cost(self, *blobs):
+        """
+        Analytic (flops, bytes) of one forward pass over these blobs, see
+        sejits_caffe.util.roofline.  By default no arithmetic and every
+        blob read or written once.
+        """
+        return 0, sum(int(blob.nbytes) for blob in blobs)
+
+    def backward(self, bottom, bottom_diff, top, top_diff):
+        """
+        Layers with several bottoms or tops receive all bottoms, then their
+        diffs, then all tops, then their diffs.  The diff of a blob that
+        does not need a gradient is None.  `self.propagate_down` tells
+        whether bottom_diff has to be computed at all; parameter gradients
+        are always computed.
+        """
         raise NotImplementedError()
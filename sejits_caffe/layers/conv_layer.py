@@ -4,7 +4,12 @@ import logging
 # from sejits_caffe.util.im2col import cpu_im2col, gpu_im2col
 # from sejits_caffe.operations import convolve, meta
 from cstructures.array import Array  # , specialize
-from sejits_caffe.util.im2col import Im2Col
+from sejits_caffe.util.im2col import ParallelIm2Col
+from sejits_caffe.util.col2im import ParallelCol2Im
+from sejits_caffe.util.workspace import Workspace
+from sejits_caffe.util.epilogue import Epilogue
+from sejits_caffe.util.precompile import kernel
+from sejits_caffe.util.profiler import profiler
 
 # from hindemith.operations.gemm import gemm
 # import ctypes
@@ -72,7 +77,7 @@ def gpu_gemm(A, A_offset, B, B_offset, C, C_offset, m, n, k):
 
 
 class ConvLayer(BaseLayer):
-    def __init__(self, param):
+    def __init__(self, param, batched=False, num_threads=0):
         super(ConvLayer, self).__init__(param)
 
         conv_param = param.convolution_param
@@ -97,7 +102,59 @@ class ConvLayer(BaseLayer):
         self.bias_term = None
         self.bias = None
         self.kernel_size = self.kernel_h, self.kernel_w
-        self.im2col = Im2Col(self.kernel_size, self.stride, self.padding)
+        # num_threads == 0 lets OpenMP pick the thread count.
+        self.num_threads = num_threads
+        self.im2col = ParallelIm2Col(self.kernel_size, self.stride,
+                                     self.padding, num_threads)
+        # When batched, the whole minibatch is lowered into one column
+        # buffer and each group is computed with a single GEMM.  This trades
+        # a column buffer num times larger for far fewer, larger GEMMs.
+        self.batched = batched
+        # Scratch space for the column buffer, shared with the other conv
+        # layers when the layer is owned by a Net.
+        self.workspace = None
+        self.col_shape = None
+        # The columns of every chunk of the batch, kept from forward for
+        # backward, see keep_columns.  Only the first `kept_chunks` hold
+        # the columns of the last forward.
+        self.columns = None
+        self.kept_chunks = 0
+        # The column buffer and col2im are sized for the bottom of setup
+        self.bottom_shape = None
+        # Adds the bias and applies a fused ReLU to each chunk of top while
+        # it is still in cache, see fuse_relu.
+        self.epilogue = None
+
+    def fuse_relu(self, negative_slope):
+        """
+        Apply the ReLU of an in-place ReluLayer on top together with the
+        bias, see Net.fuse_layers.
+        """
+        self.epilogue = Epilogue(negative_slope)
+
+    def epilogue_args(self, top):
+        return (top, self.bias) if self.bias_term else (top, )
+
+    def keep_columns(self):
+        """
+        Lower the bottom of forward into a column buffer of this layer's
+        own instead of the shared workspace, with room for every chunk of
+        the batch of setup, so that backward reads the columns back instead
+        of running im2col again.  This takes num * prod(col_shape) / chunk
+        floats, the size of the batched column buffer.
+        """
+        chunks = 1 if self.batched else self.bottom_shape[0]
+        self.columns = Array.zeros((chunks, ) + tuple(self.col_shape),
+                                   np.float32)
+        if profiler.enabled:
+            profiler.allocated(self.layer_param.name + "_columns",
+                               self.columns.nbytes)
+
+    def col_buffer(self, index):
+        # The column buffer of chunk `index`
+        if self.columns is not None and index < len(self.columns):
+            return self.columns[index]
+        return self.workspace.view(self.col_shape)
 
     def get_top_shape(self, bottom):
         conv_param = self.layer_param.convolution_param
@@ -112,6 +169,13 @@ class ConvLayer(BaseLayer):
 
         channels, height, width = bottom[0].shape
         num_output = conv_param.num_output
+        chunk = bottom.shape[0] if self.batched else 1
+        self.bottom_shape = bottom.shape
+        self.col_shape = self.im2col.col_shape((chunk, ) + bottom.shape[1:])
+        self.col2im = ParallelCol2Im(self.kernel_size, self.stride,
+                                     self.padding,
+                                     (chunk, ) + bottom.shape[1:],
+                                     self.num_threads)
         assert channels % self.group == 0, \
             "Number of channels should be a multiple of group."
         assert num_output % self.group == 0, \
@@ -141,26 +205,85 @@ class ConvLayer(BaseLayer):
                 else:
                     raise Exception("Filler not implemented for bias filler \
                         type {}".format(filler.type))
+        self.blobs = [self.weights]
+        self.blob_diffs = [self.weight_diff]
+        if self.bias_term:
+            self.blobs.append(self.bias)
+            self.blob_diffs.append(self.bias_diff)
+
+    def kernels(self, bottom, top):
+        if self.workspace is None:
+            self.workspace = Workspace(np.prod(self.col_shape))
+        chunk = bottom.shape[0] if self.batched else 1
+        col_data = self.col_buffer(0)
+        jobs = [kernel(self.im2col, bottom[:chunk], col_data)]
+        if self.epilogue is not None:
+            jobs.append(kernel(self.epilogue,
+                               *self.epilogue_args(top[:chunk])))
+        if self.propagate_down:
+            jobs.append(kernel(self.col2im, col_data, bottom[:chunk]))
+        return jobs
+
+    def cost(self, bottom, top):
+        """
+        A multiply-add per weight of a group for every output, plus the
+        bias.  Besides the blobs and parameters, im2col writes the columns
+        of every image and the GEMMs read them back.
+        """
+        num, channels = bottom.shape[:2]
+        outputs = top.shape[2] * top.shape[3]
+        kernel_size = self.kernel_h * self.kernel_w
+        flops = 2 * int(top.size) * (channels // self.group) * kernel_size
+        columns = num * channels * kernel_size * outputs
+        elements = int(bottom.size) + int(top.size) + \
+            int(self.weights.size) + 2 * columns
+        if self.bias_term:
+            flops += int(top.size)
+            elements += int(self.bias.size)
+        if self.epilogue is not None:
+            # The fused ReLU, which ReluLayer.cost then leaves out
+            flops += int(top.size) * (2 if self.epilogue.negative_slope
+                                      else 1)
+        return flops, elements * bottom.itemsize
+
+    def check_shape(self, bottom):
+        # Per image buffers fit any batch size, batched ones only that of
+        # setup (e.g. not a final partial batch)
+        first = 0 if self.batched else 1
+        assert bottom.shape[first:] == self.bottom_shape[first:], \
+            "Bottom shape {} does not fit the buffers sized in setup for " \
+            "{}".format(bottom.shape, self.bottom_shape)
 
     # @meta
     def forward(self, bottom, top):
+        self.check_shape(bottom)
         weights = self.weights.reshape(self.weights.shape[0],
                                        np.prod(self.weights.shape[1:]))
-        for bottom_data, top_data in zip(bottom, top):
-            self.col_data = self.im2col(
-                bottom_data, self.kernel_size, self.padding, self.stride)
-            col_offset = self.col_data.shape[0] // self.group
-            weight_offset = top_data.shape[0] // self.group
-            top_offset = top_data.shape[0] // self.group
+        if self.workspace is None:
+            self.workspace = Workspace(np.prod(self.col_shape))
+        chunk = bottom.shape[0] if self.batched else 1
+        weight_offset = top.shape[1] // self.group
+        self.kept_chunks = 0
+        for index, start in enumerate(range(0, bottom.shape[0], chunk)):
+            stop = start + chunk
+            col_data = self.im2col(bottom[start:stop], self.col_buffer(index))
+            if self.columns is not None and index < len(self.columns):
+                self.kept_chunks = index + 1
+            col_offset = col_data.shape[0] // self.group
             for g in range(self.group):
-                top_data[g * top_offset:(g + 1) * top_offset] = (
-                    weights[g * weight_offset:(g + 1) * weight_offset].dot(
-                        self.col_data[g * col_offset:(g + 1) * col_offset])
-                ).reshape(top_data[g * top_offset:(g + 1) * top_offset].shape)
+                # (out / group, stop - start, height_out * width_out)
+                output = weights[
+                    g * weight_offset:(g + 1) * weight_offset].dot(
+                        col_data[g * col_offset:(g + 1) * col_offset])
+                top[start:stop, g * weight_offset:(g + 1) * weight_offset] = \
+                    output.reshape(
+                        (weight_offset, stop - start) + top.shape[2:]
+                    ).transpose(1, 0, 2, 3)
+            if self.epilogue is not None:
+                self.epilogue(*self.epilogue_args(top[start:stop]))
 
-            if self.bias_term:
-                for output_data, bias in zip(top_data, self.bias):
-                    output_data += bias
+        if self.bias_term and self.epilogue is None:
+            top += self.bias.reshape(1, top.shape[1], 1, 1)
         # out_groups = top.shape[1] // self.group
         # in_groups = bottom.shape[1] // self.group
         # for i in range(len(top)):
@@ -179,39 +302,47 @@ class ConvLayer(BaseLayer):
         #             # top[i, j] += self.bias[j]
         #             top[i, j] += self.bias[j]
 
-    def backward(self, top_data, top_diff, bottom_data, bottom_diff):
-        if self.propagate_down:
-            self.weight_diff.fill(0)
-            if self.bias is not None:
-                self.bias_diff.fill(0)
-
-        for i in range(top_data.shape[0]):
-            if self.bias is not None and self.propagate_down:
-                curr_bias_diff = self.bias_diff[i]
-                for n in range(top_data.shape[1]):
-                    for data, bias_diff in zip(top_data[i, n], curr_bias_diff):
-                        top_data += bias_diff
+    def backward(self, bottom, bottom_diff, top, top_diff):
+        self.check_shape(bottom)
+        weights = self.weights.reshape(self.weights.shape[0],
+                                       np.prod(self.weights.shape[1:]))
+        weight_diff = self.weight_diff.reshape(weights.shape)
+        if self.bias_term:
+            self.bias_diff[:] = top_diff.reshape(
+                top_diff.shape[0], top_diff.shape[1], -1).sum(axis=(0, 2))
+
+        chunk = bottom.shape[0] if self.batched else 1
+        weight_offset = top_diff.shape[1] // self.group
+        for index, start in enumerate(range(0, bottom.shape[0], chunk)):
+            stop = start + chunk
+            if index < self.kept_chunks:
+                # Still holds the columns of forward, see keep_columns
+                col_data = self.columns[index]
+            else:
+                col_data = self.im2col(bottom[start:stop],
+                                       self.col_buffer(index))
+            col_offset = col_data.shape[0] // self.group
+            for g in range(self.group):
+                # (out / group, (stop - start) * height_out * width_out)
+                group_diff = top_diff[
+                    start:stop, g * weight_offset:(g + 1) * weight_offset]
+                group_diff = group_diff.transpose(1, 0, 2, 3).reshape(
+                    weight_offset, -1)
+                group_cols = col_data[g * col_offset:(g + 1) * col_offset]
+                group_weight_diff = weight_diff[
+                    g * weight_offset:(g + 1) * weight_offset]
+                if start == 0:
+                    np.dot(group_diff, group_cols.T, out=group_weight_diff)
+                else:
+                    group_weight_diff += group_diff.dot(group_cols.T)
+                if self.propagate_down:
+                    # The columns of this group are no longer needed, so the
+                    # column gradient overwrites them in place.
+                    np.dot(weights[
+                        g * weight_offset:(g + 1) * weight_offset].T,
+                        group_diff, out=group_cols)
             if self.propagate_down:
-                for n in range(top_data.shape[1]):
-                    self.col_data = self.im2col(bottom_data, self.kernel_size,
-                                                self.padding, self.stride)
-                    col_offset = self.col_data.shape[0] // self.group
-                    weight_offset = top_data.shape[0] // self.group
-                    top_offset = top_data.shape[0] // self.group
-                    # TODO: Clean this up with helper functions
-                    for g in range(self.group):
-                        self.weight_diff[i, g * weight_offset:(g + 1) * weight_offset] += \
-                            top_diff[i, g * top_offset:
-                                     (g + 1) * top_offset].dot(
-                                self.col_data[
-                                    i, g * col_offset:(g + 1) * col_offset])
-
-                    for g in range(self.group):
-                        self.col_data[g * col_offset:(g + 1) * col_offset] = \
-                            self.weights[
-                                g * weight_offset:(g + 1) * weight_offset].dot(
-                                    self.top_diff[n, g * top_offset:
-                                                  (g + 1) * top_offset])
-                    bottom_diff[i] = self.col2im(self.col_data,
-                                                 self.kernel_size,
-                                                 self.padding, self.stride)
+                self.col2im(col_data, bottom_diff[start:stop])
+        if self.propagate_down:
+            # The column gradients have overwritten the kept columns
+            self.kept_chunks = 0
@@ -1,4 +1,6 @@
 from sejits_caffe.layers.base_layer import BaseLayer
+from sejits_caffe.util.data_transform import BatchTransform
+from sejits_caffe.util.precompile import kernel
 from cstructures import Array
 import numpy as np
 
@@ -7,7 +9,21 @@ import numpy as np
 
 import lmdb
 import sejits_caffe.caffe_pb2 as caffe_pb2
-import random
+import multiprocessing
+import os
+import threading
+import traceback
+try:
+    from queue import Queue, Empty
+except ImportError:  # pragma: no cover
+    from Queue import Queue, Empty
+
+try:
+    # Workers run OpenMP kernels, which do not survive a fork from a
+    # process that already used them.
+    mp = multiprocessing.get_context("spawn")
+except AttributeError:  # pragma: no cover
+    mp = multiprocessing
 
 
 class DataTransformer(object):
@@ -15,95 +31,368 @@ class DataTransformer(object):
         self.param = param
         self.phase = phase
         if param.HasField("mean_file"):
+            if len(param.mean_value) > 0:
+                raise ValueError(
+                    "Cannot specify mean_file and mean_value at the same time")
             blob_proto = caffe_pb2.BlobProto()
             with open(param.mean_file, "rb") as f:
                 blob_proto.ParseFromString(f.read())
-                # FIXME: Assuming float32
-                self.mean = Array.array(
-                    blob_proto.data._values).astype(np.float32)
+            self.mean = Array.array(blob_proto.data).astype(np.float32)
+            mean_mode = "file"
+        elif len(param.mean_value) > 0:
+            self.mean = Array.array(param.mean_value).astype(np.float32)
+            mean_mode = "value"
         else:
-            raise NotImplementedError()
+            self.mean = Array.zeros((1, ), np.float32)
+            mean_mode = "none"
+        self.mean_mode = mean_mode
+        self.batch_transform = BatchTransform(param.scale, mean_mode)
+
+    def get_offsets(self, num, datum_height, datum_width):
+        """
+        Pick the crop offsets and mirror flags of `num` samples: random
+        crops while training, centered ones otherwise, and a coin flip per
+        sample for mirroring like Caffe.
+        """
+        crop_size = self.param.crop_size
+        h_offsets = Array.zeros((num, ), np.int32)
+        w_offsets = Array.zeros((num, ), np.int32)
+        if crop_size:
+            if self.phase == "train":
+                h_offsets[:] = np.random.randint(
+                    datum_height - crop_size + 1, size=num)
+                w_offsets[:] = np.random.randint(
+                    datum_width - crop_size + 1, size=num)
+            else:
+                h_offsets.fill((datum_height - crop_size) // 2)
+                w_offsets.fill((datum_width - crop_size) // 2)
+        mirror = Array.zeros((num, ), np.int32)
+        if self.param.mirror:
+            mirror[:] = np.random.randint(2, size=num)
+        return h_offsets, w_offsets, mirror
+
+    def batch_args(self, data, output):
+        """
+        The arguments of batch_transform for `data`, with fresh offsets.
+        """
+        num, channels, datum_height, datum_width = data.shape
+        if self.mean_mode == "value" and len(self.mean) != channels:
+            if len(self.mean) != 1:
+                raise ValueError(
+                    "Specify either 1 mean_value or as many as channels")
+            self.mean = Array.array(
+                np.repeat(self.mean, channels)).astype(np.float32)
+        h_offsets, w_offsets, mirror = self.get_offsets(
+            num, datum_height, datum_width)
+        return data, self.mean, h_offsets, w_offsets, mirror, output
+
+    def transform_batch(self, data, output):
+        """
+        Transform a stacked uint8 (num, channels, datum_height, datum_width)
+        batch into `output` with a single compiled pass.
+        """
+        return self.batch_transform(*self.batch_args(data, output))
 
     def transform(self, datum):
         channels, datum_height, datum_width = datum.channels, datum.height, \
             datum.width
+        height = self.param.crop_size or datum_height
+        width = self.param.crop_size or datum_width
+        data = np.frombuffer(datum.data, dtype=np.uint8).reshape(
+            1, channels, datum_height, datum_width)
+        transformed_data = Array.empty((1, channels, height, width),
+                                       np.float32)
+        return self.transform_batch(data, transformed_data)[0]
 
-        crop_size = self.param.crop_size
-        do_mirror = self.param.mirror
-        # scale = self.param.scale
-        height = datum_height
-        width = datum_width
 
-        if crop_size:
-            height = crop_size
-            width = crop_size
-            if self.phase == "train":
-                h_off = random.randrange(datum_height - crop_size + 1)
-                w_off = random.randrange(datum_width - crop_size + 1)
-            else:
-                h_off = (datum_height - crop_size) / 2
-                w_off = (datum_width - crop_size) / 2
-
-        transformed_data = Array.zeros(
-            np.prod((channels, height, width)), np.float32)
-
-        data = Array.fromstring(
-            datum.data, dtype=np.uint8).astype(
-                np.float32).reshape(channels, datum_height, datum_width)
-        transformed_data = data[..., h_off:h_off + height, w_off:w_off + width]
-        if do_mirror:
-            for c in range(channels):
-                transformed_data[c] = np.fliplr(transformed_data[c])
-
-        return transformed_data
-        # for c in range(channels):
-        #     for h in range(height):
-        #         for w in range(width):
-        #             data_index = (c * datum_height + h_off + h) *
-        #                 datum_width + w_off + w
-        #             if do_mirror:
-        #                 top_index = (c * height + h) * width + \
-        #                       (width - 1 - w)
-        #             else:
-        #                 top_index = (c * height + h) * width + w
-
-        #             datum_element = data[data_index]
-
-        #             if self.param.HasField("mean_file"):
-        #                 transformed_data[top_index] = \
-        #                     (datum_element - self.mean[data_index]) * scale
-        #             else:
-        #                 raise NotImplementedError()
-        # return transformed_data.reshape((channels, height, width))
+def shard_records(db, worker_id, num_workers, batch_size):
+    """
+    Yield the raw records of every `num_workers`-th batch of `db`, starting
+    with batch `worker_id`.  Records are numbered as if the database were
+    read over and over, so interleaving the batches of all workers gives
+    the same stream as a single reader.
+    """
+    with db.begin() as txn:
+        cursor = txn.cursor()
+        if not cursor.first():
+            raise ValueError("Database is empty")
+        index = 0
+        while True:
+            if (index // batch_size) % num_workers == worker_id:
+                yield cursor.value()
+            index += 1
+            if not cursor.next():
+                cursor.first()
+
+
+def read_batches(worker_id, num_workers, source, transform_param, phase,
+                 top_shape, datum_shape, data, labels, free_slots,
+                 full_slots, seed):
+    """
+    Worker process body of DataReaderPool: fill the free batch slots handed
+    over in `free_slots` with transformed records of this worker's shard
+    and report them in `full_slots`.
+    """
+    # The pool already runs one process per core
+    os.environ["OMP_NUM_THREADS"] = "1"
+    np.random.seed(seed)
+    try:
+        db = lmdb.open(source, readonly=True, lock=False)
+        records = shard_records(db, worker_id, num_workers, top_shape[0])
+        param = caffe_pb2.TransformationParameter()
+        param.ParseFromString(transform_param)
+        transformer = DataTransformer(param, phase)
+        batch_size = top_shape[0]
+        data = np.frombuffer(data, np.float32).reshape((-1, ) + top_shape)
+        labels = np.frombuffer(labels, np.float32).reshape(-1, batch_size)
+        raw = np.empty((batch_size, ) + datum_shape, np.uint8)
+        datum = caffe_pb2.Datum()
+        while True:
+            slot = free_slots.get()
+            if slot is None:
+                return
+            for i in range(batch_size):
+                datum.ParseFromString(next(records))
+                raw[i] = np.frombuffer(
+                    datum.data, dtype=np.uint8).reshape(datum_shape)
+                labels[slot, i] = datum.label
+            transformer.transform_batch(raw, data[slot])
+            full_slots.put(slot)
+    except Exception:
+        # Surface the error in the main process instead of hanging it
+        full_slots.put(traceback.format_exc())
+
+
+class DataReaderPool(object):
+    """
+    Decode and transform batches in `num_workers` processes.  Batches are
+    dealt round robin to the workers, each of which owns `slots_per_worker`
+    batch slots in shared memory, and are handed out in the same order, so
+    the stream of records is the same as with a single reader.
+    """
+    def __init__(self, source, transform_param, phase, top_shape,
+                 datum_shape, num_workers, slots_per_worker=2):
+        self.top_shape = tuple(top_shape)
+        self.slots_per_worker = slots_per_worker
+        num_slots = num_workers * slots_per_worker
+        batch_size = self.top_shape[0]
+        self.shared_data = mp.RawArray(
+            'f', num_slots * int(np.prod(self.top_shape)))
+        self.shared_labels = mp.RawArray('f', num_slots * batch_size)
+        self.data = np.frombuffer(self.shared_data, np.float32).reshape(
+            (num_slots, ) + self.top_shape).view(Array)
+        self.labels = np.frombuffer(self.shared_labels, np.float32).reshape(
+            num_slots, batch_size).view(Array)
+        self.free_slots = []
+        self.full_slots = []
+        self.workers = []
+        for worker_id in range(num_workers):
+            free_slots, full_slots = mp.Queue(), mp.Queue()
+            for j in range(slots_per_worker):
+                free_slots.put(worker_id * slots_per_worker + j)
+            worker = mp.Process(
+                target=read_batches,
+                # The generated messages cannot be pickled, pass them
+                # serialized.
+                args=(worker_id, num_workers, source,
+                      transform_param.SerializeToString(), phase,
+                      self.top_shape, tuple(datum_shape), self.shared_data,
+                      self.shared_labels, free_slots, full_slots,
+                      np.random.randint(2 ** 31)))
+            worker.daemon = True
+            worker.start()
+            self.free_slots.append(free_slots)
+            self.full_slots.append(full_slots)
+            self.workers.append(worker)
+        self.next_worker = 0
+
+    def get(self):
+        """
+        Wait for the next batch and return its slot together with zero-copy
+        views of its data and labels.  The views stay valid until the slot
+        is given back with `release`.
+        """
+        worker_id = self.next_worker
+        self.next_worker = (worker_id + 1) % len(self.workers)
+        while True:
+            try:
+                slot = self.full_slots[worker_id].get(timeout=1)
+                break
+            except Empty:
+                if not self.workers[worker_id].is_alive():
+                    raise RuntimeError(
+                        "Data worker {} died".format(worker_id))
+        if not isinstance(slot, int):
+            raise RuntimeError(
+                "Data worker {} failed:\n{}".format(worker_id, slot))
+        return slot, self.data[slot], self.labels[slot]
+
+    def release(self, slot):
+        self.free_slots[slot // self.slots_per_worker].put(slot)
+
+    def close(self):
+        for free_slots in self.free_slots:
+            free_slots.put(None)
+        for worker in self.workers:
+            worker.join(1)
+            if worker.is_alive():
+                worker.terminate()
+        self.workers = []
 
 
 class DataLayer(BaseLayer):
+    def __init__(self, param, prefetch=0, num_workers=0):
+        super(DataLayer, self).__init__(param)
+        # Number of batches loaded ahead of forward on a background thread.
+        # With 0, every batch is loaded synchronously inside forward.
+        self.prefetch = prefetch
+        self.prefetch_thread = None
+        # Number of reader processes, see DataReaderPool.  Takes precedence
+        # over the prefetch thread, with `prefetch` batches per worker.
+        self.num_workers = num_workers
+        self.reader = None
+        # The reader slot whose views were handed out last, see next_views
+        self.held_slot = None
+        self.raw_batch = None
+
     def get_top_shape(self):
         backend = self.layer_param.data_param.backend
         if backend == caffe_pb2.DataParameter.LMDB:
             self.db = lmdb.open(self.layer_param.data_param.source)
             txn = self.db.begin()
-            self.cursor = txn.cursor().iternext()
             datum = caffe_pb2.Datum()
-            datum.ParseFromString(next(self.cursor)[1])
+            datum.ParseFromString(next(txn.cursor().iternext())[1])
+            # Peek at the first record only, reading starts at the beginning
+            self.cursor = txn.cursor().iternext()
+            self.datum_shape = datum.channels, datum.height, datum.width
             crop_size = self.layer_param.transform_param.crop_size
             if crop_size > 0:
                 return self.layer_param.data_param.batch_size, \
                     datum.channels, crop_size, crop_size
             else:
-                raise NotImplementedError()
+                return (self.layer_param.data_param.batch_size, ) + \
+                    self.datum_shape
         else:
             raise NotImplementedError(backend)
 
     def setup(self, top, top_label):
         self.data_transformer = \
             DataTransformer(self.layer_param.transform_param, self.phase)
+        if self.num_workers > 0:
+            # One slot more per worker for the batch handed out by
+            # next_views, which the net reads until its next forward
+            self.reader = DataReaderPool(
+                self.layer_param.data_param.source,
+                self.layer_param.transform_param, self.phase, top.shape,
+                self.datum_shape, self.num_workers,
+                max(self.prefetch, 1) + 1)
+        elif self.prefetch > 0:
+            # Batches cycle between the two queues: the thread fills free
+            # buffers, forward copies full ones into top and hands them
+            # back.
+            self.free_batches = Queue()
+            self.full_batches = Queue()
+            for _ in range(self.prefetch):
+                self.free_batches.put((Array.empty_like(top),
+                                       Array.empty_like(top_label)))
+            self.prefetch_thread = threading.Thread(
+                target=self.prefetch_batches)
+            self.prefetch_thread.daemon = True
+            self.prefetch_thread.start()
 
-    def forward(self, top, top_label):
+    def next_datum(self, datum):
+        """
+        Parse the next record into `datum`, starting over at the end of the
+        database.
+        """
+        try:
+            value = next(self.cursor)[1]
+        except StopIteration:
+            self.cursor = self.db.begin().cursor().iternext()
+            value = next(self.cursor)[1]
+        datum.ParseFromString(value)
+
+    def get_raw_batch(self, num):
+        """
+        The uint8 staging buffer of load_batch, only touched by whichever
+        thread loads batches.
+        """
+        if self.raw_batch is None:
+            self.raw_batch = Array.empty((num, ) + self.datum_shape,
+                                         np.uint8)
+        return self.raw_batch
+
+    def kernels(self, top, top_label):
+        if self.reader is not None:
+            # The reader processes compile their own
+            return []
+        transformer = self.data_transformer
+        return [kernel(transformer.batch_transform, *transformer.batch_args(
+            self.get_raw_batch(top.shape[0]), top))]
+
+    def load_batch(self, data, label):
+        # Only the raw bytes are gathered per record, the float conversion
+        # runs over the whole batch at once.
+        raw = self.get_raw_batch(data.shape[0])
         datum = caffe_pb2.Datum()
-        batch_size = self.layer_param.data_param.batch_size
-        for i in range(batch_size):
-            print("data layer batch: ", i)
-            datum.ParseFromString(next(self.cursor)[1])
-            top[i] = self.data_transformer.transform(datum)
-            top_label[i] = datum.label
+        for i in range(data.shape[0]):
+            self.next_datum(datum)
+            raw[i] = np.frombuffer(
+                datum.data, dtype=np.uint8).reshape(self.datum_shape)
+            label[i] = datum.label
+        self.data_transformer.transform_batch(raw, data)
+
+    def prefetch_batches(self):
+        while True:
+            batch = self.free_batches.get()
+            if batch is None:
+                return
+            try:
+                self.load_batch(*batch)
+            except Exception as e:
+                # Surface the error in forward instead of hanging it
+                self.full_batches.put(e)
+                return
+            self.full_batches.put(batch)
+
+    def next_views(self):
+        """
+        Zero-copy views of the data and labels of the next batch of the
+        reader processes, which Net binds as the tops.  They stay valid until
+        the next call, which gives their slot back to its worker.
+        """
+        if self.held_slot is not None:
+            self.reader.release(self.held_slot)
+            self.held_slot = None
+        self.held_slot, data, label = self.reader.get()
+        return data, label
+
+    def forward(self, top, top_label):
+        if self.reader is not None:
+            data, label = self.next_views()
+            top[:] = data
+            top_label[:] = label
+            return
+        if self.prefetch_thread is None:
+            self.load_batch(top, top_label)
+            return
+        batch = self.full_batches.get()
+        if isinstance(batch, Exception):
+            raise batch
+        data, label = batch
+        top[:] = data
+        top_label[:] = label
+        self.free_batches.put(batch)
+
+    def close(self):
+        """
+        Stop the prefetch thread or reader processes, if any.
+        """
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+            self.held_slot = None
+        if self.prefetch_thread is not None:
+            self.free_batches.put(None)
+            self.prefetch_thread.join()
+            self.prefetch_thread = None
@@ -17,11 +17,15 @@ class DropoutLayer(BaseLayer):
         return bottom.shape
 
     def forward(self, bottom, top):
-        self.mask = np.random.binomial(bottom.shape[0], 1.0 - self.threshold,
-                                       bottom.shape)
-        top[:] = bottom * self.mask * self.scale
+        if self.phase == 'train':
+            self.mask = np.random.binomial(1, 1.0 - self.threshold,
+                                           bottom.shape)
+            top[:] = bottom * self.mask * self.scale
+        elif top.ctypes.data != bottom.ctypes.data:
+            # Identity, which costs nothing when run in place
+            top[:] = bottom
 
-    def backward(self, bottom_diff, top_diff):
+    def backward(self, bottom, bottom_diff, top, top_diff):
         if self.propagate_down:
             if self.phase == 'train':
                 bottom_diff[:] = top_diff * self.mask * self.scale
@@ -1,4 +1,6 @@
 from sejits_caffe.layers.base_layer import BaseLayer
+from sejits_caffe.util.epilogue import Epilogue
+from sejits_caffe.util.precompile import kernel
 from cstructures.array import Array
 import numpy as np
 
@@ -11,16 +13,29 @@ class InnerProductLayer(BaseLayer):
         self.num_output = param.num_output
         self.bias_term = param.bias_term
         if self.bias_term:
-            self.bias = Array.zeros(self.num_output)
+            self.bias = Array.zeros(self.num_output, np.float32)
             filler = param.bias_filler
             if filler.type == 'constant':
                 self.bias.fill(filler.value)
             else:
                 raise Exception("Filler not implemented for bias filler \
                     type {}".format(filler.type))
+        # See fuse_relu
+        self.epilogue = None
+
+    def fuse_relu(self, negative_slope):
+        """
+        Apply the ReLU of an in-place ReluLayer on top together with the
+        bias, see Net.fuse_layers.
+        """
+        self.epilogue = Epilogue(negative_slope)
+
+    def epilogue_args(self, top):
+        return (top, self.bias) if self.bias_term else (top, )
 
     def setup(self, bottom, top):
-        weights_shape = (self.num_output, bottom.shape[0])
+        # Everything but the first axis is flattened into one input vector
+        weights_shape = (self.num_output, np.prod(bottom.shape[1:]))
         weight_filler = self.layer_param.inner_product_param.weight_filler
         if weight_filler.type == 'gaussian':
             self.weights = weight_filler.mean + weight_filler.std * \
@@ -29,21 +44,48 @@ class InnerProductLayer(BaseLayer):
         else:
             raise Exception("Filler not implemented for weight filler"
                             "type {}".format(weight_filler.type))
+        self.weight_diff = Array.zeros_like(self.weights)
+        self.blobs = [self.weights]
+        self.blob_diffs = [self.weight_diff]
+        if self.bias_term:
+            self.bias_diff = Array.zeros_like(self.bias)
+            self.blobs.append(self.bias)
+            self.blob_diffs.append(self.bias_diff)
 
     def get_top_shape(self, bottom):
         return bottom.shape[0], self.num_output
 
-    def forward(self, bottom, top):
-        top[:] = np.dot(bottom, self.weights.T)
+    def cost(self, bottom, top):
+        flops = 2 * int(bottom.size) * self.num_output
+        elements = int(bottom.size) + int(self.weights.size) + int(top.size)
         if self.bias_term:
+            flops += int(top.size)
+            elements += self.num_output
+        if self.epilogue is not None:
+            # The fused ReLU, which ReluLayer.cost then leaves out
+            flops += int(top.size) * (2 if self.epilogue.negative_slope
+                                      else 1)
+        return flops, elements * bottom.itemsize
+
+    def kernels(self, bottom, top):
+        if self.epilogue is None:
+            return []
+        return [kernel(self.epilogue, *self.epilogue_args(top))]
+
+    def forward(self, bottom, top):
+        np.dot(bottom.reshape(bottom.shape[0], -1), self.weights.T, out=top)
+        if self.epilogue is not None:
+            self.epilogue(*self.epilogue_args(top))
+        elif self.bias_term:
             top += self.bias
 
-    def backward(self, bottom_data, bottom_diff, top_diff):
-        if self.propagate_down:
-            bottom_diff[:] = np.dot(bottom_diff, bottom_data, self.weights)
+    def backward(self, bottom, bottom_diff, top, top_diff):
+        bottom = bottom.reshape(bottom.shape[0], -1)
+        np.dot(top_diff.T, bottom, out=self.weight_diff)
 
         if self.bias_term:
-            self.bias = np.dot(top_diff, self.bias_multiplier)
+            self.bias_diff[:] = top_diff.sum(axis=0)
 
         if self.propagate_down:
-            bottom_data[:] = np.dot(top_diff, self.weights)
+            np.dot(top_diff, self.weights,
+                   out=bottom_diff.reshape(bottom.shape))
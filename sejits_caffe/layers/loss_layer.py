@@ -5,5 +5,9 @@ class LossLayer(BaseLayer):
     """docstring for LossLayer"""
     def __init__(self, param):
         super(LossLayer, self).__init__(param)
-        # if param.loss_weight_size == 0:
-        #     self.param.loss_weight_size = 1
+        # The weight of the loss in the objective, 1 unless configured
+        self.loss_weight = param.loss_weight[0] if param.loss_weight else 1.0
+
+    def allow_force_backward(self, bottom_index):
+        # The labels never get a gradient
+        return bottom_index != 1
@@ -1,6 +1,9 @@
 from sejits_caffe.layers.base_layer import BaseLayer
+from sejits_caffe.util.lrn import LRNForward, LRNBackward, \
+    WithinChannelLRNForward, WithinChannelLRNBackward
+from sejits_caffe.util.precompile import kernel
 from cstructures.array import Array
-import numpy as np
+import sejits_caffe.caffe_pb2 as caffe_pb2
 
 
 class LRNLayer(BaseLayer):
@@ -12,67 +15,60 @@ class LRNLayer(BaseLayer):
         assert self.size % 2 == 1, \
             "LRN only supports odd values for local size"
 
-        self.pre_pad = (self.size - 1) / 2
+        self.pre_pad = (self.size - 1) // 2
         self.alpha = param.alpha
         self.beta = param.beta
         self.k = param.k
+        self.norm_region = param.norm_region
+        if self.norm_region == caffe_pb2.LRNParameter.ACROSS_CHANNELS:
+            forward, backward = LRNForward, LRNBackward
+        elif self.norm_region == caffe_pb2.LRNParameter.WITHIN_CHANNEL:
+            forward, backward = WithinChannelLRNForward, \
+                WithinChannelLRNBackward
+        else:
+            raise Exception("Unknown normalization region.")
+        self.lrn_forward = forward(self.size, self.alpha, self.beta, self.k)
+        self.lrn_backward = backward(self.size, self.alpha, self.beta,
+                                     self.k)
 
     def setup(self, bottom, top):
-        self.scale = Array.zeros_like(bottom)
+        # Only backward needs the scale, forward computes it on the fly
+        if self.phase == 'train':
+            self.scale = Array.zeros_like(bottom)
+        else:
+            self.scale = None
+
+    def kernels(self, bottom, top):
+        if self.scale is None:
+            return [kernel(self.lrn_forward, bottom, top)]
+        jobs = [kernel(self.lrn_forward, bottom, top, self.scale)]
+        if self.propagate_down:
+            jobs.append(kernel(self.lrn_backward, bottom, top, self.scale,
+                               top, bottom))
+        return jobs
 
     def get_top_shape(self, bottom):
         return bottom.shape
 
-    def forward(self, bottom, top):
-        # initialize scale to constant value
-        self.scale.fill(self.k)
-
-        padded_square = Array.zeros((bottom.shape[1] + self.size - 1,
-                                     bottom.shape[2], bottom.shape[3]),
-                                    bottom.dtype)
-
-        alpha_over_size = self.alpha / self.size
-
-        for n in range(bottom.shape[0]):
-            padded_square[self.pre_pad:bottom.shape[1] + self.pre_pad] = \
-                np.square(bottom[n])
+    def cost(self, bottom, top):
+        """
+        Per element, whatever the size of the window: the squares entering
+        and leaving the running sums and their additions and subtractions,
+        the multiply-add of the scale, the power (counted as two) and the
+        product with the input.  The scale is only written when training.
+        """
+        flops = int(bottom.size) * 9
+        nbytes = int(bottom.nbytes) + int(top.nbytes)
+        if self.phase == 'train':
+            nbytes += int(self.scale.nbytes)
+        return flops, nbytes
 
-            for c in range(self.size):
-                self.scale[n] += alpha_over_size * padded_square[c]
-
-            # for c in range(1, bottom.shape[1]):
-            #     self.scale[n, c] = self.scale[n, c - 1] + \
-            #         alpha_over_size * padded_square[c + self.size - 1] - \
-            #         alpha_over_size * padded_square[c - 1]
-            print('asdfasdf', c)
-            self.scale[n, 1:] = self.scale[n, :-1] + \
-                alpha_over_size * padded_square[self.size:self.size + bottom.shape[1] - 1] - \
-                alpha_over_size * padded_square[:bottom.shape[1] - 1]
-
-        top[:] = np.power(self.scale, -self.beta) * bottom
-
-    def backward(self, bottom_data, bottom_diff, top_data, top_diff):
-        padded_ratio = Array.zeros(1, bottom_data.shape[1] + self.size - 1,
-                                   bottom_data.shape[2], bottom_data.shape[3])
-        accum_ratio = Array.zeros(1, 1, bottom_data.shape[2],
-                                  bottom_data.shape[3])
-        accum_ratio_times_bottom = Array.zeros(1, 1, bottom_data.shape[2],
-                                               bottom_data.shape[3])
-        cache_ratio_value = 2.0 * self.apha * self.beta / self.size
-        bottom_diff = np.pow(self.scale, -self.beta)
-        bottom_diff *= top_diff
-
-        inverse_pre_pad = self.size - (self.size + 1) / 2
-        for n in range(bottom_data.shape[0]):
-            padded_ratio[0, inverse_pre_pad] = top_diff[n] * top_data[n]
-            padded_ratio[0, inverse_pre_pad] /= self.scale[n]
-            accum_ratio.fill(0)
-            for c in range(self.size - 1):
-                accum_ratio += padded_ratio[0, c]
+    def forward(self, bottom, top):
+        if self.scale is None:
+            self.lrn_forward(bottom, top)
+        else:
+            self.lrn_forward(bottom, top, self.scale)
 
-            for c in range(bottom_data.shape[1]):
-                accum_ratio += padded_ratio[0, c + self.size - 1]
-                accum_ratio_times_bottom += bottom_data[n, c] * accum_ratio
-                bottom_data[n, c] += -cache_ratio_value * \
-                    accum_ratio_times_bottom
-                accum_ratio += -1 * padded_ratio[0, c]
+    def backward(self, bottom, bottom_diff, top, top_diff):
+        if self.propagate_down:
+            self.lrn_backward(bottom, top, self.scale, top_diff, bottom_diff)
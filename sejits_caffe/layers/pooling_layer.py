@@ -1,14 +1,12 @@
 from cstructures import Array
-from sejits_caffe.operations import max_pool  # , meta
 from sejits_caffe.layers.base_layer import BaseLayer
-from cstructures.array import specialize
+from sejits_caffe.util.pooling import MaxPool, MaxPoolBackward, AvePool, \
+    AvePoolBackward, GlobalAvePool, GlobalAvePoolBackward, StochasticPool
+from sejits_caffe.util.precompile import kernel
+import sejits_caffe.caffe_pb2 as caffe_pb2
+import numpy as np
 
-
-@specialize
-def max_pool_backward(top_diff, bottom_diff, mask):  # pragma: no cover
-    for y, x in top_diff.indices():
-        index = mask[y, x]
-        bottom_diff[index] += top_diff[y, x]
+PoolMethod = caffe_pb2.PoolingParameter
 
 
 class PoolingLayer(BaseLayer):
@@ -16,65 +14,133 @@ class PoolingLayer(BaseLayer):
     def __init__(self, param):
         super(PoolingLayer, self).__init__(param)
         pool_param = param.pooling_param
-        if pool_param.kernel_size is not None:
+        self.pool = pool_param.pool
+        self.global_pooling = pool_param.global_pooling
+        if self.global_pooling:
+            if pool_param.HasField("kernel_size") or \
+                    pool_param.HasField("kernel_h") or \
+                    pool_param.HasField("kernel_w"):
+                raise Exception("With global_pooling: true filter size "
+                                "cannot be specified")
+            # The kernel covers the whole bottom, see setup
+            self.kernel_h = self.kernel_w = None
+        elif pool_param.HasField("kernel_size"):
             self.kernel_h = self.kernel_w = pool_param.kernel_size
-        elif pool_param.kernel_h is not None and \
-                pool_param.kernel_w is not None:
+        elif pool_param.HasField("kernel_h") and \
+                pool_param.HasField("kernel_w"):
             self.kernel_h = pool_param.kernel_h
             self.kernel_w = pool_param.kernel_w
         else:
             raise Exception("Pooling Layer must specify kernel size or"
                             "kernel_h and kernel_w")
 
-        assert self.kernel_h > 0 and self.kernel_w > 0, \
-            'Filter dimensions must be >= 0'
-
-        if pool_param.stride is not None:
-            self.stride_h = self.stride_w = pool_param.stride
-        elif pool_param.stride_h is not None and \
-                pool_param.stride_w is not None:
+        if pool_param.HasField("stride_h") and \
+                pool_param.HasField("stride_w"):
             self.stride_h = pool_param.stride_h
             self.stride_w = pool_param.stride_w
         else:
-            raise Exception("Pooling Layer stride OR stride_h and stride_w"
-                            "required.")
+            self.stride_h = self.stride_w = pool_param.stride
 
-        if pool_param.pad is not None:
-            self.pad_h = self.pad_w = pool_param.pad
-        elif pool_param.pad_h is not None and \
-                pool_param.pad_w is not None:
+        if pool_param.HasField("pad_h") and pool_param.HasField("pad_w"):
             self.pad_h = pool_param.pad_h
             self.pad_w = pool_param.pad_w
         else:
-            raise Exception("Pooling Layer pad OR pad_h and pad_w"
-                            "required.")
+            self.pad_h = self.pad_w = pool_param.pad
 
+        if self.global_pooling:
+            assert self.pad_h == 0 and self.pad_w == 0 and \
+                self.stride_h == 1 and self.stride_w == 1, \
+                "With global_pooling: true only pad = 0 and stride = 1"
+            return
+
+        assert self.kernel_h > 0 and self.kernel_w > 0, \
+            'Filter dimensions must be >= 0'
         assert self.pad_h < self.kernel_h and self.pad_w < self.kernel_w, \
             "Padding dimensions should be smaller than kernel dimensions"
+        self.build_kernels()
+
+    def build_kernels(self):
+        # Each pools all num * channels planes in one parallel call
+        geometry = ((self.kernel_h, self.kernel_w), (self.pad_h, self.pad_w),
+                    (self.stride_h, self.stride_w))
+        if self.pool == PoolMethod.MAX:
+            self.pool_forward = MaxPool(*geometry)
+            self.pool_backward = MaxPoolBackward(*geometry)
+        elif self.pool == PoolMethod.AVE and self.global_pooling:
+            self.pool_forward = GlobalAvePool(*geometry)
+            self.pool_backward = GlobalAvePoolBackward(*geometry)
+        elif self.pool == PoolMethod.AVE:
+            self.pool_forward = AvePool(*geometry)
+            self.pool_backward = AvePoolBackward(*geometry)
+        elif self.pool == PoolMethod.STOCHASTIC:
+            self.pool_forward = StochasticPool(*geometry)
+            # The sampled offsets are kept in the mask like an argmax
+            self.pool_backward = MaxPoolBackward(*geometry)
+        else:
+            raise Exception("Unknown pooling method.")
 
     def get_top_shape(self, bottom):
+        if self.global_pooling:
+            return bottom.shape[:2] + (1, 1)
         channels, height, width = bottom[0].shape
         pooled_height = (height + 2 * self.pad_h - self.kernel_h) \
-            / self.stride_h + 1
+            // self.stride_h + 1
         pooled_width = (width + 2 * self.pad_w - self.kernel_w) \
-            / self.stride_w + 1
+            // self.stride_w + 1
         return bottom.shape[:2] + (pooled_height, pooled_width)
 
     def setup(self, bottom, top):
-        self.mask = Array.zeros_like(top)
+        if self.global_pooling:
+            self.kernel_h, self.kernel_w = bottom.shape[2:]
+            self.build_kernels()
+        # The argmax (or the sample), as an offset into its bottom plane,
+        # is only needed by backward
+        if self.phase == 'train' and self.pool != PoolMethod.AVE:
+            self.mask = Array.zeros(top.shape, np.int32)
+        else:
+            self.mask = None
+        if self.mask is not None and self.pool == PoolMethod.STOCHASTIC:
+            self.rand = Array.zeros(top.shape, np.float32)
+        else:
+            self.rand = None
+
+    def forward_args(self, bottom, top):
+        if self.mask is None:
+            return bottom, top
+        if self.rand is None:
+            return bottom, top, self.mask
+        return bottom, top, self.mask, self.rand
+
+    def backward_args(self, bottom_diff, top_diff):
+        if self.pool == PoolMethod.AVE:
+            return top_diff, bottom_diff
+        return top_diff, self.mask, bottom_diff
+
+    def kernels(self, bottom, top):
+        jobs = [kernel(self.pool_forward, *self.forward_args(bottom, top))]
+        if self.propagate_down and (self.mask is not None or
+                                    self.pool == PoolMethod.AVE):
+            jobs.append(kernel(self.pool_backward,
+                               *self.backward_args(bottom, top)))
+        return jobs
+
+    def cost(self, bottom, top):
+        """
+        One comparison (or addition) per window element of every output.
+        """
+        flops = int(top.size) * self.kernel_h * self.kernel_w
+        nbytes = int(bottom.nbytes) + int(top.nbytes)
+        if self.mask is not None:
+            nbytes += int(self.mask.nbytes)
+        if self.rand is not None:
+            nbytes += int(self.rand.nbytes)
+        return flops, nbytes
 
-    # @meta
     def forward(self, bottom, top):
-        for n in range(bottom.shape[0]):
-            for channel in range(bottom.shape[1]):
-                max_pool(bottom[n, channel], top[n, channel],
-                         self.mask[n, channel],
-                         (self.kernel_h, self.kernel_w),
-                         (self.pad_h, self.pad_w), (self.stride_h,
-                         self.stride_w))
-
-    def backward(self, bottom_diff, top_diff):
-        for n in range(top_diff.shape[0]):
-            for c in range(top_diff.shape[1]):
-                max_pool_backward(top_diff[n, c], bottom_diff[n, c],
-                                  self.mask[n, c])
+        if self.rand is not None:
+            self.rand[:] = np.random.random_sample(self.rand.shape)
+        self.pool_forward(*self.forward_args(bottom, top))
+
+    def backward(self, bottom, bottom_diff, top, top_diff):
+        if self.propagate_down:
+            self.pool_backward(*self.backward_args(bottom_diff, top_diff))
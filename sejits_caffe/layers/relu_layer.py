@@ -1,6 +1,6 @@
 from sejits_caffe.layers.base_layer import BaseLayer
-from sejits_caffe.operations.relu import relu
-from sejits_caffe.operations import meta
+from sejits_caffe.util.relu import ReluForward, ReluBackward
+from sejits_caffe.util.precompile import kernel
 
 
 class ReluLayer(BaseLayer):
@@ -8,21 +8,31 @@ class ReluLayer(BaseLayer):
     def __init__(self, param):
         super(ReluLayer, self).__init__(param)
         self.negative_slope = param.relu_param.negative_slope
+        # Each runs over the whole blob at once, in place when the
+        # prototxt names the same blob as bottom and top.
+        self.relu_forward = ReluForward(self.negative_slope)
+        self.relu_backward = ReluBackward(self.negative_slope)
 
     def get_top_shape(self, bottom):
         return bottom.shape
 
-    @meta
+    def kernels(self, bottom, top):
+        jobs = [] if self.fused else [kernel(self.relu_forward, bottom, top)]
+        if self.propagate_down:
+            jobs.append(kernel(self.relu_backward, top, bottom, bottom))
+        return jobs
+
+    def cost(self, bottom, top):
+        if self.fused:
+            # Counted by the layer it is fused into
+            return 0, 0
+        # The comparison, and the product with a nonzero negative slope
+        flops = int(bottom.size) * (2 if self.negative_slope else 1)
+        return flops, int(bottom.nbytes) + int(top.nbytes)
+
     def forward(self, bottom, top):
-        for n in range(bottom.shape[0]):
-            for c in range(bottom.shape[1]):
-                relu(bottom[n, c], bottom[n, c], top[n, c],
-                     self.negative_slope)
+        self.relu_forward(bottom, top)
 
-    def backward(self, bottom, bottom_diff, top, top_diff,
-                 propagate_down=True):
-        if propagate_down:
-            for n in range(bottom_diff.shape[0]):
-                for c in range(bottom.shape[1]):
-                    relu(top_diff[n, c], bottom[n, c], bottom_diff[n, c],
-                         self.negative_slope)
+    def backward(self, bottom, bottom_diff, top, top_diff):
+        if self.propagate_down:
+            self.relu_backward(top_diff, bottom, bottom_diff)
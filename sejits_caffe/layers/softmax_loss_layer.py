@@ -1,7 +1,8 @@
 from sejits_caffe.layers.loss_layer import LossLayer
 from sejits_caffe.layers.base_layer import BaseLayer
+from sejits_caffe.util.softmax import Softmax, SoftmaxLoss
+from sejits_caffe.util.precompile import kernel
 from cstructures.array import Array
-import sejits_caffe.caffe_pb2 as caffe_pb2
 import numpy as np
 
 
@@ -10,87 +11,67 @@ class SoftMaxLayer(BaseLayer):
     def __init__(self, param):
         super(SoftMaxLayer, self).__init__(param)
         self.param = param
+        # Over axis 1 of the whole blob in one call
+        self.softmax = Softmax()
 
-    def setup(self, bottom, top):
-        self.sum_multiplier = Array.ones((bottom.shape[1]), np.float32)
+    def kernels(self, bottom, top):
+        return [kernel(self.softmax, bottom, top)]
 
     def forward(self, bottom, top):
-        top[:] = bottom[:]
-        for n in range(bottom.shape[0]):
-            # Initialize scale to the first plane
-            scale = bottom[n, 0]
-
-            for c in range(1, bottom.shape[1]):
-                scale = np.maximum(scale, bottom[n, c])
-
-            for c in range(bottom.shape[1]):
-                top[n, c] -= self.sum_multiplier[c] * scale
-
-            top[n] = np.exp(top[n])
-
-            for h in range(bottom.shape[2]):
-                for w in range(bottom.shape[3]):
-                    scale[h, w] = np.dot(top[n].T[w, h], self.sum_multiplier)
-
-            for j in range(bottom.shape[1]):
-                top[n, j] /= scale
+        self.softmax(bottom, top)
 
 
 class SoftMaxWithLossLayer(LossLayer):
     """docstring for SoftMaxWithLossLayer"""
     def __init__(self, param):
         super(SoftMaxWithLossLayer, self).__init__(param)
-        softmax_param = caffe_pb2.SoftmaxParameter()
-        self.softmax_layer = SoftMaxLayer(softmax_param)
-
-        self.ignore_label = param.loss_param.ignore_label
+        if param.loss_param.HasField("ignore_label"):
+            self.ignore_label = param.loss_param.ignore_label
+        else:
+            self.ignore_label = None
         self.normalize = param.loss_param.normalize
+        # The softmax, the loss and its gradient in one pass
+        self.softmax_loss = SoftmaxLoss(self.ignore_label)
 
     def setup(self, bottom_data, bottom_label, top):
-        self.prob = Array.zeros_like(bottom_data)
-        self.softmax_layer.setup(bottom_data, self.prob)
+        # prob - onehot for every position, scaled by backward
+        self.diff = Array.zeros_like(bottom_data)
+        # The loss, labelled and invalid positions of the last forward
+        self.results = np.zeros(3, np.float64)
+        self.normalizer = 1
 
     def get_top_shape(self, *args):
         return (1, )
 
-    def forward(self, bottom_data, bottom_label, top):
-        self.softmax_layer.forward(bottom_data, self.prob)
-        label = bottom_label
-        loss = 0.0
-        count = 0
-        for i in range(self.prob.shape[0]):
-            for j in range(self.prob.shape[2]):
-                for k in range(self.prob.shape[3]):
-                    label_val = label[i, 0, j, k]
-                    if self.ignore_label == label_val:
-                        continue
-                    assert 0 <= label_val < self.prob.shape[1]
-                    loss -= np.log(max(self.prob[i, label_val, j, k],
-                                       np.finfo(np.float32).eps))
-                    count += 1
+    def kernels(self, bottom_data, bottom_label, top):
+        return [kernel(self.softmax_loss, bottom_data, bottom_label,
+                       self.diff, self.results)]
+
+    def cost(self, bottom_data, bottom_label, top):
+        """
+        The max, subtraction, exponential, sum and scaling of the softmax
+        for every input, then a log per label.  The gradient is written
+        out for backward.
+        """
+        flops = 5 * int(bottom_data.size) + int(bottom_label.size)
+        nbytes = 2 * int(bottom_data.nbytes) + int(bottom_label.nbytes) + \
+            int(top.nbytes)
+        return flops, nbytes
 
+    def forward(self, bottom_data, bottom_label, top):
+        self.softmax_loss(bottom_data, bottom_label, self.diff, self.results)
+        loss, count, invalid = self.results
+        if invalid:
+            raise ValueError("{} labels out of range [0, {})".format(
+                int(invalid), bottom_data.shape[1]))
         if self.normalize:
-            top[0] = loss / count
+            self.normalizer = max(count, 1)
         else:
-            top[0] = loss / bottom_data.shape[0]
+            self.normalizer = bottom_data.shape[0]
+        top[0] = loss / self.normalizer
 
-    def backward(self, bottom_diff, bottom_label, top_diff):
-        label = bottom_label
-        bottom_diff[:] = self.prob
-        count = 0
+    def backward(self, bottom_data, bottom_label, bottom_diff, label_diff,
+                 top, top_diff):
         if self.propagate_down:
-            for i in range(self.prob.shape[0]):
-                for j in range(self.prob.shape[2]):
-                    for k in range(self.prob.shape[3]):
-                        label_val = label[i, 0, j, k]
-                        if self.ignore_label == label_val:
-                            bottom_diff[i, ..., j, k] = 0
-                        else:
-                            bottom_diff[i, label_val, j, k] -= 1
-                            count += 1
-
-            loss_weight = top_diff[0]
-            if self.normalize:
-                bottom_diff *= loss_weight / count
-            else:
-                bottom_diff *= loss_weight / bottom_diff.shape[0]
+            np.multiply(self.diff, top_diff[0] / self.normalizer,
+                        out=bottom_diff)
@@ -4,19 +4,25 @@ Draw a graph of the net architecture.
 """
 # import os
 from google.protobuf import text_format
-import caffe_pb2
-
-from layers.conv_layer import ConvLayer
-from layers.relu_layer import ReluLayer
-from layers.data_layer import DataLayer
-from layers.lrn_layer import LRNLayer
-from layers.pooling_layer import PoolingLayer
-from layers.inner_product_layer import InnerProductLayer
-from layers.dropout_layer import DropoutLayer
-from layers.accuracy_layer import AccuracyLayer
-from layers.softmax_loss_layer import SoftMaxWithLossLayer
+import sejits_caffe.caffe_pb2 as caffe_pb2
+
+from sejits_caffe.layers.conv_layer import ConvLayer
+from sejits_caffe.layers.relu_layer import ReluLayer
+from sejits_caffe.layers.data_layer import DataLayer
+from sejits_caffe.layers.lrn_layer import LRNLayer
+from sejits_caffe.layers.pooling_layer import PoolingLayer
+from sejits_caffe.layers.inner_product_layer import InnerProductLayer
+from sejits_caffe.layers.dropout_layer import DropoutLayer
+from sejits_caffe.layers.accuracy_layer import AccuracyLayer
+from sejits_caffe.layers.loss_layer import LossLayer
+from sejits_caffe.layers.softmax_loss_layer import SoftMaxWithLossLayer
 import numpy as np
 
+from sejits_caffe.util.workspace import Workspace
+from sejits_caffe.util.precompile import precompile_all
+from sejits_caffe.util.memory_planner import plan_blobs
+from sejits_caffe.util.profiler import profiler
+from sejits_caffe.util import roofline
 from cstructures.array import Array
 from ctree.util import Timer
 
@@ -37,26 +43,37 @@ class Net(object):
         "SoftmaxWithLoss": SoftMaxWithLossLayer,
     }
 
-    def __init__(self, param_file):
-        self.phase = TRAIN
+    def __init__(self, param_file, batched_conv=False, prefetch=0,
+                 data_workers=0, precompile=False, phase=None, fuse=True):
         # importing net param from .prototxt
         self.param = caffe_pb2.NetParameter()
         param_string = open(param_file).read()
         text_format.Merge(param_string, self.param)
+        # An explicit phase wins over the NetState of the prototxt, which
+        # wins over TRAIN.  TEST nets are forward only: no diffs, no state
+        # kept for backward, and the blobs share memory.
+        if phase is None:
+            phase = self.param.state.phase if self.param.HasField("state") \
+                else TRAIN
+        self.phase = phase
         self.layers = []
         self.blobs = {}
         data_layers = self.get_data_layers_for_phase(self.param.layer)
         for layer_param in data_layers:
-            layer = DataLayer(layer_param)
+            layer = DataLayer(layer_param, prefetch, data_workers)
+            layer.phase = self.layer_phase
             top_shape = layer.get_top_shape()
             top = []
-            for blob in layer_param.top:
-                self.add_blob(blob, top_shape)
+            # The data blob, then one label per image
+            for blob, shape in zip(layer_param.top,
+                                   (top_shape, top_shape[:1])):
+                self.add_blob(blob, shape)
                 top.append(self.blobs[blob])
             layer.setup(*top)
             self.layers.append(layer)
         for layer_param in self.param.layer:
-            if layer_param.type == "Data":
+            if layer_param.type == "Data" or \
+                    not self.layer_included(layer_param):
                 continue
             bottom = []
             top = []
@@ -64,7 +81,12 @@ class Net(object):
                 if blob not in self.blobs:
                     raise Exception("Found uninitialized blob {}".format(blob))
                 bottom.append(self.blobs[blob])
-            layer = self.layer_type_map[layer_param.type](layer_param)
+            layer_class = self.layer_type_map[layer_param.type]
+            if layer_class is ConvLayer:
+                layer = ConvLayer(layer_param, batched_conv)
+            else:
+                layer = layer_class(layer_param)
+            layer.phase = self.layer_phase
             top_shape = layer.get_top_shape(*bottom)
             for blob in layer_param.top:
                 if blob not in self.blobs:
@@ -74,10 +96,148 @@ class Net(object):
             layer.setup(*(bottom + top))
             self.layers.append(layer)
         # print(self.layers)
+        if fuse:
+            self.fuse_layers()
+        self.setup_backward()
+        self.setup_workspace()
+        self.arenas = None
+        # (before, after) bytes of the blobs, see plan_memory
+        self.activation_memory = None
+        if not any(self.layer_need_backward):
+            self.activation_memory = self.plan_memory()
+        if precompile:
+            self.compile()
+
+    @property
+    def layer_phase(self):
+        """
+        The phase as the layers spell it.
+        """
+        return 'train' if self.phase == TRAIN else 'test'
+
+    def fuse_layers(self):
+        """
+        Fold every in-place ReLU that directly follows the convolution or
+        inner product producing its blob into that layer, which then adds
+        the bias and rectifies its output in one pass (see
+        sejits_caffe.util.epilogue) instead of two more sweeps over it.
+        The ReLU is skipped in forward but still runs backward: with a
+        non-negative slope its output has the sign of its input.  Returns
+        the number of fused pairs.
+        """
+        count = 0
+        # blob -> layer that wrote it and that nothing has read since
+        producers = {}
+        for layer in self.layers:
+            layer_param = layer.layer_param
+            bottom = list(layer_param.bottom)
+            top = list(layer_param.top)
+            producer = producers.get(bottom[0]) if bottom else None
+            if isinstance(layer, ReluLayer) and bottom == top and \
+                    layer.negative_slope >= 0 and \
+                    isinstance(producer, (ConvLayer, InnerProductLayer)) and \
+                    producer.epilogue is None:
+                producer.fuse_relu(layer.negative_slope)
+                layer.fused = True
+                count += 1
+            for blob in bottom:
+                producers.pop(blob, None)
+            for blob in top:
+                producers[blob] = layer
+        return count
+
+    def kernels(self):
+        """
+        The (specializer, args) jobs of every kernel forward and backward
+        will call, see BaseLayer.kernels.
+        """
+        jobs = []
+        for layer in self.layers:
+            layer_param = layer.layer_param
+            bottom = [self.blobs[blob] for blob in layer_param.bottom]
+            top = [self.blobs[blob] for blob in layer_param.top]
+            jobs.extend(layer.kernels(*(bottom + top)))
+        return jobs
+
+    def compile(self, num_threads=None):
+        """
+        Specialize and compile every kernel forward and backward will use,
+        in parallel on `num_threads` threads, so that none is compiled
+        lazily inside the first iteration.  Returns the number of kernels
+        and the compile time in seconds.
+        """
+        with Timer() as t:
+            count = precompile_all(self.kernels(), num_threads)
+        return count, t.interval
+
+    def costs(self):
+        """
+        The (name, type, flops, bytes) of every layer's forward pass, see
+        BaseLayer.cost.
+        """
+        costs = []
+        for layer in self.layers:
+            layer_param = layer.layer_param
+            blobs = [self.blobs[blob] for blob in
+                     list(layer_param.bottom) + list(layer_param.top)]
+            flops, nbytes = layer.cost(*blobs)
+            costs.append((layer_param.name, layer_param.type, flops, nbytes))
+        return costs
+
+    def roofline_report(self, iterations=1, peak_gflops=None, peak_gbps=None,
+                        worst=3):
+        """
+        Time `iterations` forward passes and report the achieved GFLOP/s
+        and GB/s of every layer against the machine peaks, flagging the
+        `worst` layers furthest from their roofline bound.  Peaks that are
+        not given are measured, see sejits_caffe.util.roofline.measure_peaks.
+        Returns the rows of the report and the report formatted as a table
+        (see roofline.format_report).
+        """
+        if peak_gflops is None or peak_gbps is None:
+            measured = roofline.measure_peaks()
+            peak_gflops = peak_gflops or measured[0]
+            peak_gbps = peak_gbps or measured[1]
+        enabled = profiler.enabled
+        profiler.enable()
+        mark = profiler.now() - profiler.epoch
+        try:
+            for _ in range(iterations):
+                self.forward()
+        finally:
+            profiler.enabled = enabled
+        times = {}
+        for category, name, start, duration, _, _ in profiler.events:
+            if category == "forward" and start >= mark:
+                times[name] = times.get(name, 0.0) + duration / iterations
+        rows = roofline.flag_worst(
+            roofline.roofline(self.costs(), times, peak_gflops, peak_gbps),
+            worst)
+        return rows, roofline.format_report(rows, peak_gflops, peak_gbps)
+
+    def forward_layer(self, layer, bottom, top):
+        if isinstance(layer, DataLayer) and layer.reader is not None:
+            # Bind the tops to the batch in shared memory instead of copying
+            # it, the views stay valid until the next forward
+            for blob, view in zip(layer.layer_param.top, layer.next_views()):
+                self.blobs[blob] = view
+        else:
+            layer.forward(*(bottom + top))
+
+    def load_data(self):
+        """
+        Load the next batch of every data layer into its tops.
+        """
+        for layer in self.layers:
+            if isinstance(layer, DataLayer):
+                self.forward_layer(layer, [], [self.blobs[blob] for blob
+                                               in layer.layer_param.top])
 
     def forward(self):
         loss = 0
         for layer in self.layers:
+            if layer.fused:
+                continue
             layer_param = layer.layer_param
             bottom = []
             top = []
@@ -85,19 +245,233 @@ class Net(object):
                 bottom.append(self.blobs[blob])
             for blob in layer_param.top:
                 top.append(self.blobs[blob])
-            with Timer() as t:
-                layer.forward(*(bottom + top))
-            print("{} layer time: {}s".format(layer_param.type, t.interval))
+            if profiler.enabled:
+                start = profiler.now()
+                self.forward_layer(layer, bottom, top)
+                profiler.record("forward", layer_param.name, start)
+            else:
+                self.forward_layer(layer, bottom, top)
+            if isinstance(layer, LossLayer):
+                loss += layer.loss_weight * top[0][0]
         # print("Loss: {}".format(loss))
         return loss
 
+    def backward(self):
+        """
+        Propagate the loss gradient from the top of the net down to every
+        layer that needs it (see `setup_backward`).  Layers are called as
+        layer.backward(*(bottom + bottom_diff + top + top_diff)), with None
+        for the diff of blobs that do not need a gradient.  The gradients of
+        a blob read by several layers are summed, see `setup_backward`.
+        """
+        for index in reversed(range(len(self.layers))):
+            if not self.layer_need_backward[index]:
+                continue
+            layer = self.layers[index]
+            layer_param = layer.layer_param
+            bottom = [self.blobs[blob] for blob in layer_param.bottom]
+            bottom_diff = self.bottom_diffs[index]
+            top = [self.blobs[blob] for blob in layer_param.top]
+            top_diff = [self.blob_diffs.get(blob) for blob in layer_param.top]
+            if profiler.enabled:
+                start = profiler.now()
+                layer.backward(*(bottom + bottom_diff + top + top_diff))
+                profiler.record("backward", layer_param.name, start)
+            else:
+                layer.backward(*(bottom + bottom_diff + top + top_diff))
+            for partial, diff in self.diff_sums[index]:
+                diff += partial
+
+    def forward_backward(self):
+        """
+        One training step without the parameter update: returns the loss
+        and leaves the parameter gradients in each layer's blob_diffs.
+        """
+        loss = self.forward()
+        self.backward()
+        return loss
+
+    def close(self):
+        """
+        Stop the prefetch threads and reader processes of the data layers.
+        """
+        for layer in self.layers:
+            if isinstance(layer, DataLayer):
+                layer.close()
+
+    def setup_backward(self):
+        """
+        Decide which layers need backward and allocate a diff for every blob
+        that needs a gradient, following Caffe's Net::Init: a layer needs
+        backward if it has parameters or any of its bottoms needs a
+        gradient, and it contributes to a loss.  force_backward gives a
+        gradient to every bottom that allows it (see
+        BaseLayer.allow_force_backward); layers without bottoms, like the
+        data layers, have nothing to force.
+
+        Like the Split layers Caffe inserts, a blob read by several layers
+        that need its gradient receives the sum of their gradients: the
+        last reader writes the diff of the blob, the others each write a
+        diff of their own that is added to it after their backward.  An
+        in-place layer starts a new version of its blob, whose readers are
+        counted separately.
+        """
+        if self.phase != TRAIN:
+            self.layer_need_backward = [False] * len(self.layers)
+            self.blob_diffs = {}
+            self.bottom_diffs = [[] for _ in self.layers]
+            self.diff_sums = [[] for _ in self.layers]
+            for layer in self.layers:
+                layer.propagate_down = False
+            return
+        blob_need_backward = {}
+        self.layer_need_backward = []
+        # Per layer, whether each bottom gets a gradient
+        bottom_need_backward = []
+        for layer in self.layers:
+            layer_param = layer.layer_param
+            # Only bottoms that exist can be forced, data layers have none
+            bottom_need = [
+                blob_need_backward.get(blob, False) or
+                self.param.force_backward and layer.allow_force_backward(i)
+                for i, blob in enumerate(layer_param.bottom)]
+            bottom_need_backward.append(bottom_need)
+            need_backward = any(bottom_need) or len(layer.blobs) > 0
+            layer.propagate_down = any(bottom_need)
+            for blob in layer_param.top:
+                blob_need_backward[blob] = need_backward
+            self.layer_need_backward.append(need_backward)
+
+        # Prune the layers that do not contribute to any loss.
+        blobs_under_loss = set()
+        for index in reversed(range(len(self.layers))):
+            layer = self.layers[index]
+            layer_param = layer.layer_param
+            if isinstance(layer, LossLayer) or any(
+                    blob in blobs_under_loss for blob in layer_param.top):
+                blobs_under_loss.update(layer_param.bottom)
+            else:
+                self.layer_need_backward[index] = False
+
+        self.blob_diffs = {}
+        for layer, need_backward, bottom_need in zip(
+                self.layers, self.layer_need_backward, bottom_need_backward):
+            if not need_backward:
+                continue
+            layer_param = layer.layer_param
+            needed = [blob for blob, need in zip(layer_param.bottom,
+                                                 bottom_need) if need] + \
+                [blob for blob in layer_param.top
+                 if blob_need_backward.get(blob, False)]
+            for blob in needed:
+                if blob not in self.blob_diffs:
+                    self.blob_diffs[blob] = Array.zeros_like(self.blobs[blob])
+                    if profiler.enabled:
+                        profiler.allocated(blob + "_diff",
+                                           self.blob_diffs[blob].nbytes)
+            if isinstance(layer, LossLayer):
+                self.blob_diffs[layer.layer_param.top[0]].fill(
+                    layer.loss_weight)
+
+        # (blob, version) -> (layer, bottom index) of the readers that need
+        # its gradient
+        readers = {}
+        versions = {}
+        for index, layer in enumerate(self.layers):
+            layer_param = layer.layer_param
+            for i, blob in enumerate(layer_param.bottom):
+                if self.layer_need_backward[index] and \
+                        bottom_need_backward[index][i]:
+                    readers.setdefault((blob, versions.get(blob, 0)),
+                                       []).append((index, i))
+            for blob in layer_param.top:
+                versions[blob] = versions.get(blob, 0) + 1
+        self.bottom_diffs = [[None] * len(layer.layer_param.bottom)
+                             for layer in self.layers]
+        # Per layer, the (partial, diff) pairs to sum after its backward
+        self.diff_sums = [[] for _ in self.layers]
+        for (blob, _), blob_readers in readers.items():
+            # Backward runs the last reader first
+            index, i = blob_readers[-1]
+            self.bottom_diffs[index][i] = self.blob_diffs[blob]
+            for index, i in blob_readers[:-1]:
+                partial = Array.zeros_like(self.blob_diffs[blob])
+                if profiler.enabled:
+                    profiler.allocated(blob + "_diff", partial.nbytes)
+                self.bottom_diffs[index][i] = partial
+                self.diff_sums[index].append((partial, self.blob_diffs[blob]))
+
+    def setup_workspace(self):
+        """
+        Give every conv layer that needs backward column buffers of its own
+        to keep the columns of forward for backward (see
+        ConvLayer.keep_columns), and share a single column workspace large
+        enough for the biggest of the others between them.
+        """
+        conv_layers = [layer for layer in self.layers
+                       if isinstance(layer, ConvLayer)]
+        shared = []
+        for layer, need_backward in zip(self.layers,
+                                        self.layer_need_backward):
+            if isinstance(layer, ConvLayer):
+                if need_backward:
+                    layer.keep_columns()
+                else:
+                    shared.append(layer)
+        size = max([np.prod(layer.col_shape) for layer in shared] + [0])
+        self.workspace = Workspace(size)
+        for layer in conv_layers:
+            layer.workspace = self.workspace
+
+    def plan_memory(self):
+        """
+        Let blobs whose lifetimes do not overlap share memory, see
+        sejits_caffe.util.memory_planner.  Only valid when no layer needs
+        backward, since backward reads the blobs of forward again.  Returns
+        the activation memory before and after in bytes.
+        """
+        steps = [(list(layer.layer_param.bottom),
+                  list(layer.layer_param.top)) for layer in self.layers]
+        consumed = set(blob for bottom, _ in steps for blob in bottom)
+        # Blobs nobody consumes (losses, accuracies) are read by the caller
+        outputs = [blob for blob in self.blobs if blob not in consumed]
+        # Both compute top elementwise from bottom
+        in_place = [index for index, layer in enumerate(self.layers)
+                    if isinstance(layer, (ReluLayer, DropoutLayer))]
+        sizes = dict((blob, value.size) for blob, value in self.blobs.items())
+        arena_sizes, assignment = plan_blobs(steps, sizes, outputs, in_place)
+        before = sum(value.nbytes for value in self.blobs.values())
+        self.arenas = [Array.zeros((size, ), np.float32)
+                       for size in arena_sizes]
+        if profiler.enabled:
+            for index, arena in enumerate(self.arenas):
+                profiler.allocated("arena{}".format(index), arena.nbytes)
+        for blob, arena in assignment.items():
+            self.blobs[blob] = self.arenas[arena][:sizes[blob]].reshape(
+                self.blobs[blob].shape)
+        after = sum(arena.nbytes for arena in self.arenas)
+        return before, after
+
     def add_blob(self, blob, shape):
         self.blobs[blob] = Array.zeros(shape, np.float32)
+        if profiler.enabled:
+            profiler.allocated(blob, self.blobs[blob].nbytes)
+
+    def layer_included(self, layer_param):
+        """
+        Apply the include/exclude rules of a layer to the current phase.
+        Stages are not supported.
+        """
+        def matches(rule):
+            return not rule.HasField("phase") or rule.phase == self.phase
+
+        if len(layer_param.include) > 0:
+            return any(matches(rule) for rule in layer_param.include)
+        return not any(matches(rule) for rule in layer_param.exclude)
 
     def get_data_layers_for_phase(self, layers):
-        # TODO: Do we need to handle more than 1 includes?
         return filter(lambda x: x.type == "Data" and
-                      x.include[0].phase == self.phase, layers)
+                      self.layer_included(x), layers)
 
 
 def main(argv):
@@ -12,6 +12,7 @@ import ctree.c.nodes as C
 from ctree.templates.nodes import StringTemplate
 from ctree.types import get_ctype
 from cstructures.array import Array
+from sejits_caffe.util.profiler import profiler
 import numpy as np
 import ctypes as ct
 from collections import namedtuple
@@ -259,6 +260,7 @@ class InlineEnvironment(ast.NodeTransformer):
 class ConcreteMeta(ConcreteSpecializedFunction):
     def __init__(self, entry_name, proj, entry_type, params, original_args):
         self._c_function = self._compile(entry_name, proj, entry_type)
+        self.entry_name = entry_name
         self.params = params
         self.original_args = original_args
 
@@ -277,11 +279,12 @@ class ConcreteMeta(ConcreteSpecializedFunction):
                     if _id == param.name:
                         a.append(args[i])
                         break
-        from ctree.util import Timer
-        with Timer() as t:
+        if profiler.enabled:
+            start = profiler.now()
             retval = self._c_function(*a)
-        print("meta time {}".format(t.interval))
-        return retval
+            profiler.record("kernel", self.entry_name, start)
+            return retval
+        return self._c_function(*a)
 
 
 class MetaSpecialized(LazySpecializedFunction):
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""
+Train a net with the solver described by a solver .prototxt.
+"""
+from google.protobuf import text_format
+import sejits_caffe.caffe_pb2 as caffe_pb2
+from sejits_caffe.net import Net
+from sejits_caffe.util.param_update import ParamUpdate
+from sejits_caffe.util.precompile import kernel, precompile_all
+from sejits_caffe.util.profiler import profiler
+from cstructures.array import Array
+from ctree.util import Timer
+import numpy as np
+import os
+
+
+class Solver(object):
+    def __init__(self, param_file, batched_conv=False, data_workers=0,
+                 precompile=False):
+        # importing solver param from .prototxt
+        self.param = caffe_pb2.SolverParameter()
+        param_string = open(param_file).read()
+        text_format.Merge(param_string, self.param)
+        if self.param.HasField("net"):
+            net_file = self.param.net
+        elif self.param.HasField("train_net"):
+            net_file = self.param.train_net
+        else:
+            raise NotImplementedError("Solver requires net or train_net")
+        # Net paths are relative to the solver file, like the examples
+        if not os.path.isabs(net_file) and not os.path.exists(net_file):
+            net_file = os.path.join(os.path.dirname(param_file), net_file)
+        if self.param.random_seed >= 0:
+            np.random.seed(self.param.random_seed)
+        self.net = Net(net_file, batched_conv, data_workers=data_workers,
+                       phase=caffe_pb2.TRAIN)
+        self.iter = 0
+        self.update = ParamUpdate(self.param.solver_type,
+                                  self.param.momentum, self.param.delta,
+                                  self.param.regularization_type)
+
+        # (data, diff, history, lr_mult, decay_mult) for every learnable blob
+        self.params = []
+        for layer in self.net.layers:
+            param_specs = layer.layer_param.param
+            for index, (data, diff) in enumerate(zip(layer.blobs,
+                                                     layer.blob_diffs)):
+                if index < len(param_specs):
+                    lr_mult = param_specs[index].lr_mult
+                    decay_mult = param_specs[index].decay_mult
+                else:
+                    lr_mult, decay_mult = 1.0, 1.0
+                self.params.append((data, diff, Array.zeros_like(data),
+                                    lr_mult, decay_mult))
+        if precompile:
+            self.compile()
+
+    def compile(self, num_threads=None):
+        """
+        Compile the kernels of the net and of the parameter updates ahead
+        of the first iteration, see Net.compile.
+        """
+        jobs = self.net.kernels()
+        for data, diff, history, lr_mult, decay_mult in self.params:
+            jobs.append(kernel(self.update, data, diff, history, 0.0, 0.0))
+        with Timer() as t:
+            count = precompile_all(jobs, num_threads)
+        return count, t.interval
+
+    def get_learning_rate(self):
+        """
+        The learning rate for the current iteration according to lr_policy,
+        with the same policies and formulas as Caffe.
+        """
+        param = self.param
+        policy = param.lr_policy
+        if policy == "fixed":
+            return param.base_lr
+        elif policy == "step":
+            return param.base_lr * \
+                pow(param.gamma, self.iter // param.stepsize)
+        elif policy == "exp":
+            return param.base_lr * pow(param.gamma, self.iter)
+        elif policy == "inv":
+            return param.base_lr * \
+                pow(1 + param.gamma * self.iter, -param.power)
+        elif policy == "multistep":
+            current_step = sum(1 for value in param.stepvalue
+                               if self.iter >= value)
+            return param.base_lr * pow(param.gamma, current_step)
+        elif policy == "poly":
+            return param.base_lr * \
+                pow(1.0 - float(self.iter) / param.max_iter, param.power)
+        elif policy == "sigmoid":
+            return param.base_lr * \
+                (1.0 / (1.0 + np.exp(-param.gamma *
+                                     (self.iter - param.stepsize))))
+        raise NotImplementedError("Unknown lr_policy {}".format(policy))
+
+    def get_diff_scale(self):
+        """
+        Factor applied to every gradient so that their global L2 norm does
+        not exceed clip_gradients.
+        """
+        clip_gradients = self.param.clip_gradients
+        if clip_gradients < 0:
+            return 1.0
+        sumsq_diff = 0.0
+        for data, diff, history, lr_mult, decay_mult in self.params:
+            flat = diff.reshape(-1)
+            sumsq_diff += float(np.dot(flat, flat))
+        l2norm_diff = np.sqrt(sumsq_diff)
+        if l2norm_diff > clip_gradients:
+            return clip_gradients / l2norm_diff
+        return 1.0
+
+    def apply_update(self):
+        rate = self.get_learning_rate()
+        diff_scale = self.get_diff_scale()
+        for data, diff, history, lr_mult, decay_mult in self.params:
+            self.update(data, diff, history, rate * lr_mult,
+                        self.param.weight_decay * decay_mult, diff_scale)
+
+    def step(self, iters):
+        for _ in range(iters):
+            loss = self.net.forward_backward()
+            if self.param.display and self.iter % self.param.display == 0:
+                print("Iteration {}, lr = {}, loss = {}".format(
+                    self.iter, self.get_learning_rate(), loss))
+            if profiler.enabled:
+                start = profiler.now()
+                self.apply_update()
+                profiler.record("update", "iteration", start)
+            else:
+                self.apply_update()
+            self.iter += 1
+
+    def solve(self):
+        self.step(self.param.max_iter - self.iter)
+
+
+def main(argv):
+    if len(argv) != 2:
+        raise Exception('Usage: solver .prototxt file')
+    Solver(argv[1]).solve()
+
+
+if __name__ == '__main__':
+    import sys
+    main(sys.argv)
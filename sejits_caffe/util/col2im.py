@@ -2,39 +2,56 @@ import ctree.c.nodes as C
 # import ctree.c
 from ctree.nodes import Project
 from ctree.templates.nodes import StringTemplate
-from ctree.jit import LazySpecializedFunction, ConcreteSpecializedFunction
+from sejits_caffe.util.specializer import Specializer, ConcreteKernel
 import ctypes as ct
 from cstructures.array import Array
+from sejits_caffe.util.im2col import omp_parallel_for
 import numpy as np
 
 
-class ConcreteCol2Im(ConcreteSpecializedFunction):
+class ConcreteCol2Im(ConcreteKernel):
     def __init__(self, entry_name, proj, entry_type, out_shape):
         self._c_function = self._compile(entry_name, proj, entry_type)
         self.out_shape = out_shape
 
-    def __call__(self, *args):
-        output = Array.zeros(self.out_shape, args[0].dtype)
-        self._c_function(args[0], output)
+    def __call__(self, data_col, output=None):
+        """
+        Accumulate `data_col` back into an image of shape `out_shape`.  The
+        kernel clears `output` before scattering, so a caller-provided
+        buffer does not need to be zeroed.
+        """
+        if output is None:
+            output = Array.empty(self.out_shape, data_col.dtype)
+        self._c_function(data_col, output)
         return output
 
 
-class Col2Im(LazySpecializedFunction):
+class Col2Im(Specializer):
     def __init__(self, kernel_size, stride, padding, shape):
+        """
+        `shape` is the shape of the image, either (channels, height, width)
+        or, for columns produced from a whole batch, (num, channels, height,
+        width).
+        """
         super(Col2Im, self).__init__(C.Constant(0))
         self.kernel_h, self.kernel_w = kernel_size
         self.stride_h, self.stride_w = stride
         self.pad_h, self.pad_w = padding
-        self.shape = shape
+        self.shape = tuple(shape)
 
     def args_to_subconfig(self, args):
         A = args[0]
-        return (A.shape, np.ctypeslib.ndpointer(A.dtype, A.ndim, A.shape))
+        return (A.shape, np.ctypeslib.ndpointer(A.dtype, A.ndim, A.shape),
+                (self.kernel_h, self.kernel_w, self.stride_h, self.stride_w,
+                 self.pad_h, self.pad_w), self.shape)
 
-    def transform(self, tree, program_cfg):
-        arg_cfg, tune_cfg = program_cfg
-        channels, height, width = self.shape
-        cfg = {
+    def template_cfg(self):
+        if len(self.shape) == 3:
+            num, (channels, height, width) = 1, self.shape
+        else:
+            num, channels, height, width = self.shape
+        return {
+            'num': C.Constant(num),
             'pad_h': C.Constant(self.pad_h),
             'pad_w': C.Constant(self.pad_w),
             'stride_h': C.Constant(self.stride_h),
@@ -45,6 +62,10 @@ class Col2Im(LazySpecializedFunction):
             'height': C.Constant(height),
             'width': C.Constant(width),
         }
+
+    def transform(self, tree, program_cfg):
+        arg_cfg, tune_cfg = program_cfg
+        cfg = self.template_cfg()
         col2im = C.FunctionDecl(
             None,
             C.SymbolRef("col2im"),
@@ -57,23 +78,28 @@ int pad_h = $pad_h;
 int pad_w = $pad_w;
 int patch_h = $kernel_h;
 int patch_w = $kernel_w;
+int num = $num;
 int channels = $channels;
 int height = $height;
 int width = $width;
 int height_col = (height + 2 * pad_h - patch_h) / stride_h + 1;
 int width_col = (width + 2 * pad_w - patch_w) / stride_w + 1;
 int channels_col = channels * patch_h * patch_w;
+for (int i = 0; i < num * channels * height * width; ++i)
+  data_im[i] = 0;
 for (int c = 0; c < channels_col; ++c) {
   int w_offset = c % patch_w;
   int h_offset = (c / patch_w) % patch_h;
   int c_im = c / patch_h / patch_w;
-  for (int h = 0; h < height_col; ++h) {
-    for (int w = 0; w < width_col; ++w) {
-      int h_pad = h * stride_h - pad_h + h_offset;
-      int w_pad = w * stride_w - pad_w + w_offset;
-      if (h_pad >= 0 && h_pad < height && w_pad >= 0 && w_pad < width)
-        data_im[(c_im * height + h_pad) * width + w_pad] +=
-            data_col[(c * height_col + h) * width_col + w];
+  for (int n = 0; n < num; ++n) {
+    for (int h = 0; h < height_col; ++h) {
+      for (int w = 0; w < width_col; ++w) {
+        int h_pad = h * stride_h - pad_h + h_offset;
+        int w_pad = w * stride_w - pad_w + w_offset;
+        if (h_pad >= 0 && h_pad < height && w_pad >= 0 && w_pad < width)
+          data_im[((n * channels + c_im) * height + h_pad) * width + w_pad] +=
+              data_col[((c * num + n) * height_col + h) * width_col + w];
+      }
     }
   }
 } """, cfg)])
@@ -82,6 +108,80 @@ for (int c = 0; c < channels_col; ++c) {
     def finalize(self, files, program_cfg):
         arg_cfg, tune_cfg = program_cfg
         proj = Project(files)
-        out_ptr = np.ctypeslib.ndpointer(arg_cfg[1]._dtype_, 3, self.shape)
+        out_ptr = np.ctypeslib.ndpointer(arg_cfg[1]._dtype_, len(self.shape),
+                                         self.shape)
         entry_type = ct.CFUNCTYPE(None, arg_cfg[1], out_ptr)
         return ConcreteCol2Im('col2im', proj, entry_type, self.shape)
+
+
+class ParallelCol2Im(Col2Im):
+    """
+    OpenMP variant of Col2Im.  Work is split over image planes (n, c_im)
+    rather than column rows: every row that scatters into a plane is handled
+    by the thread owning that plane, so no atomics are needed.  Padding
+    checks are hoisted out of the inner loop the same way as in
+    ParallelIm2Col.
+
+    num_threads == 0 leaves the thread count to the OpenMP runtime.
+    """
+    def __init__(self, kernel_size, stride, padding, shape, num_threads=0):
+        super(ParallelCol2Im, self).__init__(kernel_size, stride, padding,
+                                             shape)
+        self.num_threads = num_threads
+
+    def args_to_subconfig(self, args):
+        return super(ParallelCol2Im, self).args_to_subconfig(args) + \
+            (self.num_threads, )
+
+    def transform(self, tree, program_cfg):
+        arg_cfg, tune_cfg = program_cfg
+        cfg = self.template_cfg()
+        cfg['pragma'] = omp_parallel_for(self.num_threads)
+        col2im = C.FunctionDecl(
+            None,
+            C.SymbolRef("col2im"),
+            [C.SymbolRef("data_col", arg_cfg[1]()),
+             C.SymbolRef("data_im", arg_cfg[1]())],
+            [StringTemplate("""
+int stride_h = $stride_h;
+int stride_w = $stride_w;
+int pad_h = $pad_h;
+int pad_w = $pad_w;
+int patch_h = $kernel_h;
+int patch_w = $kernel_w;
+int num = $num;
+int channels = $channels;
+int height = $height;
+int width = $width;
+int height_col = (height + 2 * pad_h - patch_h) / stride_h + 1;
+int width_col = (width + 2 * pad_w - patch_w) / stride_w + 1;
+$pragma
+for (int plane = 0; plane < num * channels; ++plane) {
+  int n = plane / channels;
+  int c_im = plane % channels;
+  memset(data_im + plane * height * width, 0,
+         height * width * sizeof(*data_im));
+  for (int h_offset = 0; h_offset < patch_h; ++h_offset) {
+    for (int w_offset = 0; w_offset < patch_w; ++w_offset) {
+      int c = (c_im * patch_h + h_offset) * patch_w + w_offset;
+      // Columns [w_start, w_end) scatter inside the image.
+      int w_start = pad_w > w_offset ?
+          (pad_w - w_offset + stride_w - 1) / stride_w : 0;
+      int w_end = width + pad_w - w_offset > 0 ?
+          (width + pad_w - w_offset + stride_w - 1) / stride_w : 0;
+      if (w_end > width_col)
+        w_end = width_col;
+      for (int h = 0; h < height_col; ++h) {
+        int h_pad = h * stride_h - pad_h + h_offset;
+        if (h_pad < 0 || h_pad >= height)
+          continue;
+        int col_offset = ((c * num + n) * height_col + h) * width_col;
+        int im_offset = (plane * height + h_pad) * width - pad_w + w_offset;
+        for (int w = w_start; w < w_end; ++w)
+          data_im[im_offset + w * stride_w] += data_col[col_offset + w];
+      }
+    }
+  }
+} """, cfg)])
+        return [C.CFile('col2im', [StringTemplate("#include <string.h>"),
+                                   col2im], config_target='omp')]
@@ -0,0 +1,115 @@
+import ctree.c.nodes as C
+from ctree.nodes import Project
+from ctree.templates.nodes import StringTemplate
+from sejits_caffe.util.specializer import Specializer, ConcreteKernel
+import ctypes as ct
+import numpy as np
+
+
+# Value subtracted from each pixel, per mean mode
+means = {
+    # A full (channels, datum_height, datum_width) mean indexed by the
+    # position in the uncropped datum, like Caffe's mean_file
+    "file": "mean[mean_offset + w]",
+    # One value per channel, like Caffe's mean_value
+    "value": "mean[c]",
+    "none": "0",
+}
+
+
+class ConcreteBatchTransform(ConcreteKernel):
+    def __init__(self, entry_name, proj, entry_type):
+        self._c_function = self._compile(entry_name, proj, entry_type)
+
+    def __call__(self, data, mean, h_offsets, w_offsets, mirror, output):
+        self._c_function(data, mean, h_offsets, w_offsets, mirror, output)
+        return output
+
+
+class BatchTransform(Specializer):
+    """
+    Turns a stacked uint8 (num, channels, datum_height, datum_width) batch
+    into the float32 (num, channels, height, width) network input in one
+    pass, fusing the cast, the per-sample crop at (h_offsets[n],
+    w_offsets[n]), the mirror when mirror[n] is set, the mean subtraction
+    and the scale.
+    """
+    def __init__(self, scale=1.0, mean_mode="none"):
+        super(BatchTransform, self).__init__(C.Constant(0))
+        if mean_mode not in means:
+            raise NotImplementedError(
+                "Unknown mean mode {}".format(mean_mode))
+        self.scale = scale
+        self.mean_mode = mean_mode
+
+    def args_to_subconfig(self, args):
+        data, mean, h_offsets, w_offsets, mirror, output = args
+        return (data.shape, mean.shape, output.shape,
+                (self.scale, self.mean_mode))
+
+    def transform(self, tree, program_cfg):
+        arg_cfg, tune_cfg = program_cfg
+        data_shape, mean_shape, output_shape = arg_cfg[:3]
+        num, channels, datum_height, datum_width = data_shape
+        height, width = output_shape[2:]
+        cfg = {
+            'num': C.Constant(num),
+            'channels': C.Constant(channels),
+            'datum_height': C.Constant(datum_height),
+            'datum_width': C.Constant(datum_width),
+            'height': C.Constant(height),
+            'width': C.Constant(width),
+            'scale': C.Constant(self.scale),
+            'mean': StringTemplate(means[self.mean_mode]),
+        }
+        offsets = np.ctypeslib.ndpointer(np.int32, 1, (num, ))()
+        transform = C.FunctionDecl(
+            None,
+            C.SymbolRef("batch_transform"),
+            # ctree has no C spelling for uint8 pointers, the data is cast
+            # below instead.
+            [C.SymbolRef("raw_data", ct.c_void_p()),
+             C.SymbolRef("mean", np.ctypeslib.ndpointer(
+                 np.float32, len(mean_shape), mean_shape)()),
+             C.SymbolRef("h_offsets", offsets),
+             C.SymbolRef("w_offsets", offsets),
+             C.SymbolRef("mirror", offsets),
+             C.SymbolRef("output", np.ctypeslib.ndpointer(
+                 np.float32, 4, output_shape)())],
+            [StringTemplate("""
+const unsigned char* data = (const unsigned char*) raw_data;
+#pragma omp parallel for collapse(2)
+for (int n = 0; n < $num; ++n) {
+  for (int c = 0; c < $channels; ++c) {
+    int h_off = h_offsets[n];
+    int w_off = w_offsets[n];
+    for (int h = 0; h < $height; ++h) {
+      int mean_offset = (c * $datum_height + h_off + h) * $datum_width +
+          w_off;
+      const unsigned char* src = data + n * $channels * $datum_height *
+          $datum_width + mean_offset;
+      float* dst = output + ((n * $channels + c) * $height + h) * $width;
+      if (mirror[n]) {
+        for (int w = 0; w < $width; ++w)
+          dst[$width - 1 - w] = ((float) src[w] - $mean) * $scale;
+      } else {
+        for (int w = 0; w < $width; ++w)
+          dst[w] = ((float) src[w] - $mean) * $scale;
+      }
+    }
+  }
+} """, cfg)])
+        return [C.CFile('batch_transform', [transform], config_target='omp')]
+
+    def finalize(self, files, program_cfg):
+        arg_cfg, tune_cfg = program_cfg
+        data_shape, mean_shape, output_shape = arg_cfg[:3]
+        offsets = np.ctypeslib.ndpointer(np.int32, 1, data_shape[:1])
+        proj = Project(files)
+        entry_type = ct.CFUNCTYPE(
+            None,
+            np.ctypeslib.ndpointer(np.uint8, 4, data_shape),
+            np.ctypeslib.ndpointer(np.float32, len(mean_shape), mean_shape),
+            offsets, offsets, offsets,
+            np.ctypeslib.ndpointer(np.float32, 4, output_shape))
+        return ConcreteBatchTransform('batch_transform', proj, entry_type)
@@ -0,0 +1,86 @@
+import ctree.c.nodes as C
+from ctree.nodes import Project
+from ctree.templates.nodes import StringTemplate
+from sejits_caffe.util.specializer import Specializer, ConcreteKernel
+from sejits_caffe.util.relu import float_literal
+import ctypes as ct
+import numpy as np
+
+
+class ConcreteEpilogue(ConcreteKernel):
+    def __init__(self, entry_name, proj, entry_type):
+        self._c_function = self._compile(entry_name, proj, entry_type)
+
+    def __call__(self, data, bias=None):
+        if bias is None:
+            self._c_function(data)
+        else:
+            self._c_function(data, bias)
+        return data
+
+
+class Epilogue(Specializer):
+    """
+    Finishes the output of a GEMM in place in a single pass over it: adds
+    `bias` (if given) along axis 1 and, unless `negative_slope` is None,
+    applies a ReLU with that slope.  `data` is a contiguous float32 blob
+    of shape (num, channels, ...).
+    """
+    def __init__(self, negative_slope=None):
+        super(Epilogue, self).__init__(C.Constant(0))
+        self.negative_slope = negative_slope
+
+    def args_to_subconfig(self, args):
+        return args[0].shape, len(args) > 1 and args[1] is not None, \
+            self.negative_slope
+
+    def transform(self, tree, program_cfg):
+        arg_cfg, tune_cfg = program_cfg
+        shape, bias_term = arg_cfg[:2]
+        num, channels = shape[:2]
+        if self.negative_slope is None:
+            activation = "value"
+        elif self.negative_slope == 0:
+            activation = "value > 0 ? value : 0.0f"
+        else:
+            activation = "value > 0 ? value : value * $negative_slope"
+        cfg = {
+            'num': C.Constant(num),
+            'channels': C.Constant(channels),
+            'spatial': C.Constant(int(np.prod(shape[2:]))),
+            'bias': StringTemplate("bias[c]" if bias_term else "0.0f"),
+            'activation': StringTemplate(activation, {
+                'negative_slope': float_literal(self.negative_slope or 0.0)}),
+        }
+        params = [C.SymbolRef("data", np.ctypeslib.ndpointer(
+            np.float32, len(shape), shape)())]
+        if bias_term:
+            params.append(C.SymbolRef("bias", np.ctypeslib.ndpointer(
+                np.float32, 1, (channels, ))()))
+        epilogue = C.FunctionDecl(
+            None,
+            C.SymbolRef("epilogue"),
+            params,
+            [StringTemplate("""
+#pragma omp parallel for collapse(2)
+for (int n = 0; n < $num; ++n) {
+  for (int c = 0; c < $channels; ++c) {
+    float* row = data + (n * $channels + c) * $spatial;
+    float b = $bias;
+    #pragma omp simd
+    for (int s = 0; s < $spatial; ++s) {
+      float value = row[s] + b;
+      row[s] = $activation;
+    }
+  }
+} """, cfg)])
+        return [C.CFile('epilogue', [epilogue], config_target='omp')]
+
+    def finalize(self, files, program_cfg):
+        arg_cfg, tune_cfg = program_cfg
+        shape, bias_term = arg_cfg[:2]
+        argtypes = [np.ctypeslib.ndpointer(np.float32, len(shape), shape)]
+        if bias_term:
+            argtypes.append(np.ctypeslib.ndpointer(np.float32, 1, shape[1:2]))
+        entry_type = ct.CFUNCTYPE(None, *argtypes)
+        return ConcreteEpilogue('epilogue', Project(files), entry_type)
@@ -0,0 +1,56 @@
+"""
+C sources of exp and pow in branch free float arithmetic, which unlike
+those of libm vectorize inside `omp simd` loops.  Kernels include them in
+their CFile before their own functions.
+
+exp(z) = 2 ** n * exp(r) with n the nearest integer to z / log(2) and
+|r| <= log(2) / 2, where exp(r) is its Taylor series; n * log(2) is
+subtracted in two parts so that r stays exact.  n is rounded by adding
+1.5 * 2 ** 23, which leaves it in the low bits of the sum: floorf, a
+conversion back from int or a second comparison would each keep gcc from
+vectorizing the loop.  It is within about 1e-7 relative error for z up to
+88, and z below -87 gives exp(-87) rather than 0.  pow(x, y) for x > 0 is
+exp(y * log(x)), where log(m) of the mantissa m of x, in [sqrt(1/2),
+sqrt(2)), is the series of 2 atanh((m - 1) / (m + 1)); its error grows
+with |y * log(x)|, to about 1e-6 around 10.
+"""
+
+fast_expf = """
+#include <math.h>
+#include <string.h>
+
+static inline float fast_expf(float z) {
+  z = z < -87.0f ? -87.0f : z;
+  float t = z * 1.44269504f + 12582912.0f;
+  float n = t - 12582912.0f;
+  float r = z - n * 0.693145751953125f - n * 1.42860677e-6f;
+  float p = 1.0f + r * (1.0f + r * (1.0f / 2 + r * (1.0f / 6 +
+      r * (1.0f / 24 + r * (1.0f / 120 + r * (1.0f / 720 +
+      r * (1.0f / 5040)))))));
+  int bits;
+  memcpy(&bits, &t, 4);
+  bits = (bits - 0x4b400000 + 127) << 23;
+  float two_n;
+  memcpy(&two_n, &bits, 4);
+  return p * two_n;
+}
+"""
+
+fast_powf = fast_expf + """
+static inline float fast_powf(float x, float y) {
+  int bits;
+  memcpy(&bits, &x, 4);
+  int e = ((bits >> 23) & 255) - 127;
+  bits = (bits & 0x007fffff) | 0x3f800000;
+  float m;
+  memcpy(&m, &bits, 4);
+  int big = m > 1.41421356f;
+  m = big ? 0.5f * m : m;
+  e += big;
+  float t = (m - 1.0f) / (m + 1.0f);
+  float t2 = t * t;
+  float log_m = 2.0f * t * (1.0f + t2 * (1.0f / 3 + t2 * (1.0f / 5 +
+      t2 * (1.0f / 7 + t2 * (1.0f / 9)))));
+  return fast_expf(y * (e * 0.693147181f + log_m));
+}
+"""
@@ -2,24 +2,30 @@ import ctree.c.nodes as C
 # import ctree.c
 from ctree.nodes import Project
 from ctree.templates.nodes import StringTemplate
-from ctree.jit import LazySpecializedFunction, ConcreteSpecializedFunction
+from sejits_caffe.util.specializer import Specializer, ConcreteKernel
 import ctypes as ct
 from cstructures.array import Array
 import numpy as np
 
 
-class ConcreteIm2Col(ConcreteSpecializedFunction):
+class ConcreteIm2Col(ConcreteKernel):
     def __init__(self, entry_name, proj, entry_type, out_shape):
         self._c_function = self._compile(entry_name, proj, entry_type)
         self.out_shape = out_shape
 
-    def __call__(self, *args):
-        output = Array.empty(self.out_shape, np.float32)
-        self._c_function(args[0], output)
+    def __call__(self, data, output=None):
+        """
+        Lower `data` into columns.  If `output` is given it must be a
+        contiguous float32 buffer of shape `out_shape` and is written in
+        place, otherwise a new buffer is allocated.
+        """
+        if output is None:
+            output = Array.empty(self.out_shape, np.float32)
+        self._c_function(data, output)
         return output
 
 
-class Im2Col(LazySpecializedFunction):
+class Im2Col(Specializer):
     def __init__(self, kernel_size, stride, padding):
         super(Im2Col, self).__init__(C.Constant(0))
         self.kernel_h, self.kernel_w = kernel_size
@@ -28,12 +34,37 @@ class Im2Col(LazySpecializedFunction):
 
     def args_to_subconfig(self, args):
         A = args[0]
-        return (A.shape, np.ctypeslib.ndpointer(A.dtype, A.ndim, A.shape))
+        # The geometry is part of the config so that two instances with
+        # different kernels never share a compiled variant.
+        return (A.shape, np.ctypeslib.ndpointer(A.dtype, A.ndim, A.shape),
+                (self.kernel_h, self.kernel_w, self.stride_h, self.stride_w,
+                 self.pad_h, self.pad_w))
 
-    def transform(self, tree, program_cfg):
-        arg_cfg, tune_cfg = program_cfg
-        channels, height, width = arg_cfg[0]
-        cfg = {
+    def col_shape(self, shape):
+        """
+        Shape of the column buffer for an input of `shape`, either a single
+        image (channels, height, width) or a batch (num, channels, height,
+        width).  The columns of a batch are laid out image after image so a
+        single GEMM covers the whole batch.
+        """
+        if len(shape) == 3:
+            num, (channels, height, width) = 1, shape
+        else:
+            num, channels, height, width = shape
+        height_col = (height + 2 * self.pad_h - self.kernel_h) // \
+            self.stride_h + 1
+        width_col = (width + 2 * self.pad_w - self.kernel_w) // \
+            self.stride_w + 1
+        return (channels * self.kernel_h * self.kernel_w,
+                num * height_col * width_col)
+
+    def template_cfg(self, shape):
+        if len(shape) == 3:
+            num, (channels, height, width) = 1, shape
+        else:
+            num, channels, height, width = shape
+        return {
+            'num': C.Constant(num),
             'pad_h': C.Constant(self.pad_h),
             'pad_w': C.Constant(self.pad_w),
             'stride_h': C.Constant(self.stride_h),
@@ -44,6 +75,10 @@ class Im2Col(LazySpecializedFunction):
             'height': C.Constant(height),
             'width': C.Constant(width),
         }
+
+    def transform(self, tree, program_cfg):
+        arg_cfg, tune_cfg = program_cfg
+        cfg = self.template_cfg(arg_cfg[0])
         im2col = C.FunctionDecl(
             None,
             C.SymbolRef("im2col"),
@@ -56,6 +91,7 @@ int pad_h = $pad_h;
 int pad_w = $pad_w;
 int kernel_h = $kernel_h;
 int kernel_w = $kernel_w;
+int num = $num;
 int channels = $channels;
 int height = $height;
 int width = $width;
@@ -66,15 +102,21 @@ for (int c = 0; c < channels_col; ++c) {
     int w_offset = c % kernel_w;
     int h_offset = (c / kernel_w) % kernel_h;
     int c_im = c / kernel_h / kernel_w;
-    for (int h = 0; h < height_col; ++h) {
-        for (int w = 0; w < width_col; ++w) {
-            int h_pad = h * stride_h - pad_h + h_offset;
-            int w_pad = w * stride_w - pad_w + w_offset;
-            if (h_pad >= 0 && h_pad < height && w_pad >= 0 && w_pad < width)
-            data_col[(c * height_col + h) * width_col + w] =
-                data_im[(c_im * height + h_pad) * width + w_pad];
-            else
-                data_col[(c * height_col + h) * width_col + w] = 0;
+    for (int n = 0; n < num; ++n) {
+        for (int h = 0; h < height_col; ++h) {
+            for (int w = 0; w < width_col; ++w) {
+                int h_pad = h * stride_h - pad_h + h_offset;
+                int w_pad = w * stride_w - pad_w + w_offset;
+                if (h_pad >= 0 && h_pad < height &&
+                        w_pad >= 0 && w_pad < width)
+                    data_col[((c * num + n) * height_col + h) * width_col +
+                             w] =
+                        data_im[((n * channels + c_im) * height + h_pad) *
+                                width + w_pad];
+                else
+                    data_col[((c * num + n) * height_col + h) * width_col +
+                             w] = 0;
+            }
         }
     }
 } """, cfg)])
@@ -83,13 +125,106 @@ for (int c = 0; c < channels_col; ++c) {
     def finalize(self, files, program_cfg):
         arg_cfg, tune_cfg = program_cfg
         proj = Project(files)
-        channels, height, width = arg_cfg[0]
-        height_col = (height + 2 * self.pad_h - self.kernel_h) // \
-            self.stride_h + 1
-        width_col = (width + 2 * self.pad_w - self.kernel_w) // \
-            self.stride_w + 1
-        out_shape = (channels * self.kernel_h * self.kernel_w, height_col *
-                     width_col)
+        out_shape = self.col_shape(arg_cfg[0])
         out_ptr = np.ctypeslib.ndpointer(arg_cfg[1]._dtype_, 2, out_shape)
         entry_type = ct.CFUNCTYPE(None, arg_cfg[1], out_ptr)
         return ConcreteIm2Col('im2col', proj, entry_type, out_shape)
+
+
+class ParallelIm2Col(Im2Col):
+    """
+    OpenMP variant of Im2Col.  Rows of the column buffer (channels_col) are
+    split across threads.  For every row the range of output columns that
+    maps inside the image is computed once, so the interior is copied
+    without bounds checks (with memcpy when stride_w == 1) and only the
+    border is zero filled.
+
+    num_threads == 0 leaves the thread count to the OpenMP runtime.
+    """
+    def __init__(self, kernel_size, stride, padding, num_threads=0):
+        super(ParallelIm2Col, self).__init__(kernel_size, stride, padding)
+        self.num_threads = num_threads
+
+    def args_to_subconfig(self, args):
+        return super(ParallelIm2Col, self).args_to_subconfig(args) + \
+            (self.num_threads, )
+
+    def transform(self, tree, program_cfg):
+        arg_cfg, tune_cfg = program_cfg
+        cfg = self.template_cfg(arg_cfg[0])
+        cfg['pragma'] = omp_parallel_for(self.num_threads)
+        im2col = C.FunctionDecl(
+            None,
+            C.SymbolRef("im2col"),
+            [C.SymbolRef("data_im", arg_cfg[1]()),
+             C.SymbolRef("data_col", arg_cfg[1]())],
+            [StringTemplate("""
+int stride_h = $stride_h;
+int stride_w = $stride_w;
+int pad_h = $pad_h;
+int pad_w = $pad_w;
+int kernel_h = $kernel_h;
+int kernel_w = $kernel_w;
+int num = $num;
+int channels = $channels;
+int height = $height;
+int width = $width;
+int height_col = (height + 2 * pad_h - kernel_h) / stride_h + 1;
+int width_col = (width + 2 * pad_w - kernel_w) / stride_w + 1;
+int channels_col = channels * kernel_h * kernel_w;
+$pragma
+for (int c = 0; c < channels_col; ++c) {
+    int w_offset = c % kernel_w;
+    int h_offset = (c / kernel_w) % kernel_h;
+    int c_im = c / kernel_h / kernel_w;
+    // Output columns [w_start, w_end) read from inside the image.
+    int w_start = pad_w > w_offset ?
+        (pad_w - w_offset + stride_w - 1) / stride_w : 0;
+    int w_end = width + pad_w - w_offset > 0 ?
+        (width + pad_w - w_offset + stride_w - 1) / stride_w : 0;
+    if (w_end > width_col)
+        w_end = width_col;
+    if (w_start > w_end)
+        w_start = w_end;
+    for (int n = 0; n < num; ++n) {
+        for (int h = 0; h < height_col; ++h) {
+            int h_pad = h * stride_h - pad_h + h_offset;
+            int col_offset = ((c * num + n) * height_col + h) * width_col;
+            if (h_pad < 0 || h_pad >= height) {
+                memset(data_col + col_offset, 0,
+                       width_col * sizeof(*data_col));
+                continue;
+            }
+            for (int w = 0; w < w_start; ++w)
+                data_col[col_offset + w] = 0;
+            if (w_end > w_start) {
+                int im_offset = ((n * channels + c_im) * height + h_pad) *
+                    width + w_start * stride_w - pad_w + w_offset;
+                if (stride_w == 1) {
+                    memcpy(data_col + col_offset + w_start,
+                           data_im + im_offset,
+                           (w_end - w_start) * sizeof(*data_col));
+                } else {
+                    for (int w = w_start; w < w_end; ++w)
+                        data_col[col_offset + w] =
+                            data_im[im_offset + (w - w_start) * stride_w];
+                }
+            }
+            for (int w = w_end; w < width_col; ++w)
+                data_col[col_offset + w] = 0;
+        }
+    }
+} """, cfg)])
+        return [C.CFile('im2col', [StringTemplate("#include <string.h>"),
+                                   im2col], config_target='omp')]
+
+
+def omp_parallel_for(num_threads):
+    """
+    The `omp parallel for` pragma for a loop, pinned to `num_threads`
+    threads unless it is 0.
+    """
+    pragma = "#pragma omp parallel for"
+    if num_threads:
+        pragma += " num_threads({})".format(num_threads)
+    return StringTemplate(pragma)
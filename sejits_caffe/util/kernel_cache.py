@@ -0,0 +1,220 @@
+"""
+A persistent cache of compiled kernels shared by every process.
+
+Generated C files are compiled once into
+`$SEJITS_CAFFE_KERNEL_CACHE/<key>.so`, where the key hashes the C source,
+the compiler command and the entry point signature, so a warm restart loads
+shared objects instead of invoking the compiler.  The least recently used
+kernels are evicted once the cache grows past
+`$SEJITS_CAFFE_KERNEL_CACHE_SIZE` megabytes.
+
+Only the concrete functions of this package use the cache, see
+sejits_caffe.util.specializer.ConcreteKernel.  It is created on their first
+compilation; setting SEJITS_CAFFE_KERNEL_CACHE to 0 compiles them into a
+temporary directory private to the process instead.  Either way they are
+compiled with ctree's configuration plus `cflags`, which leaves the
+configuration of other ctree users alone.
+"""
+from sejits_caffe.util.profiler import profiler
+import ctree
+import atexit
+import ctypes as ct
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+try:
+    from shlex import quote
+except ImportError:  # pragma: no cover
+    from pipes import quote
+
+
+default_path = os.path.join(os.path.expanduser("~"), ".cache", "sejits_caffe",
+                            "kernels")
+default_size = 256
+
+# No kernel reads errno, and keeping it up to date stops gcc from
+# vectorizing sqrtf and friends.  The very cheap cost model of -O2 leaves
+# out loops that need an epilogue, among them the `omp simd` reductions.
+cflags = "-fno-math-errno -fvect-cost-model=dynamic"
+
+
+def describe_type(arg_type):
+    """
+    A stable description of a ctypes argument type, including the dtype,
+    dimensions and shape of ndpointers.
+    """
+    if arg_type is None:
+        return "void"
+    if hasattr(arg_type, "_dtype_"):
+        return "ndpointer({}, {}, {})".format(
+            arg_type._dtype_, arg_type._ndim_, arg_type._shape_)
+    return arg_type.__name__
+
+
+class KernelCache(object):
+    def __init__(self, path=default_path, max_size=default_size):
+        self.path = path
+        # Bytes
+        self.max_size = max_size * 2 ** 20
+        # key -> loaded library, so a kernel is only loaded once per process
+        self.libraries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, program_text, compile_cmd, entry_type):
+        key = hashlib.sha256(program_text.encode())
+        key.update(compile_cmd.encode())
+        for arg_type in (entry_type._restype_, ) + entry_type._argtypes_:
+            key.update(describe_type(arg_type).encode())
+        return key.hexdigest()
+
+    def compile(self, entry_name, proj, entry_type):
+        """
+        Return the entry point of the single CFile in `proj`, compiling it
+        only if no process compiled the same program before.
+        """
+        cfile = proj.files[0]
+        program_text = cfile.codegen()
+        target = cfile.config_target
+        compile_cmd = "{} -shared {} {} -o {{}} {{}} {}".format(
+            ctree.CONFIG.get(target, "CC"), ctree.CONFIG.get(target, "CFLAGS"),
+            cflags, ctree.CONFIG.get(target, "LDFLAGS"))
+        key = self.key(program_text, compile_cmd, entry_type)
+        if key not in self.libraries:
+            so_file = os.path.join(self.path, key + ".so")
+            library = None
+            if os.path.exists(so_file):
+                try:
+                    # Mark as recently used
+                    os.utime(so_file, None)
+                    library = ct.cdll.LoadLibrary(so_file)
+                    self.hits += 1
+                except OSError:
+                    # Evicted by another process since the check, rebuild
+                    pass
+            if library is None:
+                self.misses += 1
+                for attempt in range(2):
+                    start = profiler.now()
+                    self.build(program_text, compile_cmd, so_file)
+                    if profiler.enabled:
+                        profiler.record("compile", entry_name, start)
+                    self.evict(keep=so_file)
+                    try:
+                        library = ct.cdll.LoadLibrary(so_file)
+                        break
+                    except OSError:
+                        # Evicted by another process since the build,
+                        # rebuild once
+                        if attempt:
+                            raise
+            self.libraries[key] = library
+        func = getattr(self.libraries[key], entry_name)
+        func.argtypes = entry_type._argtypes_
+        func.restype = entry_type._restype_
+        return func
+
+    def build(self, program_text, compile_cmd, so_file):
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # Created by another process in the meantime
+                pass
+        # Build under a temporary name and move it in place at once, so
+        # concurrent processes never load a partial shared object.
+        fd, tmp_src = tempfile.mkstemp(suffix=".c", dir=self.path)
+        tmp_so = tmp_src[:-2] + ".so"
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(program_text)
+            subprocess.check_call(
+                compile_cmd.format(quote(tmp_so), quote(tmp_src)), shell=True)
+            os.rename(tmp_so, so_file)
+        finally:
+            for tmp in (tmp_src, tmp_so):
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used kernels other than `keep` until the
+        cache fits in `max_size`.
+        """
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith(".so") and \
+                    os.path.join(self.path, name) != keep:
+                try:
+                    stat = os.stat(os.path.join(self.path, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        if keep is not None:
+            total += os.path.getsize(keep)
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for name in os.listdir(self.path):
+            if name.endswith(".so"):
+                os.remove(os.path.join(self.path, name))
+        self.libraries = {}
+
+
+# The cache of get_kernel_cache, persistent unless `enabled` is False
+kernel_cache = None
+enabled = os.environ.get("SEJITS_CAFFE_KERNEL_CACHE") != "0"
+
+
+def get_kernel_cache():
+    """
+    The KernelCache the concrete functions of this package compile through,
+    created with the defaults of `enable_kernel_cache` on first use, or in
+    a temporary directory removed at exit if the cache is disabled.
+    """
+    global kernel_cache
+    if kernel_cache is None:
+        if enabled:
+            enable_kernel_cache()
+        else:
+            path = tempfile.mkdtemp(prefix="sejits_caffe_kernels")
+            atexit.register(shutil.rmtree, path, True)
+            kernel_cache = KernelCache(path, float("inf"))
+    return kernel_cache
+
+
+def enable_kernel_cache(path=None, max_size=None):
+    """
+    Compile through a new KernelCache in `path` holding up to `max_size`
+    megabytes, defaulting to $SEJITS_CAFFE_KERNEL_CACHE and
+    $SEJITS_CAFFE_KERNEL_CACHE_SIZE.
+    """
+    global kernel_cache, enabled
+    if path is None:
+        path = os.environ.get("SEJITS_CAFFE_KERNEL_CACHE", default_path)
+    if max_size is None:
+        max_size = float(os.environ.get("SEJITS_CAFFE_KERNEL_CACHE_SIZE",
+                                        default_size))
+    kernel_cache = KernelCache(path, max_size)
+    enabled = True
+    return kernel_cache
+
+
+def disable_kernel_cache():
+    """
+    Compile into a temporary directory private to this process, see
+    get_kernel_cache.
+    """
+    global kernel_cache, enabled
+    kernel_cache = None
+    enabled = False
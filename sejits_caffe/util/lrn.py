@@ -0,0 +1,416 @@
+"""
+Local response normalization over whole (num, channels, height, width)
+blobs.
+
+    scale = k + alpha / size * (sum of the squares in the window)
+    top = bottom * scale ** -beta
+
+Across channels, the windows of consecutive channels overlap in all but
+two channels, so a running sum per (n, h, w) column moves from one to the
+next with an addition and a subtraction.  The columns of an image are
+processed in tiles of consecutive pixels, so that each step is a
+vectorized loop over a row of a channel, and (image, tile) pairs run in
+parallel.
+"""
+import ctree.c.nodes as C
+from ctree.nodes import Project
+from ctree.templates.nodes import StringTemplate
+from sejits_caffe.util.specializer import Specializer, ConcreteKernel
+from sejits_caffe.util.relu import float_literal
+from sejits_caffe.util.fast_math import fast_powf
+import ctypes as ct
+import numpy as np
+
+
+# Pixels per tile, the running sums of a tile stay in L1
+tile_size = 256
+
+
+def power(value, beta):
+    """
+    C expression of value ** -beta, with square roots for the usual betas.
+    """
+    if beta == 0.75:
+        return "1.0f / sqrtf({0} * sqrtf({0}))".format(value)
+    if beta == 0.5:
+        return "1.0f / sqrtf({0})".format(value)
+    if beta == 1:
+        return "1.0f / {0}".format(value)
+    return "fast_powf({0}, {1!r}f)".format(value, -float(beta))
+
+
+class ConcreteLRN(ConcreteKernel):
+    def __init__(self, entry_name, proj, entry_type):
+        self._c_function = self._compile(entry_name, proj, entry_type)
+
+    def __call__(self, *args):
+        self._c_function(*args)
+
+
+class LRNKernel(Specializer):
+    """
+    Base of the LRN kernels, whose arguments are float32 blobs of the
+    same shape: subclasses provide `entry_name`, the `names` and the
+    `body` template for `count` arguments.
+    """
+    entry_name = None
+
+    def __init__(self, size, alpha, beta, k):
+        super(LRNKernel, self).__init__(C.Constant(0))
+        self.size = size
+        self.alpha = alpha
+        self.beta = beta
+        self.k = k
+
+    def args_to_subconfig(self, args):
+        return args[0].shape, len(args), \
+            (self.size, self.alpha, self.beta, self.k)
+
+    def pointer_type(self, shape):
+        return np.ctypeslib.ndpointer(np.float32, len(shape), shape)
+
+    def template_cfg(self, shape):
+        num, channels = shape[:2]
+        spatial = int(np.prod(shape[2:]))
+        return {
+            'num': C.Constant(num),
+            'channels': C.Constant(channels),
+            'spatial': C.Constant(spatial),
+            'tile_size': C.Constant(tile_size),
+            'tiles': C.Constant((spatial + tile_size - 1) // tile_size),
+            'pre_pad': C.Constant((self.size - 1) // 2),
+            'k': float_literal(self.k),
+            'alpha_over_size': float_literal(float(self.alpha) / self.size),
+        }
+
+    def transform(self, tree, program_cfg):
+        arg_cfg, tune_cfg = program_cfg
+        shape, count = arg_cfg[:2]
+        kernel = C.FunctionDecl(
+            None,
+            C.SymbolRef(self.entry_name),
+            [C.SymbolRef(name, self.pointer_type(shape)())
+             for name in self.names(count)],
+            [StringTemplate(self.body(count), self.template_cfg(shape))])
+        return [C.CFile(self.entry_name,
+                        [StringTemplate(fast_powf), kernel],
+                        config_target='omp')]
+
+    def finalize(self, files, program_cfg):
+        arg_cfg, tune_cfg = program_cfg
+        shape, count = arg_cfg[:2]
+        entry_type = ct.CFUNCTYPE(
+            None, *[self.pointer_type(shape) for _ in range(count)])
+        return ConcreteLRN(self.entry_name, Project(files), entry_type)
+
+
+class LRNForward(LRNKernel):
+    """
+    Across channel LRN, called as (bottom, top) or, when training, as
+    (bottom, top, scale) to also keep the scale for backward.
+    """
+    entry_name = "lrn_forward"
+
+    def names(self, count):
+        return ("bottom", "top", "scale")[:count]
+
+    def body(self, count):
+        scale_tile = "float* scale_tile = scale + offset;" \
+            if count == 3 else ""
+        store_scale = "scale_tile[c * $spatial + i] = s;" \
+            if count == 3 else ""
+        return """
+#pragma omp parallel for collapse(2)
+for (int n = 0; n < $num; ++n) {
+  for (int tile = 0; tile < $tiles; ++tile) {
+    int start = tile * $tile_size;
+    int length = $spatial - start < $tile_size ? $spatial - start :
+        $tile_size;
+    long offset = (long) n * $channels * $spatial + start;
+    const float* bottom_tile = bottom + offset;
+    float* top_tile = top + offset;
+    """ + scale_tile + """
+    // The sum of the squares of channels [c - pre_pad, c + pre_pad]
+    float accum[$tile_size];
+    for (int i = 0; i < length; ++i)
+      accum[i] = 0.0f;
+    for (int c = 0; c < $pre_pad && c < $channels; ++c) {
+      const float* head = bottom_tile + c * $spatial;
+      #pragma omp simd
+      for (int i = 0; i < length; ++i)
+        accum[i] += head[i] * head[i];
+    }
+    for (int c = 0; c < $channels; ++c) {
+      if (c + $pre_pad < $channels) {
+        const float* head = bottom_tile + (c + $pre_pad) * $spatial;
+        #pragma omp simd
+        for (int i = 0; i < length; ++i)
+          accum[i] += head[i] * head[i];
+      }
+      if (c - $pre_pad > 0) {
+        const float* tail = bottom_tile + (c - $pre_pad - 1) * $spatial;
+        #pragma omp simd
+        for (int i = 0; i < length; ++i)
+          accum[i] -= tail[i] * tail[i];
+      }
+      const float* in = bottom_tile + c * $spatial;
+      float* out = top_tile + c * $spatial;
+      #pragma omp simd
+      for (int i = 0; i < length; ++i) {
+        float s = $k + $alpha_over_size * accum[i];
+        """ + store_scale + """
+        out[i] = in[i] * """ + power("s", self.beta) + """;
+      }
+    }
+  }
+} """
+
+
+class LRNBackward(LRNKernel):
+    """
+    The gradient of LRNForward, called as
+    (bottom, top, scale, top_diff, bottom_diff) with the scale kept by the
+    forward pass:
+
+        bottom_diff = top_diff * scale ** -beta - 2 * alpha * beta / size *
+            bottom * (sum of top_diff * top / scale in the window)
+
+    The ratios top_diff * top / scale of the window are kept in a ring of
+    `size` rows per tile, so each is computed once.
+    """
+    entry_name = "lrn_backward"
+
+    def names(self, count):
+        return "bottom", "top", "scale", "top_diff", "bottom_diff"
+
+    def template_cfg(self, shape):
+        cfg = super(LRNBackward, self).template_cfg(shape)
+        cfg['size'] = C.Constant(self.size)
+        cfg['cache_ratio'] = float_literal(
+            2.0 * self.alpha * self.beta / self.size)
+        return cfg
+
+    def body(self, count):
+        return """
+#pragma omp parallel for collapse(2)
+for (int n = 0; n < $num; ++n) {
+  for (int tile = 0; tile < $tiles; ++tile) {
+    int start = tile * $tile_size;
+    int length = $spatial - start < $tile_size ? $spatial - start :
+        $tile_size;
+    long offset = (long) n * $channels * $spatial + start;
+    const float* bottom_tile = bottom + offset;
+    const float* top_tile = top + offset;
+    const float* scale_tile = scale + offset;
+    const float* top_diff_tile = top_diff + offset;
+    float* bottom_diff_tile = bottom_diff + offset;
+    // The ratio of channel c is in row c % size while in the window
+    float ratio[$size][$tile_size];
+    float accum[$tile_size];
+    for (int i = 0; i < length; ++i)
+      accum[i] = 0.0f;
+    for (int c = 0; c < $pre_pad && c < $channels; ++c) {
+      long row = c * $spatial;
+      float* ratio_row = ratio[c % $size];
+      #pragma omp simd
+      for (int i = 0; i < length; ++i) {
+        ratio_row[i] = top_diff_tile[row + i] * top_tile[row + i] /
+            scale_tile[row + i];
+        accum[i] += ratio_row[i];
+      }
+    }
+    for (int c = 0; c < $channels; ++c) {
+      // The tail leaves the window before the head takes its row
+      if (c - $pre_pad > 0) {
+        const float* tail = ratio[(c - $pre_pad - 1) % $size];
+        #pragma omp simd
+        for (int i = 0; i < length; ++i)
+          accum[i] -= tail[i];
+      }
+      if (c + $pre_pad < $channels) {
+        long row = (c + $pre_pad) * $spatial;
+        float* head = ratio[(c + $pre_pad) % $size];
+        #pragma omp simd
+        for (int i = 0; i < length; ++i) {
+          head[i] = top_diff_tile[row + i] * top_tile[row + i] /
+              scale_tile[row + i];
+          accum[i] += head[i];
+        }
+      }
+      long row = c * $spatial;
+      #pragma omp simd
+      for (int i = 0; i < length; ++i) {
+        float s = scale_tile[row + i];
+        bottom_diff_tile[row + i] = top_diff_tile[row + i] * """ + \
+            power("s", self.beta) + """ -
+            $cache_ratio * bottom_tile[row + i] * accum[i];
+      }
+    }
+  }
+} """
+
+
+class WithinChannelLRN(LRNKernel):
+    """
+    Base of the within channel kernels, where the window is a size x size
+    square of a plane and, as in Caffe, scale = 1 + alpha / size ** 2 *
+    (sum of the squares in the window): k is not used and the padding
+    counts towards the size of the window.
+
+    The box sums are separable: every row of a plane keeps, for each
+    column, the running sum of the rows in the window, vectorized over
+    the row, and a running sum along that row gives the box sum of every
+    pixel.  Planes run in parallel.
+    """
+    def template_cfg(self, shape):
+        cfg = super(WithinChannelLRN, self).template_cfg(shape)
+        cfg['planes'] = C.Constant(shape[0] * shape[1])
+        cfg['height'] = C.Constant(shape[2])
+        cfg['width'] = C.Constant(shape[3])
+        cfg['size'] = C.Constant(self.size)
+        cfg['alpha_over_size'] = float_literal(
+            float(self.alpha) / self.size ** 2)
+        cfg['cache_ratio'] = float_literal(
+            2.0 * self.alpha * self.beta / self.size ** 2)
+        return cfg
+
+    # Inside the loop over the rows h: the box sums of row h, into box_row,
+    # from the column sums of the rows in its window.
+    box_sum = """
+      float acc = 0.0f;
+      for (int w = 0; w < $pre_pad && w < $width; ++w)
+        acc += column[w];
+      for (int w = 0; w < $width; ++w) {
+        if (w + $pre_pad < $width)
+          acc += column[w + $pre_pad];
+        if (w - $pre_pad > 0)
+          acc -= column[w - $pre_pad - 1];
+        box_row[w] = acc;
+      }"""
+
+
+class WithinChannelLRNForward(WithinChannelLRN):
+    """
+    Within channel LRN, called as (bottom, top) or, when training, as
+    (bottom, top, scale) to also keep the scale for backward.
+    """
+    entry_name = "within_channel_lrn_forward"
+
+    def names(self, count):
+        return ("bottom", "top", "scale")[:count]
+
+    def body(self, count):
+        scale_plane = "float* scale_plane = scale + offset;" \
+            if count == 3 else ""
+        store_scale = "scale_plane[h * $width + w] = s;" \
+            if count == 3 else ""
+        return """
+#pragma omp parallel for
+for (int plane = 0; plane < $planes; ++plane) {
+  long offset = (long) plane * $height * $width;
+  const float* bottom_plane = bottom + offset;
+  float* top_plane = top + offset;
+  """ + scale_plane + """
+  // The sums of the squares of rows [h - pre_pad, h + pre_pad]
+  float column[$width];
+  float box_row[$width];
+  for (int w = 0; w < $width; ++w)
+    column[w] = 0.0f;
+  for (int h = 0; h < $pre_pad && h < $height; ++h) {
+    const float* head = bottom_plane + h * $width;
+    #pragma omp simd
+    for (int w = 0; w < $width; ++w)
+      column[w] += head[w] * head[w];
+  }
+  for (int h = 0; h < $height; ++h) {
+    if (h + $pre_pad < $height) {
+      const float* head = bottom_plane + (h + $pre_pad) * $width;
+      #pragma omp simd
+      for (int w = 0; w < $width; ++w)
+        column[w] += head[w] * head[w];
+    }
+    if (h - $pre_pad > 0) {
+      const float* tail = bottom_plane + (h - $pre_pad - 1) * $width;
+      #pragma omp simd
+      for (int w = 0; w < $width; ++w)
+        column[w] -= tail[w] * tail[w];
+    }
+""" + self.box_sum + """
+    #pragma omp simd
+    for (int w = 0; w < $width; ++w) {
+      float s = 1.0f + $alpha_over_size * box_row[w];
+      """ + store_scale + """
+      top_plane[h * $width + w] = bottom_plane[h * $width + w] * """ + \
+            power("s", self.beta) + """;
+    }
+  }
+} """
+
+
+class WithinChannelLRNBackward(WithinChannelLRN):
+    """
+    The gradient of WithinChannelLRNForward, called as
+    (bottom, top, scale, top_diff, bottom_diff): as across channels, with
+    the box sums of top_diff * top / scale, whose rows in the window are
+    kept in a ring of `size` rows.
+    """
+    entry_name = "within_channel_lrn_backward"
+
+    def names(self, count):
+        return "bottom", "top", "scale", "top_diff", "bottom_diff"
+
+    def body(self, count):
+        return """
+#pragma omp parallel for
+for (int plane = 0; plane < $planes; ++plane) {
+  long offset = (long) plane * $height * $width;
+  const float* bottom_plane = bottom + offset;
+  const float* top_plane = top + offset;
+  const float* scale_plane = scale + offset;
+  const float* top_diff_plane = top_diff + offset;
+  float* bottom_diff_plane = bottom_diff + offset;
+  // The ratios of row h are in row h % size while in the window
+  float ratio[$size][$width];
+  float column[$width];
+  float box_row[$width];
+  for (int w = 0; w < $width; ++w)
+    column[w] = 0.0f;
+  for (int h = 0; h < $pre_pad && h < $height; ++h) {
+    long row = h * $width;
+    float* ratio_row = ratio[h % $size];
+    #pragma omp simd
+    for (int w = 0; w < $width; ++w) {
+      ratio_row[w] = top_diff_plane[row + w] * top_plane[row + w] /
+          scale_plane[row + w];
+      column[w] += ratio_row[w];
+    }
+  }
+  for (int h = 0; h < $height; ++h) {
+    // The tail leaves the window before the head takes its row
+    if (h - $pre_pad > 0) {
+      const float* tail = ratio[(h - $pre_pad - 1) % $size];
+      #pragma omp simd
+      for (int w = 0; w < $width; ++w)
+        column[w] -= tail[w];
+    }
+    if (h + $pre_pad < $height) {
+      long row = (h + $pre_pad) * $width;
+      float* head = ratio[(h + $pre_pad) % $size];
+      #pragma omp simd
+      for (int w = 0; w < $width; ++w) {
+        head[w] = top_diff_plane[row + w] * top_plane[row + w] /
+            scale_plane[row + w];
+        column[w] += head[w];
+      }
+    }
+""" + self.box_sum + """
+    long row = h * $width;
+    #pragma omp simd
+    for (int w = 0; w < $width; ++w) {
+      float s = scale_plane[row + w];
+      bottom_diff_plane[row + w] = top_diff_plane[row + w] * """ + \
+            power("s", self.beta) + """ -
+          $cache_ratio * bottom_plane[row + w] * box_row[w];
+    }
+  }
+} """
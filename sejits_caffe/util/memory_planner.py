@@ -0,0 +1,71 @@
+"""
+Blob memory planning for inference.
+
+Once a blob has been read by its last consumer its memory can hold another
+blob, so instead of one allocation per blob the net only needs a few arenas
+sized for the blobs that are alive at the same time.
+"""
+
+
+def blob_lifetimes(steps, outputs=()):
+    """
+    The (first, last) step of every blob, where `steps` lists the
+    (bottom names, top names) of each layer in execution order.  Blobs in
+    `outputs` are read after the last step, so they live until the end.
+    """
+    lifetimes = {}
+    for index, (bottom, top) in enumerate(steps):
+        for blob in list(bottom) + list(top):
+            first, last = lifetimes.get(blob, (index, index))
+            lifetimes[blob] = first, index
+    for blob in outputs:
+        first, last = lifetimes[blob]
+        lifetimes[blob] = first, len(steps)
+    return lifetimes
+
+
+def plan_blobs(steps, sizes, outputs=(), in_place=()):
+    """
+    Assign every blob to an arena so that blobs whose lifetimes overlap
+    never share one.
+
+    `sizes` maps blob names to their number of elements.  The steps in
+    `in_place` compute their single top elementwise from their single
+    bottom, so the top may reuse the memory of a bottom that dies there.
+
+    Returns the size of every arena and the arena of every blob.
+    """
+    lifetimes = blob_lifetimes(steps, outputs)
+    arena_sizes = []
+    free = []
+    assignment = {}
+    for index, (bottom, top) in enumerate(steps):
+        for blob in top:
+            if blob in assignment:
+                continue
+            if index in in_place and len(bottom) == 1 and len(top) == 1 \
+                    and lifetimes[bottom[0]][1] == index \
+                    and sizes[bottom[0]] == sizes[blob]:
+                arena = assignment[bottom[0]]
+                # The bottom hands its arena over instead of freeing it
+                lifetimes[bottom[0]] = lifetimes[bottom[0]][0], -1
+            else:
+                # Best fit among the free arenas, growing the largest one if
+                # none is big enough.
+                fits = [arena for arena in free
+                        if arena_sizes[arena] >= sizes[blob]]
+                if fits:
+                    arena = min(fits, key=lambda a: arena_sizes[a])
+                elif free:
+                    arena = max(free, key=lambda a: arena_sizes[a])
+                    arena_sizes[arena] = sizes[blob]
+                else:
+                    arena = len(arena_sizes)
+                    arena_sizes.append(sizes[blob])
+                if arena in free:
+                    free.remove(arena)
+            assignment[blob] = arena
+        for blob in set(list(bottom) + list(top)):
+            if lifetimes[blob][1] == index:
+                free.append(assignment[blob])
+    return arena_sizes, assignment
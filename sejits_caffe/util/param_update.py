@@ -0,0 +1,105 @@
+import ctree.c.nodes as C
+from ctree.nodes import Project
+from ctree.templates.nodes import StringTemplate
+from sejits_caffe.util.specializer import Specializer, ConcreteKernel
+import ctypes as ct
+import sejits_caffe.caffe_pb2 as caffe_pb2
+import numpy as np
+
+
+# Gradient term added by weight decay, per regularization_type
+regularizers = {
+    "L2": "decay * data[i]",
+    "L1": "decay * ((data[i] > 0) - (data[i] < 0))",
+}
+
+# History and parameter update, per solver_type.  These follow Caffe's
+# SGDSolver, NesterovSolver and AdaGradSolver.
+updates = {
+    caffe_pb2.SolverParameter.SGD: """
+history[i] = $momentum * history[i] + rate * grad;
+data[i] -= history[i];""",
+    caffe_pb2.SolverParameter.NESTEROV: """
+float history_prev = history[i];
+history[i] = $momentum * history_prev + rate * grad;
+data[i] -= (1 + $momentum) * history[i] - $momentum * history_prev;""",
+    caffe_pb2.SolverParameter.ADAGRAD: """
+history[i] += grad * grad;
+data[i] -= rate * grad / (sqrtf(history[i]) + $delta);""",
+}
+
+
+class ConcreteParamUpdate(ConcreteKernel):
+    def __init__(self, entry_name, proj, entry_type):
+        self._c_function = self._compile(entry_name, proj, entry_type)
+
+    def __call__(self, data, diff, history, rate, decay, diff_scale=1.0):
+        self._c_function(data, diff, history, rate, decay, diff_scale)
+
+
+class ParamUpdate(Specializer):
+    """
+    Applies one solver step to a parameter blob in a single pass:
+
+        grad = diff_scale * diff + decay * regularizer(data)
+
+    followed by the history/data update of the solver type, all in place in
+    `data` and `history`.  `rate` and `decay` are runtime arguments (the
+    learning rate policy and the per blob lr_mult/decay_mult change them),
+    so one compiled variant serves every iteration.
+    """
+    def __init__(self, solver_type=caffe_pb2.SolverParameter.SGD,
+                 momentum=0.0, delta=1e-8, regularization_type="L2"):
+        super(ParamUpdate, self).__init__(C.Constant(0))
+        if solver_type not in updates:
+            raise NotImplementedError(
+                "Unknown solver type {}".format(solver_type))
+        if regularization_type not in regularizers:
+            raise NotImplementedError(
+                "Unknown regularization type {}".format(regularization_type))
+        self.solver_type = solver_type
+        self.momentum = momentum
+        self.delta = delta
+        self.regularization_type = regularization_type
+
+    def args_to_subconfig(self, args):
+        A = args[0]
+        return (A.shape, np.ctypeslib.ndpointer(A.dtype, A.ndim, A.shape),
+                (self.solver_type, self.momentum, self.delta,
+                 self.regularization_type))
+
+    def transform(self, tree, program_cfg):
+        arg_cfg, tune_cfg = program_cfg
+        cfg = {
+            'count': C.Constant(int(np.prod(arg_cfg[0]))),
+            'regularizer': StringTemplate(
+                regularizers[self.regularization_type]),
+            'update': StringTemplate(updates[self.solver_type], {
+                'momentum': C.Constant(self.momentum),
+                'delta': C.Constant(self.delta),
+            }),
+        }
+        update = C.FunctionDecl(
+            None,
+            C.SymbolRef("param_update"),
+            [C.SymbolRef("data", arg_cfg[1]()),
+             C.SymbolRef("diff", arg_cfg[1]()),
+             C.SymbolRef("history", arg_cfg[1]()),
+             C.SymbolRef("rate", ct.c_float()),
+             C.SymbolRef("decay", ct.c_float()),
+             C.SymbolRef("diff_scale", ct.c_float())],
+            [StringTemplate("""
+#pragma omp parallel for if($count > 65536)
+for (int i = 0; i < $count; ++i) {
+    float grad = diff_scale * diff[i] + $regularizer;
+    $update
+} """, cfg)])
+        return [C.CFile('param_update', [StringTemplate("#include <math.h>"),
+                                         update], config_target='omp')]
+
+    def finalize(self, files, program_cfg):
+        arg_cfg, tune_cfg = program_cfg
+        proj = Project(files)
+        entry_type = ct.CFUNCTYPE(None, arg_cfg[1], arg_cfg[1], arg_cfg[1],
+                                  ct.c_float, ct.c_float, ct.c_float)
+        return ConcreteParamUpdate('param_update', proj, entry_type)
@@ -0,0 +1,376 @@
+"""
+Pooling kernels over whole (num, channels, height, width) blobs.
+
+Every kernel is a single call parallelized over the num * channels planes,
+which are independent, with the window geometry of Caffe: windows start at
+-pad and are clipped to the image.
+"""
+import ctree.c.nodes as C
+from ctree.nodes import Project
+from ctree.templates.nodes import StringTemplate
+from sejits_caffe.util.specializer import Specializer, ConcreteKernel
+from ctree.types import codegen_type
+import ctypes as ct
+import numpy as np
+
+
+# Loops over the pooled outputs of a plane, with the clipped window
+# [hstart, hend) x [wstart, wend) of the output `ph * $pooled_width + pw`
+# in the bottom plane, around `$window`.  The ends are only clipped to
+# $height_end and $width_end: the image, or the padding for averages.
+windows = """
+  for (int ph = 0; ph < $pooled_height; ++ph) {
+    for (int pw = 0; pw < $pooled_width; ++pw) {
+      // The window bodies clip these in place
+      int hstart = ph * $stride_h - $pad_h;
+      int hend = hstart + $kernel_h < $height_end ?
+          hstart + $kernel_h : $height_end;
+      int wstart = pw * $stride_w - $pad_w;
+      int wend = wstart + $kernel_w < $width_end ?
+          wstart + $kernel_w : $width_end;
+      $window
+    }
+  } """
+
+# Clips a window to the image
+clip = """
+      int pool_size = (hend - hstart) * (wend - wstart);
+      hstart = hstart > 0 ? hstart : 0;
+      wstart = wstart > 0 ? wstart : 0;
+      hend = hend < $height ? hend : $height;
+      wend = wend < $width ? wend : $width;
+"""
+
+
+class ConcretePool(ConcreteKernel):
+    def __init__(self, entry_name, proj, entry_type):
+        self._c_function = self._compile(entry_name, proj, entry_type)
+
+    def __call__(self, *args):
+        self._c_function(*args)
+
+
+class PoolKernel(Specializer):
+    """
+    Base of the pooling kernels over blobs of any one dtype: subclasses
+    provide `entry_name`, the `names` of their `count` arguments, which
+    of them are the `bottom_and_top` blobs and the `body` template, which
+    sees the geometry below, `$type`, the C element type, and `$windows`,
+    the loops around the subclass' `window`.
+    """
+    entry_name = None
+    bottom_and_top = (0, 1)
+
+    def __init__(self, kernel_size, padding=(0, 0), stride=(1, 1)):
+        super(PoolKernel, self).__init__(C.Constant(0))
+        self.kernel_h, self.kernel_w = kernel_size
+        self.pad_h, self.pad_w = padding
+        self.stride_h, self.stride_w = stride
+
+    def args_to_subconfig(self, args):
+        return tuple((arg.shape, arg.dtype.str) for arg in args), \
+            (self.kernel_h, self.kernel_w, self.pad_h, self.pad_w,
+             self.stride_h, self.stride_w)
+
+    def geometry(self, bottom_shape, top_shape):
+        num, channels, height, width = bottom_shape
+        return {
+            'planes': C.Constant(num * channels),
+            'height': C.Constant(height),
+            'width': C.Constant(width),
+            'size': C.Constant(height * width),
+            'height_end': C.Constant(height),
+            'width_end': C.Constant(width),
+            'pooled_height': C.Constant(top_shape[2]),
+            'pooled_width': C.Constant(top_shape[3]),
+            'pooled_size': C.Constant(top_shape[2] * top_shape[3]),
+            'kernel_h': C.Constant(self.kernel_h),
+            'kernel_w': C.Constant(self.kernel_w),
+            'pad_h': C.Constant(self.pad_h),
+            'pad_w': C.Constant(self.pad_w),
+            'stride_h': C.Constant(self.stride_h),
+            'stride_w': C.Constant(self.stride_w),
+        }
+
+    def pointer_types(self, arg_cfg):
+        return [np.ctypeslib.ndpointer(np.dtype(dtype), len(shape), shape)
+                for shape, dtype in arg_cfg[0]]
+
+    def transform(self, tree, program_cfg):
+        arg_cfg, tune_cfg = program_cfg
+        shapes = [shape for shape, _ in arg_cfg[0]]
+        bottom, top = self.bottom_and_top
+        cfg = self.geometry(shapes[bottom], shapes[top])
+        cfg['type'] = StringTemplate(codegen_type(
+            np.dtype(arg_cfg[0][bottom][1]).type()))
+        body = self.body(len(shapes)).replace("$windows", windows) \
+            .replace("$window", self.window(len(shapes)))
+        kernel = C.FunctionDecl(
+            None,
+            C.SymbolRef(self.entry_name),
+            [C.SymbolRef(name, pointer())
+             for name, pointer in zip(self.names(len(shapes)),
+                                      self.pointer_types(arg_cfg))],
+            [StringTemplate(body, cfg)])
+        return [C.CFile(self.entry_name, [kernel], config_target='omp')]
+
+    def window(self, count):
+        return ""
+
+    def finalize(self, files, program_cfg):
+        arg_cfg, tune_cfg = program_cfg
+        entry_type = ct.CFUNCTYPE(None, *self.pointer_types(arg_cfg))
+        return ConcretePool(self.entry_name, Project(files), entry_type)
+
+
+class MaxPool(PoolKernel):
+    """
+    Max pooling, called as (bottom, top) or, when training, as
+    (bottom, top, mask) to also record the argmax of every output as its
+    offset in the bottom plane.  Top (and mask) are fully overwritten.
+    """
+    entry_name = "max_pool"
+
+    def names(self, count):
+        return ("bottom", "top", "mask")[:count]
+
+    def body(self, count):
+        mask_plane = "int* mask_plane = mask + plane * $pooled_size;" \
+            if count == 3 else ""
+        return """
+#pragma omp parallel for
+for (int plane = 0; plane < $planes; ++plane) {
+  const $type* bottom_plane = bottom + plane * $size;
+  $type* top_plane = top + plane * $pooled_size;
+  """ + mask_plane + """
+  $windows
+} """
+
+    def window(self, count):
+        store_mask = "mask_plane[ph * $pooled_width + pw] = index;" \
+            if count == 3 else ""
+        return """
+      hstart = hstart > 0 ? hstart : 0;
+      wstart = wstart > 0 ? wstart : 0;
+      // Windows are never empty since pad < kernel size
+      int index = hstart * $width + wstart;
+      $type value = bottom_plane[index];
+      for (int h = hstart; h < hend; ++h) {
+        for (int w = wstart; w < wend; ++w) {
+          if (bottom_plane[h * $width + w] > value) {
+            index = h * $width + w;
+            value = bottom_plane[index];
+          }
+        }
+      }
+      top_plane[ph * $pooled_width + pw] = value;
+      """ + store_mask
+
+
+class MaxPoolBackward(PoolKernel):
+    """
+    The gradient of MaxPool (and of StochasticPool), called as
+    (top_diff, mask, bottom_diff): each plane of bottom_diff is cleared,
+    then receives the top diffs at their mask offsets.
+    """
+    entry_name = "max_pool_backward"
+    bottom_and_top = (2, 0)
+
+    def names(self, count):
+        return "top_diff", "mask", "bottom_diff"
+
+    def body(self, count):
+        return """
+#pragma omp parallel for
+for (int plane = 0; plane < $planes; ++plane) {
+  const $type* top_diff_plane = top_diff + plane * $pooled_size;
+  const int* mask_plane = mask + plane * $pooled_size;
+  $type* bottom_diff_plane = bottom_diff + plane * $size;
+  for (int i = 0; i < $size; ++i)
+    bottom_diff_plane[i] = 0;
+  for (int i = 0; i < $pooled_size; ++i)
+    bottom_diff_plane[mask_plane[i]] += top_diff_plane[i];
+} """
+
+
+class AvePool(PoolKernel):
+    """
+    Average pooling, called as (bottom, top).  As in Caffe, the padding
+    counts towards the size of the windows that overlap it.
+    """
+    entry_name = "ave_pool"
+
+    def names(self, count):
+        return "bottom", "top"
+
+    def geometry(self, bottom_shape, top_shape):
+        cfg = super(AvePool, self).geometry(bottom_shape, top_shape)
+        cfg['height_end'] = C.Constant(bottom_shape[2] + self.pad_h)
+        cfg['width_end'] = C.Constant(bottom_shape[3] + self.pad_w)
+        return cfg
+
+    def body(self, count):
+        return """
+#pragma omp parallel for
+for (int plane = 0; plane < $planes; ++plane) {
+  const $type* bottom_plane = bottom + plane * $size;
+  $type* top_plane = top + plane * $pooled_size;
+  $windows
+} """
+
+    def window(self, count):
+        return clip + """
+      $type sum = 0;
+      for (int h = hstart; h < hend; ++h)
+        for (int w = wstart; w < wend; ++w)
+          sum += bottom_plane[h * $width + w];
+      top_plane[ph * $pooled_width + pw] = sum / pool_size;
+"""
+
+
+class AvePoolBackward(AvePool):
+    """
+    The gradient of AvePool, called as (top_diff, bottom_diff): each plane
+    of bottom_diff is cleared, then receives an equal share of the diff of
+    every window covering it.
+    """
+    entry_name = "ave_pool_backward"
+    bottom_and_top = (1, 0)
+
+    def names(self, count):
+        return "top_diff", "bottom_diff"
+
+    def body(self, count):
+        return """
+#pragma omp parallel for
+for (int plane = 0; plane < $planes; ++plane) {
+  const $type* top_diff_plane = top_diff + plane * $pooled_size;
+  $type* bottom_diff_plane = bottom_diff + plane * $size;
+  for (int i = 0; i < $size; ++i)
+    bottom_diff_plane[i] = 0;
+  $windows
+} """
+
+    def window(self, count):
+        return clip + """
+      $type diff = top_diff_plane[ph * $pooled_width + pw] / pool_size;
+      for (int h = hstart; h < hend; ++h)
+        for (int w = wstart; w < wend; ++w)
+          bottom_diff_plane[h * $width + w] += diff;
+"""
+
+
+class GlobalAvePool(PoolKernel):
+    """
+    The mean of every plane, called as (bottom, top) with a top of shape
+    (num, channels, 1, 1).  Each plane is a single vectorized sum.
+    """
+    entry_name = "global_ave_pool"
+
+    def names(self, count):
+        return "bottom", "top"
+
+    def body(self, count):
+        return """
+#pragma omp parallel for
+for (int plane = 0; plane < $planes; ++plane) {
+  const $type* bottom_plane = bottom + plane * $size;
+  $type sum = 0;
+  #pragma omp simd reduction(+:sum)
+  for (int i = 0; i < $size; ++i)
+    sum += bottom_plane[i];
+  top[plane] = sum / $size;
+} """
+
+
+class GlobalAvePoolBackward(PoolKernel):
+    """
+    The gradient of GlobalAvePool, called as (top_diff, bottom_diff).
+    """
+    entry_name = "global_ave_pool_backward"
+    bottom_and_top = (1, 0)
+
+    def names(self, count):
+        return "top_diff", "bottom_diff"
+
+    def body(self, count):
+        return """
+#pragma omp parallel for
+for (int plane = 0; plane < $planes; ++plane) {
+  $type* bottom_diff_plane = bottom_diff + plane * $size;
+  $type diff = top_diff[plane] / $size;
+  #pragma omp simd
+  for (int i = 0; i < $size; ++i)
+    bottom_diff_plane[i] = diff;
+} """
+
+
+class StochasticPool(PoolKernel):
+    """
+    Stochastic pooling of non-negative activations (Zeiler and Fergus,
+    2013).  When training it is called as (bottom, top, mask, rand), with
+    `rand` uniform in [0, 1) of the shape of top: each output samples an
+    element of its window with probability proportional to its value, and
+    its offset goes to mask as for MaxPool.  At test time, called as
+    (bottom, top), each output is the average of its window weighted by
+    the values themselves.  As in Caffe the padding is ignored.
+    """
+    entry_name = "stochastic_pool"
+
+    def names(self, count):
+        return ("bottom", "top", "mask", "rand")[:count]
+
+    def geometry(self, bottom_shape, top_shape):
+        cfg = super(StochasticPool, self).geometry(bottom_shape, top_shape)
+        cfg['pad_h'] = cfg['pad_w'] = C.Constant(0)
+        return cfg
+
+    def body(self, count):
+        planes = """
+  int* mask_plane = mask + plane * $pooled_size;
+  const float* rand_plane = rand + plane * $pooled_size;""" \
+            if count == 4 else ""
+        return """
+#pragma omp parallel for
+for (int plane = 0; plane < $planes; ++plane) {
+  const $type* bottom_plane = bottom + plane * $size;
+  $type* top_plane = top + plane * $pooled_size;""" + planes + """
+  $windows
+} """
+
+    def window(self, count):
+        if count == 2:
+            return """
+      $type sum = 0, weighted = 0;
+      for (int h = hstart; h < hend; ++h) {
+        for (int w = wstart; w < wend; ++w) {
+          $type value = bottom_plane[h * $width + w];
+          sum += value;
+          weighted += value * value;
+        }
+      }
+      top_plane[ph * $pooled_width + pw] = sum > 0 ? weighted / sum : 0;
+"""
+        return """
+      $type sum = 0;
+      for (int h = hstart; h < hend; ++h)
+        for (int w = wstart; w < wend; ++w)
+          sum += bottom_plane[h * $width + w];
+      $type threshold = rand_plane[ph * $pooled_width + pw] * sum;
+      // Rounding may leave the threshold above the last partial sum
+      int index = (hend - 1) * $width + wend - 1;
+      $type cumulative = 0;
+      int found = 0;
+      for (int h = hstart; h < hend && !found; ++h) {
+        for (int w = wstart; w < wend; ++w) {
+          cumulative += bottom_plane[h * $width + w];
+          if (cumulative >= threshold) {
+            index = h * $width + w;
+            found = 1;
+            break;
+          }
+        }
+      }
+      top_plane[ph * $pooled_width + pw] = bottom_plane[index];
+      mask_plane[ph * $pooled_width + pw] = index;
+"""
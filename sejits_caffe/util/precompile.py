@@ -0,0 +1,42 @@
+"""
+Ahead of time specialization: generate and compile the variant a kernel
+would use for some arguments without running it.
+"""
+from multiprocessing.pool import ThreadPool
+import multiprocessing
+
+
+def kernel(fn, *args):
+    """
+    The (specializer, args) job for a later `fn(*args)`, where `fn` is a
+    sejits_caffe.util.specializer.Specializer.
+    """
+    return fn, args
+
+
+def precompile(specializer, args):
+    """
+    Generate and compile the concrete function `specializer(*args)` will
+    run, which the specializer keeps for that call.
+    """
+    return specializer.specialize(args)
+
+
+def precompile_all(jobs, num_threads=None):
+    """
+    Precompile every (specializer, args) job on a pool of `num_threads`
+    threads (one per core by default).  The compilers run as subprocesses,
+    so the threads compile in parallel.  Returns the number of distinct
+    variants.
+    """
+    unique = {}
+    for specializer, args in jobs:
+        key = id(specializer), specializer.args_to_subconfig(args)
+        unique.setdefault(key, (specializer, args))
+    pool = ThreadPool(num_threads or multiprocessing.cpu_count())
+    try:
+        pool.map(lambda job: precompile(*job), list(unique.values()))
+    finally:
+        pool.close()
+        pool.join()
+    return len(unique)
@@ -0,0 +1,123 @@
+"""
+Structured profiling of nets.
+
+Instrumented code records events into the module level `profiler`, a ring
+buffer that keeps the most recent `capacity` events.  Recording is off by
+default (or on with SEJITS_CAFFE_PROFILE=1) and every call site checks
+`profiler.enabled` first, so a disabled profiler costs one attribute lookup:
+
+    if profiler.enabled:
+        start = profiler.now()
+        layer.forward(...)
+        profiler.record("forward", name, start)
+    else:
+        layer.forward(...)
+
+Events are (category, name, start, duration, nbytes, thread) tuples.  The
+categories used are "forward" and "backward" (per layer wall time),
+"update" (solver update), "compile" (compiler invocations), "kernel"
+(@meta kernels) and "alloc" (bytes of the blobs and buffers allocated).
+"""
+from collections import deque
+import csv
+import json
+import os
+import threading
+import timeit
+
+
+class Profiler(object):
+    def __init__(self, capacity=65536, enabled=False):
+        self.enabled = enabled
+        self.events = deque(maxlen=capacity)
+        self.now = timeit.default_timer
+        self.epoch = self.now()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def clear(self):
+        self.events.clear()
+        self.epoch = self.now()
+
+    def record(self, category, name, start, end=None, nbytes=0):
+        """
+        Record an event that started at `start` (a `now()` timestamp) and
+        ended at `end`, now by default.
+        """
+        if end is None:
+            end = self.now()
+        self.events.append((category, name, start - self.epoch, end - start,
+                            nbytes, threading.current_thread().name))
+
+    def allocated(self, name, nbytes):
+        """
+        Record an allocation of `nbytes`.
+        """
+        self.record("alloc", name, self.now(), nbytes=nbytes)
+
+    def summary(self):
+        """
+        Aggregate the events per (category, name) into their call count,
+        total, mean and max duration in seconds and total bytes.
+        """
+        stats = {}
+        for category, name, start, duration, nbytes, thread in self.events:
+            key = category, name
+            if key not in stats:
+                stats[key] = {"category": category, "name": name, "calls": 0,
+                              "total": 0.0, "max": 0.0, "bytes": 0}
+            entry = stats[key]
+            entry["calls"] += 1
+            entry["total"] += duration
+            entry["max"] = max(entry["max"], duration)
+            entry["bytes"] += nbytes
+        for entry in stats.values():
+            entry["mean"] = entry["total"] / entry["calls"]
+        return sorted(stats.values(),
+                      key=lambda entry: (entry["category"], -entry["total"]))
+
+    def to_json(self, path):
+        """
+        Write the summary and the raw events as JSON.
+        """
+        fields = ("category", "name", "start", "duration", "bytes", "thread")
+        with open(path, "w") as f:
+            json.dump({"summary": self.summary(),
+                       "events": [dict(zip(fields, event))
+                                  for event in self.events]}, f, indent=1)
+
+    def to_csv(self, path):
+        """
+        Write the summary as CSV, one row per (category, name).
+        """
+        fields = ["category", "name", "calls", "total", "mean", "max",
+                  "bytes"]
+        with open(path, "w") as f:
+            writer = csv.DictWriter(f, fields)
+            writer.writeheader()
+            for entry in self.summary():
+                writer.writerow(entry)
+
+    def to_chrome_trace(self, path):
+        """
+        Write the events in the Chrome trace event format, to be opened in
+        chrome://tracing or Perfetto.
+        """
+        pid = os.getpid()
+        events = []
+        for category, name, start, duration, nbytes, thread in self.events:
+            event = {"name": name, "cat": category, "ph": "X",
+                     "ts": start * 1e6, "dur": duration * 1e6, "pid": pid,
+                     "tid": thread}
+            if nbytes:
+                event["args"] = {"bytes": nbytes}
+            events.append(event)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events}, f)
+
+
+profiler = Profiler(enabled=os.environ.get("SEJITS_CAFFE_PROFILE") == "1")
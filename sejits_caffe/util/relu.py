@@ -0,0 +1,106 @@
+"""
+ReLU over whole blobs.
+
+Both kernels make a single parallel, vectorized pass over the flattened
+blob, so a layer costs one call instead of one per (n, c) plane.  They read
+each element before writing it, so they also run in place.  The selects
+are only turned into SIMD blends (rather than branches, which mispredict
+on the random signs of activations) because of `omp ... simd`.
+"""
+import ctree.c.nodes as C
+from ctree.nodes import Project
+from ctree.templates.nodes import StringTemplate
+from sejits_caffe.util.specializer import Specializer, ConcreteKernel
+import ctypes as ct
+import numpy as np
+
+
+# Blobs smaller than this are not worth starting the OpenMP threads for
+parallel_threshold = 1 << 15
+
+
+def float_literal(value):
+    """
+    A float (not double) C constant, so that mixing it with floats does not
+    widen the arithmetic.
+    """
+    return StringTemplate(repr(float(value)) + "f")
+
+
+class ConcreteElementwise(ConcreteKernel):
+    def __init__(self, entry_name, proj, entry_type):
+        self._c_function = self._compile(entry_name, proj, entry_type)
+
+    def __call__(self, *args):
+        self._c_function(*args)
+        return args[-1]
+
+
+class Elementwise(Specializer):
+    """
+    A kernel computing `body` for every index i of its float32 arguments
+    `names`, which all have the same shape.  `$negative_slope` is
+    substituted in the body as a float literal.
+    """
+    names = ()
+    body = ""
+
+    def __init__(self, negative_slope=0.0):
+        super(Elementwise, self).__init__(C.Constant(0))
+        self.negative_slope = negative_slope
+
+    def args_to_subconfig(self, args):
+        return args[0].shape, self.negative_slope
+
+    def pointer_type(self, shape):
+        return np.ctypeslib.ndpointer(np.float32, len(shape), shape)
+
+    def transform(self, tree, program_cfg):
+        arg_cfg, tune_cfg = program_cfg
+        shape = arg_cfg[0]
+        cfg = {
+            'count': C.Constant(int(np.prod(shape))),
+            'threshold': C.Constant(parallel_threshold),
+            'body': StringTemplate(self.body, {
+                'negative_slope': float_literal(self.negative_slope)}),
+        }
+        entry_name = type(self).__name__.lower()
+        kernel = C.FunctionDecl(
+            None,
+            C.SymbolRef(entry_name),
+            [C.SymbolRef(name, self.pointer_type(shape)())
+             for name in self.names],
+            [StringTemplate("""
+#pragma omp parallel for simd if ($count > $threshold)
+for (long i = 0; i < $count; ++i) {
+  $body;
+} """, cfg)])
+        return [C.CFile(entry_name, [kernel], config_target='omp')]
+
+    def finalize(self, files, program_cfg):
+        arg_cfg, tune_cfg = program_cfg
+        shape = arg_cfg[0]
+        entry_type = ct.CFUNCTYPE(
+            None, *[self.pointer_type(shape) for _ in self.names])
+        return ConcreteElementwise(type(self).__name__.lower(),
+                                   Project(files), entry_type)
+
+
+class ReluForward(Elementwise):
+    """
+    top = max(bottom, 0) + negative_slope * min(bottom, 0), called as
+    (bottom, top).
+    """
+    names = ("bottom", "top")
+    body = "float value = bottom[i]; " \
+        "top[i] = value > 0 ? value : value * $negative_slope"
+
+
+class ReluBackward(Elementwise):
+    """
+    The gradient of ReluForward, called as (top_diff, bottom, bottom_diff):
+    top_diff masked by the sign of bottom, in one pass.
+    """
+    names = ("top_diff", "bottom", "bottom_diff")
+    body = "bottom_diff[i] = top_diff[i] * " \
+        "(bottom[i] > 0 ? 1.0f : $negative_slope)"
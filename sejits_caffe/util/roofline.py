@@ -0,0 +1,88 @@
+"""
+Roofline analysis of a net.
+
+Every layer reports the analytic FLOPs and bytes of its forward pass
+(BaseLayer.cost).  Divided by the measured time they give the achieved
+GFLOP/s and GB/s.  The roofline bounds the attainable GFLOP/s by
+min(peak GFLOP/s, arithmetic intensity * peak GB/s), so a layer's
+efficiency is how close it gets to that bound, i.e. the larger of its
+fraction of peak compute and its fraction of peak bandwidth.
+"""
+import timeit
+import numpy as np
+
+
+def measure_peaks(size=1024, copy_size=2 ** 24, repeat=5):
+    """
+    Empirical (GFLOP/s, GB/s) peaks of this machine: the best of `repeat`
+    single precision GEMMs of `size` x `size` matrices and copies of
+    `copy_size` floats.
+    """
+    a = np.random.rand(size, size).astype(np.float32)
+    b = np.random.rand(size, size).astype(np.float32)
+    c = np.empty_like(a)
+    src = np.ones(copy_size, np.float32)
+    dst = np.empty_like(src)
+    # Warm up the BLAS threads and fault the pages in
+    np.dot(a, b, out=c)
+    np.copyto(dst, src)
+    gemm = min(timeit.repeat(lambda: np.dot(a, b, out=c), number=1,
+                             repeat=repeat))
+    copy = min(timeit.repeat(lambda: np.copyto(dst, src), number=1,
+                             repeat=repeat))
+    return 2.0 * size ** 3 / gemm / 1e9, 2.0 * src.nbytes / copy / 1e9
+
+
+def roofline(costs, times, peak_gflops, peak_gbps):
+    """
+    One row per (name, type, flops, bytes) entry of `costs` that has a
+    time in seconds in `times`, in the same order.
+    """
+    rows = []
+    for name, layer_type, flops, nbytes in costs:
+        if not times.get(name):
+            continue
+        seconds = times[name]
+        gflops = flops / seconds / 1e9
+        gbps = nbytes / seconds / 1e9
+        intensity = float(flops) / nbytes if nbytes else float("inf")
+        rows.append({
+            "name": name, "type": layer_type, "flops": flops,
+            "bytes": nbytes, "time": seconds, "gflops": gflops,
+            "gbps": gbps, "intensity": intensity,
+            "bound": "compute" if intensity * peak_gbps >= peak_gflops
+            else "memory",
+            "efficiency": max(gflops / peak_gflops, gbps / peak_gbps),
+            "flagged": False,
+        })
+    return rows
+
+
+def flag_worst(rows, worst=3, min_share=0.01):
+    """
+    Flag the `worst` rows furthest from their roofline bound, ignoring
+    layers that take less than `min_share` of the total time.
+    """
+    total = sum(row["time"] for row in rows)
+    candidates = [row for row in rows if row["time"] >= min_share * total]
+    for row in sorted(candidates, key=lambda row: row["efficiency"])[:worst]:
+        row["flagged"] = True
+    return rows
+
+
+def format_report(rows, peak_gflops, peak_gbps):
+    lines = [
+        "Peak: {:.1f} GFLOP/s, {:.1f} GB/s, ridge at {:.2f} FLOP/B".format(
+            peak_gflops, peak_gbps, peak_gflops / peak_gbps),
+        "{:<12} {:<16} {:>10} {:>10} {:>9} {:>9} {:>9} {:>8} {:>7}".format(
+            "layer", "type", "ms", "MFLOP", "MB", "GFLOP/s", "GB/s",
+            "bound", "peak%")]
+    for row in rows:
+        lines.append(
+            "{:<12} {:<16} {:>10.3f} {:>10.1f} {:>9.2f} {:>9.2f} {:>9.2f} "
+            "{:>8} {:>6.1f}%{}".format(
+                row["name"], row["type"], row["time"] * 1e3,
+                row["flops"] / 1e6, row["bytes"] / 1e6, row["gflops"],
+                row["gbps"], row["bound"], row["efficiency"] * 100,
+                " <-" if row["flagged"] else ""))
+    return "\n".join(lines)
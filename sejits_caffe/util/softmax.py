@@ -0,0 +1,240 @@
+"""
+Softmax over axis 1 of whole blobs, alone or fused with the multinomial
+logistic loss.
+
+A blob of shape (num, channels, ...) is softmaxed over its channels at
+each of its `inner` = prod(shape[2:]) positions.  With a single position
+(the (num, classes) output of an InnerProductLayer) each image is a
+contiguous row, reduced and normalized by vectorized loops over it.
+Otherwise the positions of an image are processed in tiles, whose maxima
+and sums are vectors updated one channel at a time.  Images (and tiles)
+run in parallel.  Exponentials are those of fast_math, which vectorize.
+"""
+import ctree.c.nodes as C
+from ctree.nodes import Project
+from ctree.templates.nodes import StringTemplate
+from sejits_caffe.util.specializer import Specializer, ConcreteKernel
+from sejits_caffe.util.fast_math import fast_expf
+import ctypes as ct
+import numpy as np
+
+
+# Positions per tile, as for LRN
+tile_size = 256
+
+rows = """
+#pragma omp parallel for $reduction
+for (int n = 0; n < $num; ++n) {
+  const float* in = bottom + (long) n * $channels;
+  float* out = $out + (long) n * $channels;
+  $label_row
+  float max = in[0];
+  #pragma omp simd reduction(max:max)
+  for (int c = 1; c < $channels; ++c)
+    max = in[c] > max ? in[c] : max;
+  float sum = 0.0f;
+  #pragma omp simd reduction(+:sum)
+  for (int c = 0; c < $channels; ++c) {
+    out[c] = fast_expf(in[c] - max);
+    sum += out[c];
+  }
+  float inverse = 1.0f / sum;
+  #pragma omp simd
+  for (int c = 0; c < $channels; ++c)
+    out[c] *= inverse;
+  $loss_row
+} """
+
+tiles = """
+#pragma omp parallel for collapse(2) $reduction
+for (int n = 0; n < $num; ++n) {
+  for (int tile = 0; tile < $tiles; ++tile) {
+    int start = tile * $tile_size;
+    int length = $inner - start < $tile_size ? $inner - start : $tile_size;
+    long offset = (long) n * $channels * $inner + start;
+    const float* in = bottom + offset;
+    float* out = $out + offset;
+    float max[$tile_size];
+    float sum[$tile_size];
+    for (int i = 0; i < length; ++i) {
+      max[i] = in[i];
+      sum[i] = 0.0f;
+    }
+    for (int c = 1; c < $channels; ++c) {
+      #pragma omp simd
+      for (int i = 0; i < length; ++i)
+        max[i] = in[c * $inner + i] > max[i] ? in[c * $inner + i] : max[i];
+    }
+    for (int c = 0; c < $channels; ++c) {
+      #pragma omp simd
+      for (int i = 0; i < length; ++i) {
+        out[c * $inner + i] = fast_expf(in[c * $inner + i] - max[i]);
+        sum[i] += out[c * $inner + i];
+      }
+    }
+    for (int c = 0; c < $channels; ++c) {
+      #pragma omp simd
+      for (int i = 0; i < length; ++i)
+        out[c * $inner + i] /= sum[i];
+    }
+    $loss_tile
+  }
+} """
+
+# The label of a row, whose gradient is cleared when it is ignored or
+# invalid (counted in `invalid`)
+label_row = """
+  int label_value = (int) label[n];
+  if ($ignored || label_value < 0 || label_value >= $channels) {
+    invalid += !($ignored) ? 1 : 0;
+    for (int c = 0; c < $channels; ++c)
+      out[c] = 0.0f;
+    continue;
+  }"""
+
+# -log(prob[label]) as log(sum) - (in[label] - max), which unlike the log
+# of the probability does not underflow, and the gradient prob - onehot
+loss_row = """
+  out[label_value] -= 1.0f;
+  loss += logf(sum) + max - in[label_value];
+  count += 1;"""
+
+loss_tile = """
+    for (int i = 0; i < length; ++i) {
+      int label_value = (int) label[(long) n * $inner + start + i];
+      if ($ignored || label_value < 0 || label_value >= $channels) {
+        invalid += !($ignored) ? 1 : 0;
+        for (int c = 0; c < $channels; ++c)
+          out[c * $inner + i] = 0.0f;
+        continue;
+      }
+      out[label_value * $inner + i] -= 1.0f;
+      loss += logf(sum[i]) + max[i] - in[label_value * $inner + i];
+      count += 1;
+    }"""
+
+
+class ConcreteSoftmax(ConcreteKernel):
+    def __init__(self, entry_name, proj, entry_type):
+        self._c_function = self._compile(entry_name, proj, entry_type)
+
+    def __call__(self, *args):
+        self._c_function(*args)
+
+
+class SoftmaxKernel(Specializer):
+    """
+    Base of the softmax kernels: subclasses provide `entry_name`, the
+    `names` of their arguments, the name of the `output` blob and the
+    `loss` templates.
+    """
+    entry_name = None
+    output = None
+    ignore_label = None
+
+    def __init__(self):
+        super(SoftmaxKernel, self).__init__(C.Constant(0))
+
+    def args_to_subconfig(self, args):
+        # The templates compute in float
+        for name, arg in zip(self.names(), args):
+            if name in ("bottom", self.output) and arg.dtype != np.float32:
+                raise TypeError(
+                    "{} of {} is {}, not float32".format(
+                        name, self.entry_name, arg.dtype))
+        return tuple((arg.shape, arg.dtype.str) for arg in args), \
+            self.ignore_label
+
+    def pointer_types(self, arg_cfg):
+        return [np.ctypeslib.ndpointer(np.dtype(dtype), len(shape), shape)
+                for shape, dtype in arg_cfg[0]]
+
+    def loss(self):
+        return {'reduction': "", 'label_row': "", 'loss_row': "",
+                'loss_tile': "", 'prologue': "", 'epilogue': ""}
+
+    def transform(self, tree, program_cfg):
+        arg_cfg, tune_cfg = program_cfg
+        shape = arg_cfg[0][0][0]
+        inner = int(np.prod(shape[2:]))
+        cfg = {
+            'num': C.Constant(shape[0]),
+            'channels': C.Constant(shape[1]),
+            'inner': C.Constant(inner),
+            'tile_size': C.Constant(tile_size),
+            'tiles': C.Constant((inner + tile_size - 1) // tile_size),
+        }
+        cfg['out'] = StringTemplate(self.output)
+        loss = self.loss()
+        body = loss['prologue'] + (rows if inner == 1 else tiles) + \
+            loss['epilogue']
+        for name in ('reduction', 'label_row', 'loss_row', 'loss_tile'):
+            body = body.replace("$" + name, loss[name])
+        kernel = C.FunctionDecl(
+            None,
+            C.SymbolRef(self.entry_name),
+            [C.SymbolRef(name, pointer())
+             for name, pointer in zip(self.names(),
+                                      self.pointer_types(arg_cfg))],
+            [StringTemplate(body, cfg)])
+        return [C.CFile(self.entry_name,
+                        [StringTemplate(fast_expf), kernel],
+                        config_target='omp')]
+
+    def finalize(self, files, program_cfg):
+        arg_cfg, tune_cfg = program_cfg
+        entry_type = ct.CFUNCTYPE(None, *self.pointer_types(arg_cfg))
+        return ConcreteSoftmax(self.entry_name, Project(files), entry_type)
+
+
+class Softmax(SoftmaxKernel):
+    """
+    top = softmax(bottom) over axis 1, called as (bottom, top) with float32
+    blobs of the same shape.
+    """
+    entry_name = "softmax"
+    output = "top"
+
+    def names(self):
+        return "bottom", "top"
+
+
+class SoftmaxLoss(SoftmaxKernel):
+    """
+    Softmax fused with the multinomial logistic loss, in one pass.  Called
+    as (bottom, label, diff, results): the labels, of any dtype, give the
+    class of each of the num * inner positions of bottom; diff receives
+    prob - onehot, the gradient of the loss of every position, or zeros
+    for positions whose label is `ignore_label` (if not None) or out of
+    range; results, a float64 array of 3, receives the sum of the losses
+    and the numbers of labelled and invalid positions.
+    """
+    entry_name = "softmax_loss"
+    output = "diff"
+
+    def __init__(self, ignore_label=None):
+        super(SoftmaxLoss, self).__init__()
+        self.ignore_label = ignore_label
+
+    def names(self):
+        return "bottom", "label", "diff", "results"
+
+    def loss(self):
+        if self.ignore_label is None:
+            ignored = "0"
+        else:
+            ignored = "label_value == {}".format(int(self.ignore_label))
+        return {
+            'reduction': "reduction(+:loss, count, invalid)",
+            'label_row': label_row.replace("$ignored", ignored),
+            'loss_row': loss_row,
+            'loss_tile': loss_tile.replace("$ignored", ignored),
+            'prologue': """
+double loss = 0.0;
+long count = 0;
+long invalid = 0;""",
+            'epilogue': """
+results[0] = loss;
+results[1] = count;
+results[2] = invalid;""",
+        }
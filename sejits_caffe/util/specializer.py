@@ -0,0 +1,66 @@
+"""
+The base of the specializers of this package.
+
+ctree's LazySpecializedFunction only reuses the concrete function of an
+argument configuration when its global `jit CACHE` option is set, and
+otherwise generates and compiles it again on every call.  A Specializer
+keeps the concrete functions of its configurations itself, whatever ctree's
+configuration, which is also where sejits_caffe.util.precompile leaves the
+ones it builds ahead of time.  Their concrete functions derive from
+ConcreteKernel, which compiles through the kernel cache with the package's
+compiler flags.
+"""
+from sejits_caffe.util import kernel_cache
+from ctree.c.nodes import CFile
+from ctree.jit import LazySpecializedFunction, ConcreteSpecializedFunction
+import os
+import threading
+
+
+# Code generation runs Python and writes into ctree's compile directories,
+# so only the compilation itself runs concurrently, see precompile_all.
+transform_lock = threading.Lock()
+
+
+class ConcreteKernel(ConcreteSpecializedFunction):
+    """
+    Base of the concrete functions of this package, whose single C file is
+    compiled through the kernel cache, see sejits_caffe.util.kernel_cache.
+    """
+    def _compile(self, entry_name, proj, entry_type, **kwargs):
+        files = proj.files
+        if len(files) != 1 or not isinstance(files[0], CFile):
+            return super(ConcreteKernel, self)._compile(
+                entry_name, proj, entry_type, **kwargs)
+        return kernel_cache.get_kernel_cache().compile(entry_name, proj,
+                                                       entry_type)
+
+
+class Specializer(LazySpecializedFunction):
+    """
+    A LazySpecializedFunction whose concrete_functions are keyed by
+    `args_to_subconfig`, which must be hashable.  Tuning is not supported:
+    transforms receive None as their tuner config.
+    """
+    def specialize(self, args):
+        """
+        The concrete function `self(*args)` runs, generated and compiled on
+        first use.
+        """
+        subconfig = self.args_to_subconfig(args)
+        csf = self.concrete_functions.get(subconfig)
+        if csf is None:
+            program_config = self.ProgramConfig(subconfig, None)
+            with transform_lock:
+                files = self.run_transform(program_config)
+                dir_name = self.config_to_dirname(program_config)
+                if not os.path.exists(dir_name):
+                    os.makedirs(dir_name)
+                for source_file in files:
+                    source_file.path = dir_name
+            csf = self.finalize(files, program_config)
+            self.concrete_functions[subconfig] = csf
+        return csf
+
+    def __call__(self, *args, **kwargs):
+        return self.specialize(args)(*args, **kwargs)
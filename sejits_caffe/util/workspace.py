@@ -0,0 +1,38 @@
+from cstructures.array import Array
+from sejits_caffe.util.profiler import profiler
+import numpy as np
+
+
+class Workspace(object):
+    """
+    A flat scratch buffer that is carved into views on demand.  A single
+    Workspace is shared by every layer that needs temporary storage (e.g. the
+    im2col column buffer of each ConvLayer), so once it has been sized for
+    the largest consumer, steady state passes allocate nothing.
+    """
+    def __init__(self, size=0, dtype=np.float32):
+        self.dtype = dtype
+        self.buffer = Array.empty((int(size), ), dtype)
+
+    @property
+    def nbytes(self):
+        return self.buffer.nbytes
+
+    def reserve(self, size):
+        """
+        Grow the buffer to hold at least `size` elements.  Views handed out
+        before a reallocation keep pointing at the old buffer, so consumers
+        should request a fresh view every time they use the workspace.
+        """
+        size = int(size)
+        if size > self.buffer.size:
+            self.buffer = Array.empty((size, ), self.dtype)
+            if profiler.enabled:
+                profiler.allocated("workspace", self.buffer.nbytes)
+
+    def view(self, shape):
+        """
+        Return a contiguous view of the first prod(shape) elements.
+        """
+        self.reserve(np.prod(shape))
+        return self.buffer[:np.prod(shape)].reshape(shape)
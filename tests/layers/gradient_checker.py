@@ -46,7 +46,7 @@ class GradientChecker(object):
 
         layer.forward(bottom, top)
         self.get_obj_and_gradient(layer, top, top_diff, top_id, top_data_id)
-        layer.backward(bottom_diff, top_diff)
+        layer.backward(bottom, bottom_diff, top, top_diff)
 
         computed_gradients = []
         for blob, computed in zip(blobs_to_check, computed_gradients):
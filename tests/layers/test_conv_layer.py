@@ -83,6 +83,32 @@ class NaiveConv(LazySpecializedFunction):
 path = os.path.dirname(os.path.realpath(__file__))
 
 
+def py_conv_backward(bottom, weights, top_diff, group, kernel_size, pad,
+                     stride):
+    num_output, channels = weights.shape[:2]
+    out_h, out_w = top_diff.shape[2:]
+    out_group = num_output // group
+    padded = np.pad(bottom, ((0, 0), (0, 0), (pad, pad), (pad, pad)),
+                    'constant')
+    padded_diff = np.zeros_like(padded)
+    weight_diff = np.zeros_like(weights)
+    for y in range(kernel_size):
+        for x in range(kernel_size):
+            rows = slice(y, y + stride * out_h, stride)
+            cols = slice(x, x + stride * out_w, stride)
+            for g in range(group):
+                outs = slice(g * out_group, (g + 1) * out_group)
+                ins = slice(g * channels, (g + 1) * channels)
+                weight_diff[outs, :, y, x] = np.einsum(
+                    'nmhw,nchw->mc', top_diff[:, outs],
+                    padded[:, ins, rows, cols])
+                padded_diff[:, ins, rows, cols] += np.einsum(
+                    'nmhw,mc->nchw', top_diff[:, outs], weights[outs, :, y, x])
+    bottom_diff = padded_diff[:, :, pad:pad + bottom.shape[2],
+                              pad:pad + bottom.shape[3]]
+    return weight_diff, top_diff.sum(axis=(0, 2, 3)), bottom_diff
+
+
 class ConvLayerTest(unittest.TestCase):
     def _check(self, actual, expected):
         try:
@@ -96,10 +122,10 @@ class ConvLayerTest(unittest.TestCase):
         text_format.Merge(param_string, param)
         self.layer = param.layer
 
-    def _forward_test(self, param, in_shape):
+    def _forward_test(self, param, in_shape, batched=False):
         conv_param = param.convolution_param
         in_batch = Array.rand(*in_shape).astype(np.float32) * 255
-        conv = ConvLayer(param)
+        conv = ConvLayer(param, batched)
         top_shape = conv.get_top_shape(in_batch)
         expected_conv = NaiveConv(conv_param)
         actual = Array.zeros(top_shape, np.float32)
@@ -110,6 +136,34 @@ class ConvLayerTest(unittest.TestCase):
         expected_conv(in_batch, conv.weights, conv.bias, expected)
         self._check(actual, expected)
 
+    def _backward_test(self, param, in_shape, batched=False,
+                       keep_columns=False):
+        conv_param = param.convolution_param
+        bottom = Array.rand(*in_shape).astype(np.float32)
+        conv = ConvLayer(param, batched)
+        top = Array.zeros(conv.get_top_shape(bottom), np.float32)
+        top_diff = Array.rand(*top.shape).astype(np.float32)
+        bottom_diff = Array.zeros_like(bottom)
+        conv.setup(bottom, top)
+        if keep_columns:
+            conv.keep_columns()
+        conv.forward(bottom, top)
+        im2col, calls = conv.im2col, []
+
+        def counted_im2col(*args):
+            calls.append(args)
+            return im2col(*args)
+        conv.im2col = counted_im2col
+        conv.backward(bottom, bottom_diff, top, top_diff)
+        # Backward reads the kept columns back instead of lowering again
+        self.assertEqual(len(calls) == 0, keep_columns)
+        weight_diff, bias_diff, expected_bottom_diff = py_conv_backward(
+            bottom, conv.weights, top_diff, conv_param.group,
+            conv_param.kernel_size, conv_param.pad, conv_param.stride)
+        self._check(conv.weight_diff, weight_diff)
+        self._check(conv.bias_diff, bias_diff)
+        self._check(bottom_diff, expected_bottom_diff)
+
     def test_alex_net_conv1(self):
         self._forward_test(self.layer[2], (5, 3, 256, 256))
 
@@ -125,5 +179,65 @@ class ConvLayerTest(unittest.TestCase):
     def test_alex_net_conv5(self):
         self._forward_test(self.layer[14], (5, 8, 64, 64))
 
+    def test_alex_net_conv1_batched(self):
+        self._forward_test(self.layer[2], (5, 3, 256, 256), batched=True)
+
+    def test_alex_net_conv2_batched(self):
+        self._forward_test(self.layer[6], (5, 16, 64, 64), batched=True)
+
+    def test_alex_net_conv1_backward(self):
+        self._backward_test(self.layer[2], (2, 3, 63, 63))
+
+    def test_alex_net_conv2_backward(self):
+        self._backward_test(self.layer[6], (2, 16, 15, 15))
+
+    def test_alex_net_conv2_backward_batched(self):
+        self._backward_test(self.layer[6], (2, 16, 15, 15), batched=True)
+
+    def test_alex_net_conv2_backward_kept(self):
+        self._backward_test(self.layer[6], (2, 16, 15, 15),
+                            keep_columns=True)
+
+    def test_alex_net_conv2_backward_batched_kept(self):
+        self._backward_test(self.layer[6], (2, 16, 15, 15), batched=True,
+                            keep_columns=True)
+
+    def test_batched_partial_batch(self):
+        bottom = Array.rand(4, 16, 15, 15).astype(np.float32)
+        conv = ConvLayer(self.layer[6], batched=True)
+        top = Array.zeros(conv.get_top_shape(bottom), np.float32)
+        conv.setup(bottom, top)
+        with self.assertRaises(AssertionError):
+            conv.forward(bottom[:3], top[:3])
+
+    def test_fused_relu(self):
+        bottom = Array.rand(2, 16, 15, 15).astype(np.float32) - 0.5
+        conv = ConvLayer(self.layer[6])
+        top = Array.zeros(conv.get_top_shape(bottom), np.float32)
+        conv.setup(bottom, top)
+        conv.bias[:] = Array.rand(*conv.bias.shape) - 0.5
+        conv.forward(bottom, top)
+        expected = np.maximum(top, 0)
+        conv.fuse_relu(0.0)
+        conv.forward(bottom, top)
+        self._check(top, expected)
+
+    def test_cost_grouped(self):
+        # conv2: 5x5 kernels, 2 groups, 256 outputs
+        bottom = Array.zeros((2, 16, 15, 15), np.float32)
+        conv = ConvLayer(self.layer[6])
+        top = Array.zeros(conv.get_top_shape(bottom), np.float32)
+        conv.setup(bottom, top)
+        flops, nbytes = conv.cost(bottom, top)
+        self.assertEqual(flops, 2 * top.size * 8 * 25 + top.size)
+        columns = 2 * 16 * 25 * top.shape[2] * top.shape[3]
+        self.assertEqual(nbytes, 4 * (bottom.size + top.size +
+                                      conv.weights.size + conv.bias.size +
+                                      2 * columns))
+        # A fused ReLU adds its comparison, a sweep over top is saved
+        conv.fuse_relu(0.0)
+        self.assertEqual(conv.cost(bottom, top),
+                         (flops + top.size, nbytes))
+
 if __name__ == '__main__':
     unittest.main()
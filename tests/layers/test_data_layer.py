@@ -0,0 +1,58 @@
+import unittest
+from cstructures.array import Array
+from sejits_caffe.layers.data_layer import DataLayer
+import sejits_caffe.caffe_pb2 as caffe_pb2
+import lmdb
+import shutil
+import tempfile
+import numpy as np
+
+
+class TestDataLayer(unittest.TestCase):
+    def setUp(self):
+        self.source = tempfile.mkdtemp()
+        db = lmdb.open(self.source, map_size=1 << 24)
+        with db.begin(write=True) as txn:
+            for i in range(23):
+                datum = caffe_pb2.Datum(
+                    channels=3, height=8, width=8, label=i,
+                    data=np.full(3 * 8 * 8, i, np.uint8).tobytes())
+                txn.put('{:05d}'.format(i).encode(),
+                        datum.SerializeToString())
+        db.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.source)
+
+    def _read(self, num_workers, iters=6):
+        param = caffe_pb2.LayerParameter(name="data", type="Data")
+        param.data_param.source = self.source
+        param.data_param.backend = caffe_pb2.DataParameter.LMDB
+        param.data_param.batch_size = 5
+        param.transform_param.crop_size = 6
+        param.transform_param.scale = 0.5
+        layer = DataLayer(param, 2, num_workers)
+        layer.phase = "test"
+        top_shape = layer.get_top_shape()
+        top = Array.zeros(top_shape, np.float32)
+        top_label = Array.zeros(top_shape[:1], np.float32)
+        layer.setup(top, top_label)
+        labels = []
+        for _ in range(iters):
+            layer.forward(top, top_label)
+            np.testing.assert_array_equal(
+                top, np.broadcast_to(top_label.reshape(5, 1, 1, 1) * 0.5,
+                                     top_shape))
+            labels.extend(top_label)
+        layer.close()
+        layer.db.close()
+        return labels
+
+    def test_reader_pool(self):
+        expected = [i % 23 for i in range(30)]
+        self.assertEqual(self._read(0), expected)
+        self.assertEqual(self._read(3), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
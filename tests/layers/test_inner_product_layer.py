@@ -0,0 +1,53 @@
+import unittest
+from cstructures.array import Array
+from sejits_caffe.layers.inner_product_layer import InnerProductLayer
+import sejits_caffe.caffe_pb2 as caffe_pb2
+from google.protobuf import text_format
+import os
+import numpy as np
+
+
+path = os.path.dirname(os.path.realpath(__file__))
+
+
+class TestInnerProductLayer(unittest.TestCase):
+    def _check(self, actual, expected):
+        np.testing.assert_allclose(actual, expected, rtol=1e-4, atol=1e-4)
+
+    def setUp(self):
+        param_string = open(path + '/alexnet.prototxt').read()
+        param = caffe_pb2.NetParameter()
+        text_format.Merge(param_string, param)
+        self.layer = param.layer
+
+    def test_forward_backward(self):
+        bottom = Array.rand(4, 8, 3, 3).astype(np.float32)
+        layer = InnerProductLayer(self.layer[17])
+        top = Array.zeros(layer.get_top_shape(bottom), np.float32)
+        layer.setup(bottom, top)
+        layer.forward(bottom, top)
+        flat = bottom.reshape(4, -1)
+        self._check(top, flat.dot(layer.weights.T) + layer.bias)
+
+        top_diff = Array.rand(*top.shape).astype(np.float32)
+        bottom_diff = Array.zeros_like(bottom)
+        layer.backward(bottom, bottom_diff, top, top_diff)
+        self._check(layer.weight_diff, top_diff.T.dot(flat))
+        self._check(layer.bias_diff, top_diff.sum(axis=0))
+        self._check(bottom_diff.reshape(4, -1), top_diff.dot(layer.weights))
+
+    def test_fused_relu(self):
+        bottom = Array.rand(4, 8, 3, 3).astype(np.float32) - 0.5
+        layer = InnerProductLayer(self.layer[17])
+        top = Array.zeros(layer.get_top_shape(bottom), np.float32)
+        layer.setup(bottom, top)
+        layer.bias[:] = Array.rand(*layer.bias.shape) - 0.5
+        layer.fuse_relu(0.0)
+        layer.forward(bottom, top)
+        flat = bottom.reshape(4, -1)
+        self._check(top, np.maximum(flat.dot(layer.weights.T) + layer.bias,
+                                    0))
+
+
+if __name__ == '__main__':
+    unittest.main()
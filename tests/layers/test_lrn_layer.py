@@ -11,6 +11,37 @@ import os
 path = os.path.dirname(os.path.realpath(__file__))
 
 
+def py_lrn(bottom, size, alpha, beta, k):
+    """
+    Across channel LRN and its scale, straight from the definition.
+    """
+    square = np.square(bottom.astype(np.float64))
+    scale = np.empty_like(square)
+    pre_pad = (size - 1) // 2
+    for c in range(bottom.shape[1]):
+        window = square[:, max(c - pre_pad, 0):c + pre_pad + 1]
+        scale[:, c] = k + alpha / size * window.sum(axis=1)
+    return bottom * scale ** -beta, scale
+
+
+def py_within_channel_lrn(bottom, size, alpha, beta):
+    """
+    Within channel LRN and its scale, as Caffe's average pooling of the
+    squares, whose windows all count size * size elements.
+    """
+    pre_pad = (size - 1) // 2
+    square = np.pad(np.square(bottom.astype(np.float64)),
+                    ((0, 0), (0, 0), (pre_pad, pre_pad), (pre_pad, pre_pad)),
+                    'constant')
+    height, width = bottom.shape[2:]
+    box = np.zeros(bottom.shape, np.float64)
+    for i in range(size):
+        for j in range(size):
+            box += square[:, :, i:i + height, j:j + width]
+    scale = 1 + alpha / size ** 2 * box
+    return bottom * scale ** -beta, scale
+
+
 class TestLRNLayer(unittest.TestCase):
     def _check(self, actual, expected):
         try:
@@ -49,6 +80,123 @@ class TestLRNLayer(unittest.TestCase):
                         self.assertTrue(
                             abs(actual[n, c, h, w] - expected) < 1e-4)
 
+    def test_reference(self):
+        # Fewer channels than the window and more pixels than a tile
+        for channels, size, beta in ((2, 5, 0.75), (7, 3, 0.6)):
+            bottom = Array.rand(2, channels, 17, 19).astype(np.float32) * 4
+            top = Array.zeros_like(bottom)
+            param = self.layer[4]
+            param.lrn_param.local_size = size
+            param.lrn_param.beta = beta
+            param.lrn_param.alpha = 0.1
+            param.lrn_param.k = 2
+            layer = LRNLayer(param)
+            layer.setup(bottom, top)
+            layer.forward(bottom, top)
+            expected, scale = py_lrn(bottom, size, 0.1, param.lrn_param.beta,
+                                     2)
+            np.testing.assert_allclose(top, expected, rtol=1e-5)
+            np.testing.assert_allclose(layer.scale, scale, rtol=1e-5)
+
+    def test_backward(self):
+        for size, beta in ((5, 0.75), (3, 0.6)):
+            bottom = Array.rand(2, 7, 5, 6).astype(np.float32) * 2 - 1
+            top = Array.zeros_like(bottom)
+            param = self.layer[4]
+            param.lrn_param.local_size = size
+            param.lrn_param.beta = beta
+            param.lrn_param.alpha = 0.5
+            param.lrn_param.k = 2
+            layer = LRNLayer(param)
+            layer.setup(bottom, top)
+            layer.forward(bottom, top)
+            top_diff = Array.rand(*bottom.shape).astype(np.float32)
+            bottom_diff = Array.zeros_like(bottom)
+            layer.backward(bottom, bottom_diff, top, top_diff)
+
+            # Central differences of the loss sum(top * top_diff)
+            beta = param.lrn_param.beta
+            data = bottom.astype(np.float64)
+            expected = np.empty_like(data)
+            step = 1e-4
+            for index in np.ndindex(*data.shape):
+                data[index] += step
+                positive = np.sum(py_lrn(data, size, 0.5, beta, 2)[0] *
+                                  top_diff)
+                data[index] -= 2 * step
+                negative = np.sum(py_lrn(data, size, 0.5, beta, 2)[0] *
+                                  top_diff)
+                data[index] += step
+                expected[index] = (positive - negative) / (2 * step)
+            np.testing.assert_allclose(bottom_diff, expected, rtol=1e-4,
+                                       atol=1e-5)
+
+    def within_channel_layer(self, size, beta, alpha=0.5):
+        param = self.layer[4]
+        param.lrn_param.norm_region = caffe_pb2.LRNParameter.WITHIN_CHANNEL
+        param.lrn_param.local_size = size
+        param.lrn_param.beta = beta
+        param.lrn_param.alpha = alpha
+        return LRNLayer(param)
+
+    def test_within_channel(self):
+        # The window is larger than the image in the last case
+        for shape, size, beta in (((2, 3, 9, 11), 3, 0.75),
+                                  ((2, 3, 9, 11), 5, 0.6),
+                                  ((1, 2, 3, 4), 7, 0.75)):
+            bottom = Array.rand(*shape).astype(np.float32) * 4
+            top = Array.zeros_like(bottom)
+            layer = self.within_channel_layer(size, beta)
+            layer.setup(bottom, top)
+            layer.forward(bottom, top)
+            expected, scale = py_within_channel_lrn(
+                bottom, size, 0.5, layer.layer_param.lrn_param.beta)
+            np.testing.assert_allclose(top, expected, rtol=1e-5)
+            np.testing.assert_allclose(layer.scale, scale, rtol=1e-5)
+
+    def test_within_channel_backward(self):
+        for size, beta in ((3, 0.75), (5, 0.6)):
+            bottom = Array.rand(1, 2, 6, 7).astype(np.float32) * 2 - 1
+            top = Array.zeros_like(bottom)
+            layer = self.within_channel_layer(size, beta)
+            beta = layer.layer_param.lrn_param.beta
+            layer.setup(bottom, top)
+            layer.forward(bottom, top)
+            top_diff = Array.rand(*bottom.shape).astype(np.float32)
+            bottom_diff = Array.zeros_like(bottom)
+            layer.backward(bottom, bottom_diff, top, top_diff)
+
+            data = bottom.astype(np.float64)
+            expected = np.empty_like(data)
+            step = 1e-4
+            for index in np.ndindex(*data.shape):
+                data[index] += step
+                positive = np.sum(py_within_channel_lrn(
+                    data, size, 0.5, beta)[0] * top_diff)
+                data[index] -= 2 * step
+                negative = np.sum(py_within_channel_lrn(
+                    data, size, 0.5, beta)[0] * top_diff)
+                data[index] += step
+                expected[index] = (positive - negative) / (2 * step)
+            np.testing.assert_allclose(bottom_diff, expected, rtol=1e-4,
+                                       atol=1e-5)
+
+    def test_test_phase(self):
+        bottom = Array.rand(3, 8, 16, 16).astype(np.float32)
+        expected = Array.zeros_like(bottom)
+        layer = LRNLayer(self.layer[4])
+        layer.setup(bottom, expected)
+        layer.forward(bottom, expected)
+
+        actual = Array.zeros_like(bottom)
+        layer = LRNLayer(self.layer[4])
+        layer.phase = 'test'
+        layer.setup(bottom, actual)
+        layer.forward(bottom, actual)
+        # The scale is only kept for backward
+        self.assertIsNone(layer.scale)
+        self._check(actual, expected)
+
 
 if __name__ == '__main__':
     unittest.main()
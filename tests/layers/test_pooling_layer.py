@@ -11,6 +11,50 @@ from tests.layers.gradient_checker import GradientChecker
 path = os.path.dirname(os.path.realpath(__file__))
 
 
+def py_max_pool(bottom, kernel, pad, stride, top_shape):
+    top = np.empty(top_shape, bottom.dtype)
+    mask = np.empty(top_shape, np.int32)
+    height, width = bottom.shape[2:]
+    for ph in range(top_shape[2]):
+        hstart = ph * stride[0] - pad[0]
+        hend = min(hstart + kernel[0], height)
+        hstart = max(hstart, 0)
+        for pw in range(top_shape[3]):
+            wstart = pw * stride[1] - pad[1]
+            wend = min(wstart + kernel[1], width)
+            wstart = max(wstart, 0)
+            window = bottom[:, :, hstart:hend, wstart:wend].reshape(
+                top_shape[:2] + (-1, ))
+            top[:, :, ph, pw] = window.max(axis=2)
+            h, w = np.unravel_index(window.argmax(axis=2),
+                                    (hend - hstart, wend - wstart))
+            mask[:, :, ph, pw] = (h + hstart) * width + w + wstart
+    return top, mask
+
+
+def py_ave_pool(bottom, kernel, pad, stride, top_shape):
+    """
+    Average pooling and the matrix of its gradient for one plane, with
+    Caffe's treatment of the padding.
+    """
+    top = np.empty(top_shape, bottom.dtype)
+    height, width = bottom.shape[2:]
+    weights = np.zeros(top_shape[2:] + (height, width), np.float32)
+    for ph in range(top_shape[2]):
+        hstart = ph * stride[0] - pad[0]
+        hend = min(hstart + kernel[0], height + pad[0])
+        for pw in range(top_shape[3]):
+            wstart = pw * stride[1] - pad[1]
+            wend = min(wstart + kernel[1], width + pad[1])
+            pool_size = (hend - hstart) * (wend - wstart)
+            window = (slice(max(hstart, 0), min(hend, height)),
+                      slice(max(wstart, 0), min(wend, width)))
+            top[:, :, ph, pw] = bottom[(Ellipsis, ) + window].sum(
+                axis=(2, 3)) / pool_size
+            weights[(ph, pw) + window] = 1.0 / pool_size
+    return top, weights
+
+
 class TestPoolingLayer(unittest.TestCase):
     def setUp(self):  # NOQA
         param_string = open(path + '/alexnet.prototxt').read()
@@ -45,21 +89,156 @@ class TestPoolingLayer(unittest.TestCase):
                         [9, 5, 5, 8],
                         [9, 5, 5, 8]
                     ]).astype(np.int32))
-        bottom = Array.zeros_like(bottom)
+        bottom_diff = Array.zeros_like(bottom)
+        top_diff = Array.zeros_like(actual)
         for n in range(5):
             for c in range(channels):
-                actual[n, c] = Array.array(
+                top_diff[n, c] = Array.array(
                     [[1, 1, 1, 1],
                      [1, 1, 1, 1]]).astype(np.int32)
-        layer.backward(bottom, actual)
+        layer.backward(bottom, bottom_diff, actual, top_diff)
         for n in range(5):
             for c in range(channels):
                 np.testing.assert_array_equal(
-                    bottom[n, c],
+                    bottom_diff[n, c],
                     np.array([[0, 0, 2, 0, 0],
                               [2, 0, 0, 0, 2],
                               [0, 0, 2, 0, 0]]).astype(np.int32))
 
+    def test_padded_strided(self):
+        bottom = Array.rand(2, 3, 13, 11).astype(np.float32)
+        param = self.layer[5]
+        param.pooling_param.kernel_size = 3
+        param.pooling_param.stride = 2
+        param.pooling_param.pad = 1
+        layer = PoolingLayer(param)
+        top_shape = layer.get_top_shape(bottom)
+        top = Array.zeros(top_shape, np.float32)
+        layer.setup(bottom, top)
+        layer.forward(bottom, top)
+        expected, expected_mask = py_max_pool(bottom, (3, 3), (1, 1),
+                                              (2, 2), top_shape)
+        np.testing.assert_array_equal(top, expected)
+        np.testing.assert_array_equal(layer.mask, expected_mask)
+
+        top_diff = Array.rand(*top_shape).astype(np.float32)
+        # Stale values must not leak into the gradient
+        bottom_diff = Array.rand(*bottom.shape).astype(np.float32)
+        layer.backward(bottom, bottom_diff, top, top_diff)
+        expected_diff = np.zeros(bottom.shape, np.float32)
+        for n in range(2):
+            for c in range(3):
+                np.add.at(expected_diff[n, c].reshape(-1),
+                          expected_mask[n, c].reshape(-1),
+                          top_diff[n, c].reshape(-1))
+        np.testing.assert_allclose(bottom_diff, expected_diff, rtol=1e-6)
+
+    def test_test_phase(self):
+        # All negative, so the result does not depend on the initial zeros
+        bottom = -Array.rand(2, 3, 8, 8).astype(np.float32)
+        param = self.layer[5]
+        layer = PoolingLayer(param)
+        layer.phase = 'test'
+        top_shape = layer.get_top_shape(bottom)
+        top = Array.zeros(top_shape, np.float32)
+        layer.setup(bottom, top)
+        self.assertIsNone(layer.mask)
+        layer.forward(bottom, top)
+        expected, _ = py_max_pool(bottom, (3, 3), (0, 0), (2, 2), top_shape)
+        np.testing.assert_array_equal(top, expected)
+
+    def make_layer(self, pool, **pooling_param):
+        param = self.layer[5]
+        param.pooling_param.pool = pool
+        for name, value in pooling_param.items():
+            setattr(param.pooling_param, name, value)
+        return PoolingLayer(param)
+
+    def test_ave(self):
+        bottom = Array.rand(2, 3, 13, 11).astype(np.float32)
+        layer = self.make_layer(caffe_pb2.PoolingParameter.AVE, pad=1)
+        top_shape = layer.get_top_shape(bottom)
+        top = Array.zeros(top_shape, np.float32)
+        layer.setup(bottom, top)
+        self.assertIsNone(layer.mask)
+        layer.forward(bottom, top)
+        expected, weights = py_ave_pool(bottom, (3, 3), (1, 1), (2, 2),
+                                        top_shape)
+        np.testing.assert_allclose(top, expected, rtol=1e-5)
+
+        top_diff = Array.rand(*top_shape).astype(np.float32)
+        bottom_diff = Array.rand(*bottom.shape).astype(np.float32)
+        layer.backward(bottom, bottom_diff, top, top_diff)
+        np.testing.assert_allclose(
+            bottom_diff, np.einsum('ncij,ijhw->nchw', top_diff, weights),
+            rtol=1e-5)
+
+    def test_global_ave(self):
+        bottom = Array.rand(2, 5, 7, 6).astype(np.float32)
+        param = self.layer[5]
+        param.pooling_param.Clear()
+        param.pooling_param.pool = caffe_pb2.PoolingParameter.AVE
+        param.pooling_param.global_pooling = True
+        layer = PoolingLayer(param)
+        top = Array.zeros(layer.get_top_shape(bottom), np.float32)
+        self.assertEqual(top.shape, (2, 5, 1, 1))
+        layer.setup(bottom, top)
+        layer.forward(bottom, top)
+        np.testing.assert_allclose(
+            top, bottom.mean(axis=(2, 3), keepdims=True), rtol=1e-5)
+
+        top_diff = Array.rand(*top.shape).astype(np.float32)
+        bottom_diff = Array.zeros_like(bottom)
+        layer.backward(bottom, bottom_diff, top, top_diff)
+        np.testing.assert_allclose(
+            bottom_diff, np.broadcast_to(top_diff / 42.0, bottom.shape),
+            rtol=1e-5)
+
+    def test_global_max(self):
+        bottom = Array.rand(2, 5, 7, 6).astype(np.float32)
+        param = self.layer[5]
+        param.pooling_param.Clear()
+        param.pooling_param.global_pooling = True
+        layer = PoolingLayer(param)
+        top = Array.zeros(layer.get_top_shape(bottom), np.float32)
+        layer.setup(bottom, top)
+        layer.forward(bottom, top)
+        np.testing.assert_array_equal(
+            top, bottom.max(axis=(2, 3), keepdims=True))
+
+    def test_stochastic(self):
+        np.random.seed(0)
+        bottom = Array.rand(2, 3, 9, 9).astype(np.float32)
+        layer = self.make_layer(caffe_pb2.PoolingParameter.STOCHASTIC)
+        top_shape = layer.get_top_shape(bottom)
+        top = Array.zeros(top_shape, np.float32)
+        layer.setup(bottom, top)
+        layer.forward(bottom, top)
+        # Every output is an element of its window, the one in the mask
+        for ph in range(top_shape[2]):
+            for pw in range(top_shape[3]):
+                h, w = np.divmod(layer.mask[:, :, ph, pw], 9)
+                self.assertTrue(np.all((h >= 2 * ph) & (h < 2 * ph + 3)))
+                self.assertTrue(np.all((w >= 2 * pw) & (w < 2 * pw + 3)))
+        np.testing.assert_array_equal(
+            top, np.take_along_axis(bottom.reshape(2, 3, -1),
+                                    layer.mask.reshape(2, 3, -1),
+                                    axis=2).reshape(top_shape))
+        top_diff = Array.rand(*top_shape).astype(np.float32)
+        bottom_diff = Array.zeros_like(bottom)
+        layer.backward(bottom, bottom_diff, top, top_diff)
+        self.assertAlmostEqual(bottom_diff.sum(), top_diff.sum(), places=3)
+
+        layer.phase = 'test'
+        layer.setup(bottom, top)
+        layer.forward(bottom, top)
+        windows = [bottom[:, :, 2 * ph:2 * ph + 3, 2 * pw:2 * pw + 3]
+                   for ph in range(4) for pw in range(4)]
+        expected = np.stack([(window ** 2).sum(axis=(2, 3)) /
+                             window.sum(axis=(2, 3)) for window in windows],
+                            axis=2).reshape(top_shape)
+        np.testing.assert_allclose(top, expected, rtol=1e-5)
+
     @unittest.skip("")
     def test_gradient(self):
         for kernel_h in range(3, 5):
@@ -54,5 +54,30 @@ class TestReluLayer(unittest.TestCase):
 
         np.testing.assert_allclose(actual, expected)
 
+    def test_in_place(self):
+        param = caffe_pb2.LayerParameter()
+        param.CopyFrom(self.layer[3])
+        param.relu_param.negative_slope = 0.1
+        layer = ReluLayer(param)
+        bottom = Array.rand(4, 6, 7, 9).astype(np.float32) - 0.5
+        expected = np.where(bottom > 0, bottom, bottom * 0.1)
+        layer.forward(bottom, bottom)
+        np.testing.assert_allclose(bottom, expected, rtol=1e-6)
+
+        # In place, the diff of top is the diff of bottom
+        diff = Array.rand(*bottom.shape).astype(np.float32) - 0.5
+        expected = np.where(bottom > 0, diff, diff * 0.1)
+        layer.backward(bottom, diff, bottom, diff)
+        np.testing.assert_allclose(diff, expected, rtol=1e-6)
+
+    def test_cost(self):
+        bottom = Array.zeros((2, 3, 4, 5), np.float32)
+        layer = ReluLayer(self.layer[3])
+        self.assertEqual(layer.cost(bottom, bottom),
+                         (bottom.size, 2 * bottom.nbytes))
+        # Counted by the convolution or inner product instead
+        layer.fused = True
+        self.assertEqual(layer.cost(bottom, bottom), (0, 0))
+
 if __name__ == '__main__':
     unittest.main()
@@ -32,34 +32,109 @@ class TestSoftmaxLayer(unittest.TestCase):
                                        np.exp(bottom[i, j, k, l]) / scale)
 
 
-@unittest.skip("Not working")
+def py_softmax_loss(bottom, label, ignore_label=None):
+    """
+    The losses of every labelled position and the gradient prob - onehot,
+    in float64.
+    """
+    data = bottom.astype(np.float64).reshape(bottom.shape[:2] + (-1, ))
+    label = label.reshape(data.shape[0], -1).astype(int)
+    prob = np.exp(data - data.max(axis=1, keepdims=True))
+    prob /= prob.sum(axis=1, keepdims=True)
+    losses = []
+    for n in range(data.shape[0]):
+        for i in range(data.shape[2]):
+            if label[n, i] == ignore_label:
+                prob[n, :, i] = 0
+                continue
+            log_prob = data[n, :, i] - data[n, :, i].max()
+            log_prob -= np.log(np.exp(log_prob).sum())
+            losses.append(-log_prob[label[n, i]])
+            prob[n, label[n, i], i] -= 1
+    return np.array(losses), prob.reshape(bottom.shape)
+
+
 class TestSoftmaxWitLossLayer(unittest.TestCase):
-    def test_forward(self):
+    def setUp(self):
         param_string = open(path + '/alexnet.prototxt').read()
         param = caffe_pb2.NetParameter()
         text_format.Merge(param_string, param)
-        param = param.layer[-1]
+        self.param = param.layer[-1]
+
+    def check(self, bottom, label, ignore_label=None, normalize=True):
+        param = self.param
+        param.loss_param.normalize = normalize
+        if ignore_label is not None:
+            param.loss_param.ignore_label = ignore_label
+        layer = SoftMaxWithLossLayer(param)
+        top = Array.zeros((1, ), np.float32)
+        layer.setup(bottom, label, top)
+        layer.forward(bottom, label, top)
+        losses, diff = py_softmax_loss(bottom, label, ignore_label)
+        normalizer = len(losses) if normalize else bottom.shape[0]
+        self.assertAlmostEqual(top[0], losses.sum() / normalizer, places=4)
+
+        bottom_diff = Array.rand(*bottom.shape).astype(np.float32)
+        top_diff = Array.array([2.0]).astype(np.float32)
+        layer.backward(bottom, label, bottom_diff, None, top, top_diff)
+        np.testing.assert_allclose(bottom_diff, 2.0 * diff / normalizer,
+                                   rtol=1e-4, atol=1e-6)
+
+    def test_classes(self):
+        # The (num, classes) output of an inner product, float labels
+        bottom = Array.rand(16, 1000).astype(np.float32) * 10
+        label = np.floor(Array.rand(16) * 1000).astype(np.float32)
+        self.check(bottom, label)
+        self.check(bottom, label, normalize=False)
+
+    def test_spatial_ignore_label(self):
+        bottom = Array.rand(3, 5, 17, 19).astype(np.float32) * 10
+        label = (Array.rand(3, 1, 17, 19) * 5).astype(np.int32)
+        self.check(bottom, label, ignore_label=2)
+
+    def test_large_logits(self):
+        # prob[label] underflows, log-softmax does not
+        bottom = Array.rand(4, 10).astype(np.float32) * 1000
+        label = np.zeros(4, np.float32)
+        self.check(bottom, label)
+
+    def test_invalid_label(self):
+        layer = SoftMaxWithLossLayer(self.param)
+        bottom = Array.rand(4, 10).astype(np.float32)
+        label = np.array([1, 2, 10, 3], np.float32)
+        top = Array.zeros((1, ), np.float32)
+        layer.setup(bottom, label, top)
+        with self.assertRaises(ValueError):
+            layer.forward(bottom, label, top)
+
+    def test_forward(self):
+        param = self.param
         param.loss_param.normalize = False
         layer = SoftMaxWithLossLayer(param)
         bottom = [Array.rand(10, 5, 2, 3).astype(np.float32) * 10,
                   (Array.rand(10, 1, 2, 3) * 5).astype(np.int32)]
         top = Array.zeros((1, ), np.float32)
-        layer.setup(bottom, top)
-        layer.forward(bottom, top)
+        layer.setup(*(bottom + [top]))
+        layer.forward(*(bottom + [top]))
         full_loss = top[0]
         accum_loss = 0.0
         for label in range(5):
             param.loss_param.ignore_label = label
             layer = SoftMaxWithLossLayer(param)
-            layer.setup(bottom, top)
-            layer.forward(bottom, top)
-            print(top[0])
+            layer.setup(*(bottom + [top]))
+            layer.forward(*(bottom + [top]))
             accum_loss += top[0]
 
-        print(full_loss)
-        print(accum_loss)
         self.assertTrue(abs(4 * full_loss - accum_loss) < 1e-4)
 
+    def test_float64(self):
+        layer = SoftMaxWithLossLayer(self.param)
+        bottom = Array.rand(4, 10)
+        label = np.zeros(4, np.float32)
+        top = Array.zeros((1, ), np.float32)
+        layer.setup(bottom, label, top)
+        with self.assertRaises(TypeError):
+            layer.forward(bottom, label, top)
 
 
 if __name__ == '__main__':
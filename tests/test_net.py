@@ -0,0 +1,165 @@
+import unittest
+from sejits_caffe.net import Net
+from sejits_caffe.layers.data_layer import DataLayer
+import sejits_caffe.caffe_pb2 as caffe_pb2
+import lmdb
+import os
+import shutil
+import tempfile
+import numpy as np
+
+
+prototxt = """
+name: "TinyNet"
+force_backward: true
+layer {{
+  name: "data"
+  type: "Data"
+  top: "data"
+  top: "label"
+  data_param {{
+    source: "{source}"
+    backend: LMDB
+    batch_size: 4
+  }}
+}}
+layer {{
+  name: "ip"
+  type: "InnerProduct"
+  bottom: "data"
+  top: "ip"
+  inner_product_param {{
+    num_output: 8
+    weight_filler {{
+      type: "gaussian"
+      std: 0.01
+    }}
+    bias_filler {{
+      type: "constant"
+      value: 0
+    }}
+  }}
+}}
+layer {{
+  name: "loss"
+  type: "SoftmaxWithLoss"
+  bottom: "ip"
+  bottom: "label"
+  top: "loss"
+}}
+"""
+
+# Both losses read ip, whose diff is then the sum of their gradients
+fan_out_prototxt = prototxt + """
+layer {{
+  name: "loss2"
+  type: "SoftmaxWithLoss"
+  bottom: "ip"
+  bottom: "label"
+  top: "loss2"
+  loss_weight: 0.5
+}}
+"""
+
+
+class TestNet(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        source = os.path.join(self.path, "lmdb")
+        db = lmdb.open(source, map_size=1 << 24)
+        with db.begin(write=True) as txn:
+            for i in range(8):
+                datum = caffe_pb2.Datum(
+                    channels=3, height=4, width=4, label=i,
+                    data=np.full(3 * 4 * 4, i, np.uint8).tobytes())
+                txn.put('{:05d}'.format(i).encode(),
+                        datum.SerializeToString())
+        db.close()
+        self.model = os.path.join(self.path, "net.prototxt")
+        with open(self.model, "w") as f:
+            f.write(prototxt.format(source=source))
+        self.fan_out_model = os.path.join(self.path, "fan_out.prototxt")
+        with open(self.fan_out_model, "w") as f:
+            f.write(fan_out_prototxt.format(source=source))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_force_backward(self):
+        net = Net(self.model)
+        try:
+            # Forced through the bottoms of ip and loss, not into data
+            self.assertEqual(net.layer_need_backward, [False, True, True])
+            self.assertFalse(net.layers[0].propagate_down)
+            self.assertIsInstance(net.layers[0], DataLayer)
+            self.assertIn("data", net.blob_diffs)
+            net.forward()
+            net.backward()
+            self.assertTrue(np.any(net.blob_diffs["data"] != 0))
+        finally:
+            net.close()
+
+    def test_fan_out(self):
+        net = Net(self.fan_out_model)
+        try:
+            loss = net.forward()
+            net.backward()
+            ip = np.asarray(net.blobs["ip"], np.float64)
+            label = np.asarray(net.blobs["label"]).astype(int)
+            prob = np.exp(ip - ip.max(axis=1, keepdims=True))
+            prob /= prob.sum(axis=1, keepdims=True)
+            losses = -np.log(prob[np.arange(4), label])
+            self.assertAlmostEqual(loss, 1.5 * losses.mean(), places=4)
+            # The weighted gradients of both losses, averaged over the batch
+            prob[np.arange(4), label] -= 1
+            np.testing.assert_allclose(net.blob_diffs["ip"], 1.5 * prob / 4,
+                                       rtol=1e-4, atol=1e-7)
+        finally:
+            net.close()
+
+    def test_roofline_report(self):
+        net = Net(self.model)
+        try:
+            rows, report = net.roofline_report(2, peak_gflops=10.0,
+                                               peak_gbps=10.0)
+            self.assertEqual(rows[1]["name"], "ip")
+            self.assertIn("ip", report)
+        finally:
+            net.close()
+
+    def test_compile(self):
+        net = Net(self.model)
+        try:
+            count, seconds = net.compile()
+            self.assertGreater(count, 0)
+            self.assertGreaterEqual(seconds, 0)
+        finally:
+            net.close()
+
+    def test_plan_memory(self):
+        net = Net(self.model, phase=caffe_pb2.TEST)
+        try:
+            before, after = net.activation_memory
+            self.assertLessEqual(after, before)
+        finally:
+            net.close()
+
+    def test_reader_views(self):
+        net = Net(self.model, data_workers=2)
+        try:
+            reader = net.layers[0].reader
+            for _ in range(3):
+                net.forward()
+                data, label = net.blobs["data"], net.blobs["label"]
+                # The batch is read in place from the shared slot
+                self.assertTrue(np.shares_memory(data, reader.data))
+                self.assertTrue(np.shares_memory(label, reader.labels))
+                np.testing.assert_array_equal(
+                    data, np.broadcast_to(label.reshape(4, 1, 1, 1),
+                                          data.shape))
+        finally:
+            net.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+from cstructures.array import Array
+from sejits_caffe.util.col2im import Col2Im, ParallelCol2Im
+from sejits_caffe.util.im2col import Im2Col
+import numpy as np
+
+
+def py_col2im(data_col, shape, kernel_size, stride, padding):
+    kernel_h, kernel_w = kernel_size
+    stride_h, stride_w = stride
+    pad_h, pad_w = padding
+    num, channels, height, width = shape
+    height_col = (height + 2 * pad_h - kernel_h) // stride_h + 1
+    width_col = (width + 2 * pad_w - kernel_w) // stride_w + 1
+    padded = np.zeros((num, channels, height + 2 * pad_h,
+                       width + 2 * pad_w), np.float32)
+    col = data_col.reshape(channels, kernel_h, kernel_w, num, height_col,
+                           width_col)
+    for y in range(kernel_h):
+        for x in range(kernel_w):
+            padded[:, :, y:y + stride_h * height_col:stride_h,
+                   x:x + stride_w * width_col:stride_w] += \
+                col[:, y, x].transpose(1, 0, 2, 3)
+    return padded[:, :, pad_h:pad_h + height, pad_w:pad_w + width]
+
+
+class TestCol2Im(unittest.TestCase):
+    def _check(self, actual, expected):
+        np.testing.assert_allclose(actual, expected, rtol=1e-5)
+
+    def _test(self, col2im_class, shape, kernel_size, stride, padding):
+        col_shape = Im2Col(kernel_size, stride, padding).col_shape(shape)
+        data_col = Array.rand(*col_shape).astype(np.float32)
+        col2im = col2im_class(kernel_size, stride, padding, shape)
+        # The kernel must clear whatever is already in the output.
+        output = Array.ones(shape, np.float32)
+        actual = col2im(data_col, output)
+        self.assertIs(actual, output)
+        self._check(actual,
+                    py_col2im(data_col, shape, kernel_size, stride, padding))
+
+    def test_simple(self):
+        self._test(Col2Im, (2, 3, 13, 13), (3, 3), (1, 1), (1, 1))
+
+    def test_strided(self):
+        self._test(Col2Im, (2, 3, 31, 31), (11, 11), (4, 4), (0, 0))
+
+    def test_parallel(self):
+        for kernel_size, stride, padding in [((3, 3), (1, 1), (1, 1)),
+                                             ((5, 3), (2, 3), (2, 1)),
+                                             ((11, 11), (4, 4), (0, 0))]:
+            self._test(ParallelCol2Im, (3, 4, 17, 19), kernel_size, stride,
+                       padding)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+from cstructures.array import Array
+from sejits_caffe.util.data_transform import BatchTransform
+import numpy as np
+
+
+def py_transform(data, mean, h_offsets, w_offsets, mirror, crop, scale):
+    output = []
+    for n in range(data.shape[0]):
+        sample = (data[n].astype(np.float32) - mean) * scale
+        sample = sample[:, h_offsets[n]:h_offsets[n] + crop,
+                        w_offsets[n]:w_offsets[n] + crop]
+        if mirror[n]:
+            sample = sample[..., ::-1]
+        output.append(sample)
+    return np.array(output)
+
+
+class TestBatchTransform(unittest.TestCase):
+    def setUp(self):
+        self.data = np.random.randint(
+            256, size=(4, 3, 10, 12)).astype(np.uint8)
+        self.h_offsets = np.array([0, 3, 1, 2], np.int32)
+        self.w_offsets = np.array([5, 0, 2, 4], np.int32)
+        self.mirror = np.array([0, 1, 1, 0], np.int32)
+        self.output = Array.zeros((4, 3, 7, 7), np.float32)
+
+    def _test(self, mean, mean_mode, expected_mean):
+        transform = BatchTransform(0.5, mean_mode)
+        transform(self.data, mean, self.h_offsets, self.w_offsets,
+                  self.mirror, self.output)
+        expected = py_transform(self.data, expected_mean, self.h_offsets,
+                                self.w_offsets, self.mirror, 7, 0.5)
+        np.testing.assert_allclose(self.output, expected, rtol=1e-5)
+
+    def test_mean_file(self):
+        mean = Array.rand(3 * 10 * 12).astype(np.float32) * 255
+        self._test(mean, "file", mean.reshape(3, 10, 12))
+
+    def test_mean_value(self):
+        mean = Array.array([104, 117, 123]).astype(np.float32)
+        self._test(mean, "value", mean.reshape(3, 1, 1))
+
+    def test_no_mean(self):
+        self._test(Array.zeros((1, ), np.float32), "none", 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+from cstructures.array import Array
+from sejits_caffe.util.epilogue import Epilogue
+import numpy as np
+
+
+class TestEpilogue(unittest.TestCase):
+    def _test(self, shape, negative_slope, bias_term=True):
+        data = Array.rand(*shape).astype(np.float32) - 0.5
+        bias = Array.rand(shape[1]).astype(np.float32) - 0.5
+        expected = np.array(data)
+        if bias_term:
+            expected += bias.reshape((1, -1) + (1, ) * (len(shape) - 2))
+        if negative_slope is not None:
+            expected = np.where(expected > 0, expected,
+                                expected * negative_slope)
+        epilogue = Epilogue(negative_slope)
+        if bias_term:
+            epilogue(data, bias)
+        else:
+            epilogue(data)
+        np.testing.assert_allclose(data, expected, rtol=1e-6)
+
+    def test_bias(self):
+        self._test((3, 5, 4, 6), None)
+
+    def test_bias_relu(self):
+        self._test((3, 5, 4, 6), 0.0)
+
+    def test_leaky_relu(self):
+        self._test((3, 5, 4, 6), 0.1)
+
+    def test_no_bias(self):
+        self._test((3, 5, 4, 6), 0.0, bias_term=False)
+
+    def test_inner_product(self):
+        self._test((4, 7), 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+from cstructures.array import Array
+from sejits_caffe.util.im2col import Im2Col, ParallelIm2Col
+from sejits_caffe.util.workspace import Workspace
+import numpy as np
+
+
+def py_im2col(data, kernel_size, stride, padding):
+    kernel_h, kernel_w = kernel_size
+    stride_h, stride_w = stride
+    pad_h, pad_w = padding
+    num, channels, height, width = data.shape
+    height_col = (height + 2 * pad_h - kernel_h) // stride_h + 1
+    width_col = (width + 2 * pad_w - kernel_w) // stride_w + 1
+    padded = np.pad(data, ((0, 0), (0, 0), (pad_h, pad_h), (pad_w, pad_w)),
+                    'constant')
+    col = np.zeros((channels, kernel_h, kernel_w, num, height_col,
+                    width_col), np.float32)
+    for y in range(kernel_h):
+        for x in range(kernel_w):
+            col[:, y, x] = padded[
+                :, :, y:y + stride_h * height_col:stride_h,
+                x:x + stride_w * width_col:stride_w].transpose(1, 0, 2, 3)
+    return col.reshape(channels * kernel_h * kernel_w,
+                       num * height_col * width_col)
+
+
+class TestIm2Col(unittest.TestCase):
+    def _check(self, actual, expected):
+        np.testing.assert_allclose(actual, expected)
+
+    def test_single_image(self):
+        data = Array.rand(3, 32, 32).astype(np.float32)
+        im2col = Im2Col((5, 5), (1, 1), (2, 2))
+        actual = im2col(data)
+        expected = py_im2col(data[np.newaxis], (5, 5), (1, 1), (2, 2))
+        self._check(actual, expected)
+
+    def test_batch(self):
+        data = Array.rand(4, 3, 31, 31).astype(np.float32)
+        im2col = Im2Col((11, 11), (4, 4), (0, 0))
+        actual = im2col(data)
+        expected = py_im2col(data, (11, 11), (4, 4), (0, 0))
+        self._check(actual, expected)
+
+    def test_workspace(self):
+        data = Array.rand(2, 8, 13, 13).astype(np.float32)
+        im2col = Im2Col((3, 3), (1, 1), (1, 1))
+        workspace = Workspace()
+        output = workspace.view(im2col.col_shape(data.shape))
+        actual = im2col(data, output)
+        self.assertIs(actual, output)
+        self._check(workspace.buffer[:actual.size].reshape(actual.shape),
+                    py_im2col(data, (3, 3), (1, 1), (1, 1)))
+
+    def test_parallel(self):
+        data = Array.rand(3, 4, 17, 19).astype(np.float32)
+        for kernel_size, stride, padding in [((3, 3), (1, 1), (1, 1)),
+                                             ((5, 3), (2, 3), (2, 1)),
+                                             ((11, 11), (4, 4), (0, 0))]:
+            im2col = ParallelIm2Col(kernel_size, stride, padding,
+                                    num_threads=2)
+            self._check(im2col(data),
+                        py_im2col(data, kernel_size, stride, padding))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import unittest
+from cstructures.array import Array
+from sejits_caffe.util.im2col import Im2Col
+from sejits_caffe.util import kernel_cache
+import ctree
+import os
+import shutil
+import tempfile
+import numpy as np
+
+
+class TestKernelCache(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.previous = kernel_cache.kernel_cache, kernel_cache.enabled
+
+    def tearDown(self):
+        kernel_cache.kernel_cache, kernel_cache.enabled = self.previous
+        shutil.rmtree(self.path)
+
+    def _im2col(self, shape):
+        data = Array.rand(*shape).astype(np.float32)
+        return Im2Col((3, 3), (1, 1), (1, 1))(data)
+
+    def test_warm_restart(self):
+        cache = kernel_cache.enable_kernel_cache(self.path)
+        expected = self._im2col((2, 3, 8, 8))
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        # A new cache on the same directory stands in for a new process
+        cache = kernel_cache.enable_kernel_cache(self.path)
+        actual = self._im2col((2, 3, 8, 8))
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+        self.assertEqual(actual.shape, expected.shape)
+
+    def test_eviction(self):
+        cache = kernel_cache.enable_kernel_cache(self.path, max_size=0)
+        self._im2col((2, 3, 8, 8))
+        self._im2col((2, 3, 9, 9))
+        self.assertEqual(cache.misses, 2)
+        kernels = [name for name in os.listdir(self.path)
+                   if name.endswith(".so")]
+        self.assertEqual(len(kernels), 1)
+
+    def test_rebuild_unloadable(self):
+        kernel_cache.enable_kernel_cache(os.path.join(self.path, "a"))
+        self._im2col((2, 3, 8, 8))
+        # The same kernel in another directory, evicted (or truncated) by
+        # another process between the check and the load.  (The first one
+        # stays mapped into this process.)
+        other = os.path.join(self.path, "b")
+        os.makedirs(other)
+        for name in os.listdir(os.path.join(self.path, "a")):
+            if name.endswith(".so"):
+                with open(os.path.join(other, name), "w") as f:
+                    f.write("evicted")
+        cache = kernel_cache.enable_kernel_cache(other)
+        self._im2col((2, 3, 8, 8))
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+    def test_evicted_after_build(self):
+        cache = kernel_cache.enable_kernel_cache(self.path)
+        evict, evicted = cache.evict, []
+
+        def evict_new_kernel(keep=None):
+            evict(keep)
+            # Another process evicting the kernel before it is loaded
+            if not evicted:
+                evicted.append(keep)
+                os.remove(keep)
+        cache.evict = evict_new_kernel
+        self._im2col((2, 3, 8, 8))
+        self.assertEqual(len(evicted), 1)
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+    def test_quoted_path(self):
+        path = os.path.join(self.path, "kernels $(exit 1); 'x'")
+        cache = kernel_cache.enable_kernel_cache(path)
+        self._im2col((2, 3, 8, 8))
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(len(os.listdir(path)), 1)
+
+    def test_disabled(self):
+        kernel_cache.disable_kernel_cache()
+        self._im2col((2, 3, 8, 8))
+        cache = kernel_cache.get_kernel_cache()
+        # Compiled in a directory private to the process, with the
+        # package's flags but without adding them to ctree's configuration
+        self.assertEqual(cache.misses, 1)
+        self.assertNotEqual(cache.path, kernel_cache.default_path)
+        self.assertNotIn(kernel_cache.cflags,
+                         ctree.CONFIG.get("omp", "CFLAGS"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+from sejits_caffe.util.memory_planner import blob_lifetimes, plan_blobs
+
+
+class TestMemoryPlanner(unittest.TestCase):
+    def setUp(self):
+        # data -> conv1 -> relu1 (out of place) -> pool1 -> fc -> loss
+        self.steps = [
+            ([], ["data", "label"]),
+            (["data"], ["conv1"]),
+            (["conv1"], ["relu1"]),
+            (["relu1"], ["pool1"]),
+            (["pool1"], ["fc"]),
+            (["fc", "label"], ["loss"]),
+        ]
+        self.sizes = {"data": 300, "label": 1, "conv1": 1000, "relu1": 1000,
+                      "pool1": 250, "fc": 10, "loss": 1}
+
+    def _check(self, arena_sizes, assignment, outputs=("loss", )):
+        lifetimes = blob_lifetimes(self.steps, outputs)
+        for blob, arena in assignment.items():
+            self.assertGreaterEqual(arena_sizes[arena], self.sizes[blob])
+            for other, other_arena in assignment.items():
+                if other == blob or other_arena != arena:
+                    continue
+                first, last = lifetimes[blob]
+                other_first, other_last = lifetimes[other]
+                overlap = first <= other_last and other_first <= last
+                # Only an in-place hand over may overlap, at a single step
+                self.assertTrue(not overlap or last == other_first or
+                                other_last == first, (blob, other))
+
+    def test_shared(self):
+        arena_sizes, assignment = plan_blobs(self.steps, self.sizes,
+                                             ["loss"])
+        self._check(arena_sizes, assignment)
+        self.assertNotEqual(assignment["conv1"], assignment["relu1"])
+        self.assertLess(sum(arena_sizes), sum(self.sizes.values()))
+
+    def test_in_place(self):
+        arena_sizes, assignment = plan_blobs(self.steps, self.sizes,
+                                             ["loss"], in_place=[2])
+        self._check(arena_sizes, assignment)
+        self.assertEqual(assignment["conv1"], assignment["relu1"])
+        # conv1/relu1/fc, data/pool1/loss and label
+        self.assertEqual(sum(arena_sizes), 1000 + 300 + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
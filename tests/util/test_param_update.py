@@ -0,0 +1,52 @@
+import unittest
+from cstructures.array import Array
+from sejits_caffe.util.param_update import ParamUpdate
+import sejits_caffe.caffe_pb2 as caffe_pb2
+import numpy as np
+
+
+class TestParamUpdate(unittest.TestCase):
+    def _check(self, actual, expected):
+        np.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-6)
+
+    def _test(self, solver_type, regularization_type, expected_update):
+        momentum, rate, decay, diff_scale = 0.9, 0.01, 0.0005, 0.5
+        data = Array.standard_normal((64, 3, 5, 5)).astype(np.float32)
+        diff = Array.standard_normal(data.shape).astype(np.float32)
+        history = Array.rand(*data.shape).astype(np.float32)
+        if regularization_type == "L2":
+            grad = diff_scale * diff + decay * data
+        else:
+            grad = diff_scale * diff + decay * np.sign(data)
+        expected_data, expected_history = expected_update(
+            data.copy(), history.copy(), grad, rate, momentum)
+
+        update = ParamUpdate(solver_type, momentum, 1e-8,
+                             regularization_type)
+        update(data, diff, history, rate, decay, diff_scale)
+        self._check(data, expected_data)
+        self._check(history, expected_history)
+
+    def test_sgd(self):
+        def sgd(data, history, grad, rate, momentum):
+            history = momentum * history + rate * grad
+            return data - history, history
+        self._test(caffe_pb2.SolverParameter.SGD, "L2", sgd)
+        self._test(caffe_pb2.SolverParameter.SGD, "L1", sgd)
+
+    def test_nesterov(self):
+        def nesterov(data, history, grad, rate, momentum):
+            new_history = momentum * history + rate * grad
+            return data - ((1 + momentum) * new_history -
+                           momentum * history), new_history
+        self._test(caffe_pb2.SolverParameter.NESTEROV, "L2", nesterov)
+
+    def test_adagrad(self):
+        def adagrad(data, history, grad, rate, momentum):
+            history = history + grad * grad
+            return data - rate * grad / (np.sqrt(history) + 1e-8), history
+        self._test(caffe_pb2.SolverParameter.ADAGRAD, "L2", adagrad)
+
+
+if __name__ == '__main__':
+    unittest.main()
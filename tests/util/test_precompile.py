@@ -0,0 +1,78 @@
+import unittest
+from cstructures.array import Array
+from sejits_caffe.layers.conv_layer import ConvLayer
+from sejits_caffe.util import kernel_cache
+from sejits_caffe.util.precompile import kernel, precompile_all
+from sejits_caffe.util.relu import ReluForward
+import sejits_caffe.caffe_pb2 as caffe_pb2
+import ctree
+from google.protobuf import text_format
+import os
+import shutil
+import tempfile
+import numpy as np
+
+
+path = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir,
+                    'layers')
+
+
+class TestPrecompile(unittest.TestCase):
+    def setUp(self):
+        param_string = open(path + '/alexnet.prototxt').read()
+        param = caffe_pb2.NetParameter()
+        text_format.Merge(param_string, param)
+        self.layer = param.layer
+        self.cache_path = tempfile.mkdtemp()
+        self.previous = kernel_cache.kernel_cache, kernel_cache.enabled
+
+    def tearDown(self):
+        kernel_cache.kernel_cache, kernel_cache.enabled = self.previous
+        shutil.rmtree(self.cache_path)
+
+    def test_conv_layers(self):
+        cache = kernel_cache.enable_kernel_cache(self.cache_path)
+        layers, jobs = [], []
+        for index, shape in ((2, (2, 3, 27, 27)), (6, (2, 96, 13, 13))):
+            layer = ConvLayer(self.layer[index])
+            bottom = Array.rand(*shape).astype(np.float32)
+            top = Array.zeros(layer.get_top_shape(bottom), np.float32)
+            layer.setup(bottom, top)
+            layers.append((layer, bottom, top))
+            jobs.extend(layer.kernels(bottom, top))
+        # im2col and col2im for each layer
+        self.assertEqual(precompile_all(jobs, 2), 4)
+        self.assertEqual(cache.misses, 4)
+        for layer, bottom, top in layers:
+            layer.forward(bottom, top)
+            layer.backward(bottom, Array.zeros_like(bottom), top,
+                           Array.rand(*top.shape).astype(np.float32))
+        self.assertEqual(cache.misses, 4)
+
+    def test_reused_without_jit_cache(self):
+        # ctree only reuses its own concrete functions with jit CACHE set
+        cache = ctree.CONFIG.get("jit", "CACHE")
+        ctree.CONFIG.set("jit", "CACHE", "False")
+        try:
+            relu = ReluForward()
+            finalize = relu.finalize
+            calls = []
+
+            def counting_finalize(*args):
+                calls.append(args)
+                return finalize(*args)
+
+            relu.finalize = counting_finalize
+            bottom = Array.rand(4, 8).astype(np.float32) - 0.5
+            top = Array.zeros_like(bottom)
+            self.assertEqual(precompile_all([kernel(relu, bottom, top)]), 1)
+            relu(bottom, top)
+            relu(bottom, top)
+            self.assertEqual(len(calls), 1)
+            np.testing.assert_array_equal(top, np.maximum(bottom, 0))
+        finally:
+            ctree.CONFIG.set("jit", "CACHE", cache)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+from sejits_caffe.util.profiler import Profiler
+import csv
+import json
+import os
+import shutil
+import tempfile
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.profiler = Profiler(capacity=4, enabled=True)
+        start = self.profiler.now()
+        self.profiler.record("forward", "conv1", start, start + 0.5)
+        self.profiler.record("forward", "conv1", start, start + 1.5)
+        self.profiler.record("backward", "conv1", start, start + 2.0)
+        self.profiler.allocated("data", 1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_summary(self):
+        summary = dict(((entry["category"], entry["name"]), entry)
+                       for entry in self.profiler.summary())
+        forward = summary["forward", "conv1"]
+        self.assertEqual(forward["calls"], 2)
+        self.assertAlmostEqual(forward["total"], 2.0)
+        self.assertAlmostEqual(forward["mean"], 1.0)
+        self.assertAlmostEqual(forward["max"], 1.5)
+        self.assertEqual(summary["alloc", "data"]["bytes"], 1024)
+
+    def test_ring_buffer(self):
+        start = self.profiler.now()
+        self.profiler.record("forward", "relu1", start)
+        self.assertEqual(len(self.profiler.events), 4)
+        self.assertEqual(self.profiler.events[-1][1], "relu1")
+        self.assertEqual(self.profiler.events[0][3], 1.5)
+
+    def test_export(self):
+        self.profiler.to_json(os.path.join(self.path, "profile.json"))
+        with open(os.path.join(self.path, "profile.json")) as f:
+            profile = json.load(f)
+        self.assertEqual(len(profile["events"]), 4)
+
+        self.profiler.to_csv(os.path.join(self.path, "profile.csv"))
+        with open(os.path.join(self.path, "profile.csv")) as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual(len(rows), 3)
+
+        self.profiler.to_chrome_trace(os.path.join(self.path, "trace.json"))
+        with open(os.path.join(self.path, "trace.json")) as f:
+            trace = json.load(f)
+        event = trace["traceEvents"][2]
+        self.assertEqual((event["name"], event["cat"], event["ph"]),
+                         ("conv1", "backward", "X"))
+        self.assertAlmostEqual(event["dur"], 2e6)
+
+
+if __name__ == '__main__':
+    unittest.main()
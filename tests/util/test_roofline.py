@@ -0,0 +1,47 @@
+import unittest
+from sejits_caffe.util.roofline import roofline, flag_worst, format_report
+
+
+class TestRoofline(unittest.TestCase):
+    def setUp(self):
+        # A 100 GFLOP/s, 10 GB/s machine has its ridge at 10 FLOP/B
+        self.peaks = 100.0, 10.0
+        self.costs = [
+            ("data", "Data", 0, 10 ** 6),
+            ("conv1", "Convolution", 10 ** 9, 10 ** 7),
+            ("relu1", "ReLU", 10 ** 6, 8 * 10 ** 6),
+            ("loss", "SoftmaxWithLoss", 5000, 8000),
+        ]
+        self.times = {"data": 1e-3, "conv1": 0.02, "relu1": 0.004,
+                      "loss": 1e-6}
+
+    def test_rows(self):
+        rows = roofline(self.costs, self.times, *self.peaks)
+        self.assertEqual([row["name"] for row in rows],
+                         ["data", "conv1", "relu1", "loss"])
+        data, conv, relu, loss = rows
+        self.assertAlmostEqual(conv["gflops"], 50.0)
+        self.assertAlmostEqual(conv["gbps"], 0.5)
+        self.assertEqual(conv["bound"], "compute")
+        self.assertAlmostEqual(conv["efficiency"], 0.5)
+        self.assertEqual(relu["bound"], "memory")
+        self.assertAlmostEqual(relu["efficiency"], 0.2)
+        self.assertAlmostEqual(data["efficiency"], 0.1)
+
+    def test_missing_times(self):
+        del self.times["relu1"]
+        rows = roofline(self.costs, self.times, *self.peaks)
+        self.assertNotIn("relu1", [row["name"] for row in rows])
+
+    def test_flag_worst(self):
+        rows = flag_worst(roofline(self.costs, self.times, *self.peaks), 2)
+        flagged = [row["name"] for row in rows if row["flagged"]]
+        # The loss is the least efficient but too short to matter
+        self.assertEqual(flagged, ["data", "relu1"])
+        report = format_report(rows, *self.peaks)
+        self.assertIn("ridge at 10.00 FLOP/B", report)
+        self.assertEqual(len(report.splitlines()), 2 + len(rows))
+
+
+if __name__ == '__main__':
+    unittest.main()